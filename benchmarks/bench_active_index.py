@@ -0,0 +1,97 @@
+"""Reconciliation cycle of the cluster agent: full status table scan vs. the active job index.
+
+Each cycle reads one squeue snapshot with check_job_statuses and compares it with the unfinished jobs of the
+cluster, found either by scanning the whole status table (as before the index) or read from ActiveJobIndex.
+squeue is replaced by its recorded output so that only the agent's side of the cycle is measured.
+
+Run it from a project folder with kafkaslurm_cfg.py: python benchmarks/bench_active_index.py
+"""
+import ast
+import time
+
+from kafka_slurm_agent.kafka_modules import ActiveJobIndex, ACTIVE_STATUSES, ClusterAgent, JobStatus, config
+from kafka_slurm_agent.slurm_modules import SlurmQueueSnapshot
+
+ACTIVE_JOBS = 500
+
+
+class CountingSender:
+    def __init__(self):
+        self.sent = 0
+
+    def send(self, *args, **kwargs):
+        self.sent += 1
+
+
+def make_table(size):
+    table = {}
+    for i in range(size):
+        table['job_{}'.format(i)] = JobStatus('DONE', config['CLUSTER_NAME'], job_id=i).to_dict()
+    for i in range(ACTIVE_JOBS):
+        table['active_{}'.format(i)] = JobStatus('RUNNING', config['CLUSTER_NAME'], job_id=size + i).to_dict()
+    return table
+
+
+def make_agent(size):
+    agent = ClusterAgent.__new__(ClusterAgent)
+    agent.job_name_suffix = config['CLUSTER_JOB_NAME_SUFFIX']
+    agent.array_tasks = {}
+    agent.stat_send = CountingSender()
+    agent.queue_snapshot = SlurmQueueSnapshot('bench', agent.job_name_suffix, ttl=0)
+    squeue = ''.join('{}|RUNNING|1:00:00|bench|node1|active_{}{}\n'.format(size + i, i, agent.job_name_suffix)
+                     for i in range(ACTIVE_JOBS))
+    agent.queue_snapshot.query = lambda: squeue
+    return agent
+
+
+def reconcile(agent, active, all_stats):
+    for key, js in active.items():
+        if key in all_stats:
+            job_id, status, reason, run_time = all_stats.pop(key)
+            if js['status'] != status:
+                agent.stat_send.send(key, status, js['job_id'], node=reason)
+        else:
+            agent.stat_send.send(key, 'ERROR', js['job_id'], error='Missing from slurm queue')
+    for key, (job_id, status, reason, run_time) in all_stats.items():
+        agent.stat_send.send(key, status, job_id, node=reason)
+
+
+def full_scan_cycle(agent, table):
+    all_stats = agent.check_job_statuses()
+    active = {}
+    for key in list(table.keys()):
+        if key in table.keys():
+            js = ast.literal_eval(str(table[key]))
+            if js['cluster'] == config['CLUSTER_NAME'] and js['status'] in ACTIVE_STATUSES:
+                active[key] = js
+    reconcile(agent, active, all_stats)
+
+
+def indexed_cycle(agent, index):
+    active = dict(index.items())
+    all_stats = agent.check_job_statuses({str(js.job_id): key for key, js in active.items() if js.job_id is not None})
+    reconcile(agent, active, all_stats)
+
+
+def timed(func, *args, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+if __name__ == '__main__':
+    print('{:>10} {:>14} {:>14}'.format('table size', 'full scan [s]', 'index [s]'))
+    for size in [10 ** 3, 10 ** 4, 10 ** 5, 10 ** 6]:
+        table = make_table(size)
+        index = ActiveJobIndex(lambda js: js.cluster == config['CLUSTER_NAME'])
+        index.rebuild(table)
+        agent = make_agent(size)
+        full_scan = timed(full_scan_cycle, agent, table, repeat=1)
+        indexed = timed(indexed_cycle, agent, index)
+        # nothing changed in the queue - neither cycle sends a status
+        assert agent.stat_send.sent == 0 and len(index) == ACTIVE_JOBS
+        print('{:>10} {:>14.6f} {:>14.6f}'.format(size, full_scan, indexed))
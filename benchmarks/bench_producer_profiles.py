@@ -0,0 +1,96 @@
+"""Cost of the producer profiles: serializers (KAFKA_SERIALIZER) and compression (KAFKA_PRODUCER_COMPRESSION_TYPE).
+
+Without arguments it measures serialization and compression of batches of job messages in memory.
+With --live it sends the messages to a Kafka topic with each profile and reports the throughput (needs a broker).
+
+Run it from a project folder with kafkaslurm_cfg.py: python benchmarks/bench_producer_profiles.py [--live]
+"""
+import datetime
+import sys
+import time
+
+from kafka.codec import gzip_encode, has_lz4, lz4_encode, has_zstd, zstd_encode, has_snappy, snappy_encode
+
+from kafka_slurm_agent.kafka_modules import config, KafkaSender
+from kafka_slurm_agent.serializers import serializers, loads
+
+MESSAGES = 100000
+BATCH_SIZE = 16384
+LIVE_TOPIC = 'ksa_benchmark'
+
+COMPRESSIONS = {None: lambda b: b, 'gzip': gzip_encode}
+if has_lz4():
+    COMPRESSIONS['lz4'] = lz4_encode
+if has_zstd():
+    COMPRESSIONS['zstd'] = zstd_encode
+if has_snappy():
+    COMPRESSIONS['snappy'] = snappy_encode
+
+
+def make_messages(count):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    return [{'input_job_id': 'job_{}'.format(i), 'script': 'run.py',
+             'slurm_pars': {'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu', 'MEM': '4gb'}, 'timestamp': timestamp}
+            for i in range(count)]
+
+
+def batches(data):
+    batch = []
+    size = 0
+    for el in data:
+        batch.append(el)
+        size += len(el)
+        if size >= BATCH_SIZE:
+            yield b''.join(batch)
+            batch = []
+            size = 0
+    if batch:
+        yield b''.join(batch)
+
+
+def offline(msgs):
+    print('{:<8} {:>12} {:>12} {:>10} {:>12} {:>12}'.format('serializer', 'dumps msg/s', 'loads msg/s', 'bytes',
+                                                            'compression', 'compr. bytes'))
+    for name, serializer in serializers.items():
+        start = time.perf_counter()
+        data = [serializer.dumps(m) for m in msgs]
+        dumps_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for el in data:
+            loads(el)
+        loads_time = time.perf_counter() - start
+        raw_size = sum(len(el) for el in data)
+        for compression, encode in COMPRESSIONS.items():
+            start = time.perf_counter()
+            size = sum(len(encode(batch)) for batch in batches(data))
+            compress_time = time.perf_counter() - start
+            print('{:<10} {:>12.0f} {:>12.0f} {:>10} {:>12} {:>12} ({:.3f}s)'.format(
+                name, len(msgs) / dumps_time, len(msgs) / loads_time, raw_size, str(compression), size,
+                compress_time))
+
+
+def live(msgs):
+    for name in serializers:
+        for compression in COMPRESSIONS:
+            for linger_ms in [0, 20]:
+                config['KAFKA_SERIALIZER'] = name
+                sender = KafkaSender()
+                sender.producer.close()
+                producer = sender.init_kafka_producer(compression_type=compression, linger_ms=linger_ms,
+                                                      batch_size=BATCH_SIZE * 4)
+                start = time.perf_counter()
+                for msg in msgs:
+                    producer.send(LIVE_TOPIC, key=msg['input_job_id'].encode('utf-8'), value=msg)
+                producer.flush()
+                elapsed = time.perf_counter() - start
+                producer.close()
+                print('{:<8} {:<6} linger_ms={:<3} {:>10.0f} msg/s'.format(name, str(compression), linger_ms,
+                                                                            len(msgs) / elapsed))
+
+
+if __name__ == '__main__':
+    messages = make_messages(MESSAGES)
+    if '--live' in sys.argv:
+        live(messages)
+    else:
+        offline(messages)
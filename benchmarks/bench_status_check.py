@@ -0,0 +1,73 @@
+"""Checking job statuses before submission: one request per id (check/{id}/) vs. bulk POST check/ over keep-alive.
+
+By default both paths are measured against a local stand-in of the monitor agent serving the same replies,
+with --monitor against the monitor agent configured in MONITOR_AGENT_URL (the ids do not have to exist).
+
+Run it from a project folder with kafkaslurm_cfg.py: python benchmarks/bench_status_check.py [--monitor]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from kafka_slurm_agent.kafka_modules import config, JobSubmitter, MonitorClient
+
+IDS = 100000
+PER_ID_SAMPLE = 2000
+
+
+class StandInMonitor(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    @staticmethod
+    def status(input_job_id):
+        return {'status': 'DONE', 'cluster': 'bench', 'timestamp': 0} if input_job_id.endswith('0') else ''
+
+    def reply(self, result):
+        data = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        input_job_id = self.path.rstrip('/').split('/')[-1]
+        self.reply({input_job_id: self.status(input_job_id)})
+
+    def do_POST(self):
+        ids = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.reply({input_job_id: self.status(input_job_id) for input_job_id in ids})
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    if '--monitor' not in sys.argv:
+        server = ThreadingHTTPServer(('127.0.0.1', 0), StandInMonitor)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        config['MONITOR_AGENT_URL'] = 'http://127.0.0.1:{}/'.format(server.server_address[1])
+        config['MONITOR_AGENT_CONTEXT_PATH'] = ''
+    ids = ['bench_job_{}'.format(i) for i in range(IDS)]
+
+    start = time.perf_counter()
+    for s_id in ids[:PER_ID_SAMPLE]:
+        JobSubmitter.check_status(s_id)
+    per_id = PER_ID_SAMPLE / (time.perf_counter() - start)
+    print('per id check/{{id}}/: {:>10.0f} ids/s ({} ids, {:.0f} s for {})'.format(per_id, PER_ID_SAMPLE, IDS / per_id, IDS))
+
+    for chunk_size in [100, 1000, 10000]:
+        client = MonitorClient()
+        start = time.perf_counter()
+        for i in range(0, IDS, chunk_size):
+            client.check_statuses(ids[i:i + chunk_size])
+        elapsed = time.perf_counter() - start
+        client.close()
+        print('bulk POST check/ chunk {:>5}: {:>10.0f} ids/s ({:.2f} s for {})'.format(chunk_size, IDS / elapsed, elapsed, IDS))
+
+
+if __name__ == '__main__':
+    main()
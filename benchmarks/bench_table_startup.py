@@ -0,0 +1,95 @@
+"""Startup time of the job_status table: in-memory (TABLE_STORE = 'memory://') vs. RocksDB (TABLE_STORE = 'rocksdb://').
+
+An in-memory table replays the whole changelog on every start. A RocksDB table keeps the data and the last
+changelog offset on disk and only replays the events written while the agent was down (the tail, --tail of
+the keys). Both then rebuild the status counters of the monitor from the table. No broker is needed: the
+changelog events are applied to the faust stores directly, like the table recovery does. The replay column
+therefore leaves out fetching the events from Kafka, which an in-memory table pays for every event it replays.
+
+Needs rocksdict (pip install "faust-streaming[rocksdict]").
+Run it from a project folder with kafkaslurm_cfg.py: python benchmarks/bench_table_startup.py [--tail 0.01]
+"""
+import json
+import shutil
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+import faust
+from faust.types import TP
+
+from kafka_slurm_agent.kafka_modules import StatusCounters, now_ms
+
+BATCH_SIZE = 1000
+CHANGELOG = TP('bench-job_status-changelog', 0)
+
+
+def make_events(size, start=0):
+    events = []
+    for i in range(start, start + size):
+        key = 'job_{}'.format(i)
+        value = {'status': 'DONE', 'cluster': 'cluster_{}'.format(i % 4), 'job_id': i, 'node': 'node_{}'.format(i % 64),
+                 'timestamp': now_ms()}
+        events.append(SimpleNamespace(key=key, value=value, message=SimpleNamespace(
+            tp=CHANGELOG, partition=CHANGELOG.partition, offset=i, key=json.dumps(key).encode('utf-8'),
+            value=json.dumps(value).encode('utf-8'))))
+    return events
+
+
+def open_table(store, datadir):
+    app = faust.App('bench', store=store, datadir=datadir)
+    # the RocksDB store only reads the partitions assigned to this worker
+    app.assignor.assigned_actives = lambda: {CHANGELOG}
+    return app.Table('job_status', default='')
+
+
+def close_table(table):
+    dbs = getattr(table.data, '_dbs', {})
+    for db in dbs.values():
+        db.close()
+    dbs.clear()
+
+
+def recover(table, events):
+    for i in range(0, len(events), BATCH_SIZE):
+        table.apply_changelog_batch(events[i:i + BATCH_SIZE])
+
+
+def start(store, datadir, events):
+    '''Open the table, replay the changelog it is missing and rebuild the counters, returns the timings'''
+    begin = time.perf_counter()
+    table = open_table(store, datadir)
+    offset = table.persisted_offset(CHANGELOG) if store.startswith('rocksdb') else None
+    tail = events if offset is None else [event for event in events if event.message.offset > offset]
+    recover(table, tail)
+    recovered = time.perf_counter()
+    counters = StatusCounters()
+    counters.rebuild(table)
+    ready = time.perf_counter()
+    assert sum(counters.statuses.values()) == len(events)
+    close_table(table)
+    return len(tail), recovered - begin, ready - recovered, ready - begin
+
+
+def main(tail_fraction):
+    print('{:>8} {:>14} {:>9} {:>11} {:>13} {:>10}'.format('keys', 'mode', 'replayed', 'replay [s]', 'counters [s]',
+                                                          'total [s]'))
+    for size in [10 ** 5, 10 ** 6]:
+        events = make_events(size)
+        tail = max(1, int(size * tail_fraction))
+        datadir = tempfile.mkdtemp(prefix='ksa_bench_')
+        try:
+            runs = [('memory', start('memory://', datadir, events)),
+                    # the first run creates the database, the agent is then down while the tail is written
+                    ('rocksdb cold', start('rocksdb://', datadir, events[:size - tail])),
+                    ('rocksdb warm', start('rocksdb://', datadir, events))]
+        finally:
+            shutil.rmtree(datadir, ignore_errors=True)
+        for mode, (replayed, replay, rebuild, total) in runs:
+            print('{:>8} {:>14} {:>9} {:>11.3f} {:>13.3f} {:>10.3f}'.format(size, mode, replayed, replay, rebuild,
+                                                                            total))
+
+
+if __name__ == '__main__':
+    main(float(sys.argv[sys.argv.index('--tail') + 1]) if '--tail' in sys.argv else 0.01)
@@ -0,0 +1,13 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# kafka_modules loads kafkaslurm_cfg.py from the home folder when it is imported, the tests use a copy of the
+# template in a temporary home folder so they do not depend on (or write to the folders of) a local configuration
+TEST_HOME = tempfile.mkdtemp(prefix='ksa_test_')
+atexit.register(shutil.rmtree, TEST_HOME, ignore_errors=True)
+os.makedirs(os.path.join(TEST_HOME, 'logs'))
+shutil.copy(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'kafkaslurm_cfg.py__'),
+            os.path.join(TEST_HOME, 'kafkaslurm_cfg.py'))
+os.environ['HOME'] = TEST_HOME
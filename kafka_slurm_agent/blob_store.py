@@ -0,0 +1,61 @@
+import hashlib
+import os
+import uuid
+
+
+class BlobStore:
+    '''Content addressed store for results too large to be sent through Kafka
+
+       Subclasses (RESULTS_BLOB_STORE_CLASS) implement put, open and exists for other backends.
+       '''
+
+    @staticmethod
+    def digest(data):
+        return hashlib.sha256(data).hexdigest()
+
+    def put(self, data):
+        '''Store the bytes and return their sha256 digest'''
+        raise NotImplementedError
+
+    def open(self, digest):
+        '''Return a binary file-like object to stream the blob'''
+        raise NotImplementedError
+
+    def exists(self, digest):
+        raise NotImplementedError
+
+    def get(self, digest):
+        with self.open(digest) as f:
+            data = f.read()
+        if self.digest(data) != digest:
+            raise ValueError('Blob {} is corrupted'.format(digest))
+        return data
+
+
+class DirectoryBlobStore(BlobStore):
+    '''Blobs kept as root/ab/cd/abcd... files, e.g. on the file system shared by the cluster and the monitor'''
+
+    def __init__(self, root):
+        self.root = root
+
+    def get_path(self, digest):
+        return os.path.join(self.root, digest[:2], digest[2:4], digest)
+
+    def put(self, data):
+        digest = self.digest(data)
+        path = self.get_path(digest)
+        if os.path.exists(path):
+            # same results were already stored
+            return digest
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(path, uuid.uuid4().hex)
+        with open(tmp_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+        return digest
+
+    def open(self, digest):
+        return open(self.get_path(digest), 'rb')
+
+    def exists(self, digest):
+        return os.path.exists(self.get_path(digest))
@@ -1,10 +1,13 @@
-import ast
 import os
 
 import faust
 import sys
 from pydoc import locate
-from kafka_slurm_agent.kafka_modules import config, HeartbeatSender, ClusterAgent
+from kafka_slurm_agent.kafka_modules import config, HeartbeatSender, JobStatus, TERMINAL_STATUSES, get_cycle_scheduler, ClusterAgent, ActiveJobIndex, \
+    start_profiler, expire_statuses
+from kafka_slurm_agent.serializers import register_faust_codec
+from kafka_slurm_agent.metrics import REGISTRY, CONTENT_TYPE
+from kafka_slurm_agent.tracing import TRACER
 from concurrent.futures import ThreadPoolExecutor
 
 app = faust.App(config['CLUSTER_NAME'] + '_cluster_agent',
@@ -15,9 +18,10 @@ app = faust.App(config['CLUSTER_NAME'] + '_cluster_agent',
                 consumer_max_fetch_size=config['KAFKA_CONSUMER_MAX_FETCH_SIZE'],
                 broker_max_poll_records=config['KAFKA_BROKER_MAX_POLL_RECORDS'],
                 transaction_timeout_ms=config['KAFKA_TRANSACTION_TIMEOUT_MS'],
+                store=config['TABLE_STORE'],
+                datadir=config['TABLE_DATA_DIR'],
                 topic_partitions=1)
-#store='rocksdb://',
-jobs_topic = app.topic(config['TOPIC_STATUS'], partitions=1)
+jobs_topic = app.topic(config['TOPIC_STATUS'], partitions=1, value_serializer=register_faust_codec())
 job_status = app.Table('job_status', default='')
 
 thread_pool = ThreadPoolExecutor(max_workers=1)
@@ -25,57 +29,85 @@ sys.path.append(os.getcwd())
 ca_class = locate(config['CLUSTER_AGENT_CLASS']) if 'CLUSTER_AGENT_CLASS' in config else ClusterAgent
 ca = ca_class()
 heartbeat_sender = HeartbeatSender()
+active_jobs = ActiveJobIndex(lambda js: js.cluster == config['CLUSTER_NAME'])
 
 
 def run_cluster_agent_check():
+    with TRACER.span('run_cluster_agent_check'):
+        return check_cluster_agent()
+
+
+def check_cluster_agent():
     run_timeout = None
     if 'CLUSTER_JOB_TIMEOUT' in config and config['CLUSTER_JOB_TIMEOUT']:
         run_timeout = config['CLUSTER_JOB_TIMEOUT']
-    all_stats = ca.check_job_statuses()
-    for key in list(job_status.keys()):
-        if key in job_status.keys():
-            js = ast.literal_eval(str(job_status[key]))
-            if js['cluster'] == config['CLUSTER_NAME'] and js['status'] in ['SUBMITTED', 'WAITING', 'RUNNING', 'UPLOADING']:
-                if key in all_stats:
-                    job_id, status, reason, run_time = all_stats[key]
-                    if run_timeout and run_time and run_time > run_timeout:
-                        ca.logger.warning('Canceling job {}: {} {} {} {}'.format(key, js['job_id'], status, reason, run_time))
-                        cancel_success = ca.cancel_job(js['job_id'])
-                        if cancel_success:
-                            ca.stat_send.send(key, 'TIMEOUT', js['job_id'], error='Timeout out after {} sec.'.format(run_timeout))
-                        else:
-                            ca.stat_send.send(key, 'ERROR', js['job_id'], error='Timeout after {} sec but couldnt kill'.format(run_timeout))
-                        continue
-                    elif js['status'] != status:
-                        ca.stat_send.send(key, status, js['job_id'], node=reason)
-                    all_stats.pop(key)
+    if not active_jobs.ready:
+        with TRACER.span('rebuild_active_jobs'):
+            active_jobs.rebuild(job_status)
+    active = dict(active_jobs.items())
+    # job array tasks (jobid_taskid) share a job name so they are matched by their slurm job id
+    with TRACER.span('check_job_statuses', jobs=len(active)):
+        all_stats = ca.check_job_statuses({str(js.job_id): key for key, js in active.items() if js.job_id is not None})
+    with TRACER.span('update_statuses', jobs=len(active)):
+        update_statuses(active, all_stats, run_timeout)
+    #ca.logger.info('Checked {} jobs'.format(i))
+    if not config['MONITOR_ONLY_DO_NOT_SUBMIT']:
+        with TRACER.span('check_queue_submit'):
+            ca.check_queue_submit()
+        with TRACER.span('cleanup_job_configs'):
+            ca.cleanup_job_configs(keep=set(active).union(ca.get_queued_job_ids()))
+        with TRACER.span('is_idle'):
+            return ca.is_idle()
+    return False
+
+
+def update_statuses(active, all_stats, run_timeout):
+    for key, js in active.items():
+        if key in all_stats:
+            job_id, status, reason, run_time = all_stats.pop(key)
+            if run_timeout and run_time and run_time > run_timeout:
+                ca.logger.warning('Canceling job {}: {} {} {} {}'.format(key, js.job_id, status, reason, run_time))
+                cancel_success = ca.cancel_job(js.job_id)
+                if cancel_success:
+                    ca.stat_send.send(key, 'TIMEOUT', js.job_id, error='Timeout out after {} sec.'.format(run_timeout))
                 else:
-                    js = ast.literal_eval(str(job_status[key]))
-                    # Make sure status wasn't updated to DONE
-                    if js['cluster'] == config['CLUSTER_NAME'] and js['status'] in ['SUBMITTED', 'WAITING', 'RUNNING',
-                                                                                    'UPLOADING']:
-                        ca.stat_send.send(key, 'ERROR', js['job_id'], error='Missing from slurm queue')
-                    else:
-                        ca.logger.warning(
-                            'Changed status probably to DONE {}: {}'.format(key, js['job_id']))
+                    ca.stat_send.send(key, 'ERROR', js.job_id, error='Timeout after {} sec but couldnt kill'.format(run_timeout))
+            elif js.status != status:
+                ca.stat_send.send(key, status, js.job_id, node=reason)
+        elif ca.is_job_alive(js.job_id):
+            # Run by a pilot job which reports the statuses of its input jobs itself
+            continue
+        # Make sure status wasn't updated to DONE in the meantime
+        elif key in active_jobs:
+            ca.stat_send.send(key, 'ERROR', js.job_id, error='Missing from slurm queue')
+        else:
+            ca.logger.warning(
+                'Changed status probably to DONE {}: {}'.format(key, js.job_id))
     for k in all_stats.keys():
         job_id, status, reason, run_time = all_stats[k]
         ca.stat_send.send(k, status, job_id, node=reason)
         ca.logger.warning('No status {}: {}'.format(k, all_stats[k]))
-    #ca.logger.info('Checked {} jobs'.format(i))
-    if not config['MONITOR_ONLY_DO_NOT_SUBMIT']:
-        ca.check_queue_submit()
+
+
+scheduler = get_cycle_scheduler(run_cluster_agent_check, executor=thread_pool, logger=ca.logger)
 
 
 @app.agent(jobs_topic)
 async def process(stream):
     async for event in stream.events():
-        job_status[event.key.decode('UTF-8')] = event.value
+        key = event.key.decode('UTF-8')
+        value = JobStatus.from_value(event.value)
+        job_status[key] = value
+        active_jobs.update(key, value)
+        if value and value.status in TERMINAL_STATUSES and active_jobs.match(value):
+            ca.release_job_config(key)
+            # A slot was freed - submit the next jobs without waiting for the poll interval
+            scheduler.trigger()
 
 
-@app.timer(interval=config['POLL_INTERVAL'])
+@app.task
 async def check_statuses(app):
-    app.loop.run_in_executor(executor=thread_pool, func=run_cluster_agent_check)
+    await scheduler.run(app.loop)
 
 
 @app.timer(interval=config['HEARTBEAT_INTERVAL'] if config['HEARTBEAT_INTERVAL'] > 0 else 1440000)
@@ -83,6 +115,16 @@ async def send_heartbeat(app):
     if config['HEARTBEAT_INTERVAL'] > 0:
         heartbeat_sender.send()
 
+
+@app.timer(interval=config['STATUS_ARCHIVE_INTERVAL'])
+async def expire_old_statuses(app):
+    # finished jobs older than STATUS_ARCHIVE_AGE are not needed here, the monitor keeps them
+    if config['STATUS_ARCHIVE_AGE'] is None:
+        return
+    deleted = await expire_statuses(job_status, config['STATUS_ARCHIVE_AGE'], config['MONITOR_STATS_CHUNK_SIZE'])
+    if deleted:
+        ca.logger.info('Removed {} finished jobs from the job_status table'.format(deleted))
+
 # @app.page('/stats/')
 # async def get_stat(web, request):
 #      statuses = {}
@@ -93,5 +135,17 @@ async def send_heartbeat(app):
 #      })
 
 
+@app.page('/metrics')
+async def get_metrics(web, request):
+    return web.text(REGISTRY.expose(), headers={'Content-Type': CONTENT_TYPE})
+
+
+@app.page('/profile/')
+async def get_profile(web, request):
+    # ?seconds=N samples the stacks of the agent for N seconds into a file in LOGS_DIR
+    result, status = start_profiler(ca.logger.name, request.query.get('seconds'))
+    return web.json(result, status=status)
+
+
 if __name__ == '__main__':
     app.main()
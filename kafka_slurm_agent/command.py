@@ -1,12 +1,17 @@
 # source   jcollado http://stackoverflow.com/questions/1191374/subprocess-with-timeout?rq=1
 from os import SEEK_END
 import io
+import os
 import subprocess
 from subprocess import TimeoutExpired
 import threading
+import time
 # source https://stackoverflow.com/questions/4789837/how-to-terminate-a-python-subprocess-launched-with-shell-true
 import psutil
 
+from kafka_slurm_agent.metrics import COMMAND_DURATION, get_command_type
+from kafka_slurm_agent.tracing import TRACER
+
 
 def kill(proc_pid):
     process = psutil.Process(proc_pid)
@@ -30,16 +35,20 @@ class Command(object):
         self.logfile = None
         self.logerrfile = None
 
-    def run(self, timeout, logfile=None):
+    def run(self, timeout, logfile=None, env=None):
         '''Run the command provided in constructor
 
            Parameters
            ==========
            timeout: int - (seconds) - how long to wait before killing the command
            logfile: string - path to file to which to write the std out from running command
+           env: dict - environment variables to set for the command in addition to the current environment
 
            '''
         self.logfile = logfile
+        proc_env = dict(os.environ, **env) if env else None
+        command_type = get_command_type(self.cmd)
+        started = time.perf_counter()
 
         def target():
             try:
@@ -48,10 +57,10 @@ class Command(object):
                     self.logerrfile = logfile + ".err"
                     logerrfile_handle = open(self.logerrfile, 'w+')
                     self.process = subprocess.Popen(self.cmd, shell=True, stdout=logfile_handle,
-                                                    stderr=logerrfile_handle)
+                                                    stderr=logerrfile_handle, env=proc_env)
                 else:
                     self.process = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE,
-                                                    stderr=subprocess.PIPE)
+                                                    stderr=subprocess.PIPE, env=proc_env)
                 self.o, self.e = self.process.communicate(timeout=timeout)
                 if logfile:
                     logfile_handle.flush()
@@ -69,18 +78,27 @@ class Command(object):
 
         thread = threading.Thread(
             target=target)  # thread, not process - to easily comuniacate with PIPE and return rcode.
-        thread.start()
-
-        thread.join(timeout)
-        if thread.is_alive():
-            # self.process.terminate() # is stoping main process not those run from it - then thread.join() is waiting for shell (and other children) to end!
-            # os.killpg(os.getpgid(self.process.pid), signal.SIGKILL) # Send the signal to all the process groups - including this one which is wating for next thread.join()...
-            if self.process and self.process.pid:
-                kill(self.process.pid)  # using psutil, but could be written without it - searching in processes for children.
-            thread.join()
-            raise TimeoutError('Processing binary file has been terminated by timeout. Error? Loop?')
-        if self.process:
-            self.rcode = self.process.returncode
+        # the slow commands (sinfo, squeue, sbatch...) show up in the trace by name
+        with TRACER.span('Command.run', command=command_type or os.path.basename((self.cmd.split(None, 1) or [''])[0])) \
+                as span:
+            thread.start()
+
+            thread.join(timeout)
+            if thread.is_alive():
+                # self.process.terminate() # is stoping main process not those run from it - then thread.join() is waiting for shell (and other children) to end!
+                # os.killpg(os.getpgid(self.process.pid), signal.SIGKILL) # Send the signal to all the process groups - including this one which is wating for next thread.join()...
+                if self.process and self.process.pid:
+                    kill(self.process.pid)  # using psutil, but could be written without it - searching in processes for children.
+                thread.join()
+                if command_type:
+                    COMMAND_DURATION.observe(time.perf_counter() - started, command=command_type)
+                span['timeout'] = True
+                raise TimeoutError('Processing binary file has been terminated by timeout. Error? Loop?')
+            if self.process:
+                self.rcode = self.process.returncode
+            span['rcode'] = self.rcode
+        if command_type:
+            COMMAND_DURATION.observe(time.perf_counter() - started, command=command_type)
 
     def getReturnCode(self):
         return self.rcode
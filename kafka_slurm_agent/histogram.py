@@ -0,0 +1,67 @@
+import math
+
+
+class LatencyHistogram:
+    '''Streaming histogram of latencies in milliseconds with logarithmic buckets
+
+       A value v >= 1 is counted in the bucket i with (1 + precision)^i <= v < (1 + precision)^(i + 1) so that
+       percentiles are within precision (relative) of the exact ones over any range of values, with a few hundred
+       buckets at most. Values below 1 ms share one bucket. Histograms are merged by adding their counts.
+       '''
+
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self.log_base = math.log1p(precision)
+        self.buckets = {}
+        self.count = 0
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def bucket(self, value):
+        return int(math.log(value) / self.log_base) if value >= 1 else -1
+
+    def bucket_value(self, bucket):
+        # geometric middle of the bucket
+        return 0 if bucket < 0 else math.exp((bucket + 0.5) * self.log_base)
+
+    def record(self, value, n=1):
+        value = max(value, 0)
+        bucket = self.bucket(value)
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+        self.count += n
+        self.total += value * n
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        for bucket, n in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + n
+        self.count += other.count
+        self.total += other.total
+        for value in [other.min, other.max]:
+            if value is not None:
+                self.min = value if self.min is None else min(self.min, value)
+                self.max = value if self.max is None else max(self.max, value)
+        return self
+
+    def percentile(self, q):
+        if not self.count:
+            return None
+        rank = max(1, math.ceil(q / 100 * self.count))
+        if rank >= self.count:
+            return self.max
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(max(self.bucket_value(bucket), self.min), self.max)
+        return self.max
+
+    def summary(self, percentiles=(50, 95, 99)):
+        res = {'count': self.count, 'min': self.min, 'max': self.max,
+               'mean': round(self.total / self.count) if self.count else None}
+        for q in percentiles:
+            value = self.percentile(q)
+            res['p{}'.format(q)] = round(value) if value is not None else None
+        return res
@@ -0,0 +1,175 @@
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import uuid
+
+
+MAGIC = b'KSAJOBS1\n'
+TRAILER = struct.Struct('<Q')
+REF_SEPARATOR = '#'
+BATCH_SUFFIX = '.jobs'
+
+
+class JobConfigStore:
+    '''Job configurations packed into one file per submission batch
+
+       A batch file holds the JSON configs one after another followed by a JSON index of
+       [input_job_id, offset, length] entries and the 8 byte offset of that index:
+
+           KSAJOBS1\\n | config 1 | config 2 | ... | index | index offset
+
+       write_batch returns a reference per job (path#offset,length) so a runner reads its own config
+       with a single seek. Files are spread over root/xx/yy/ directories by their random batch id.
+       A batch file is deleted once all its jobs were released (reached a terminal status).
+       '''
+
+    def __init__(self, root, shard_levels=2):
+        self.root = root
+        self.shard_levels = shard_levels
+        self.lock = threading.Lock()
+        self.batches = {}
+        self.live = {}
+
+    def get_batch_path(self, batch_id):
+        shards = [batch_id[2 * i:2 * i + 2] for i in range(self.shard_levels)]
+        return os.path.join(self.root, *shards, batch_id + BATCH_SUFFIX)
+
+    def write_batch(self, job_configs):
+        batch_id = uuid.uuid4().hex
+        path = self.get_batch_path(batch_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        index = []
+        refs = []
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(MAGIC)
+            for job_config in job_configs:
+                data = json.dumps(job_config).encode('utf-8')
+                index.append([job_config.get('input_job_id'), f.tell(), len(data)])
+                refs.append('{}{}{},{}'.format(path, REF_SEPARATOR, f.tell(), len(data)))
+                f.write(data)
+            index_offset = f.tell()
+            f.write(json.dumps(index).encode('utf-8'))
+            f.write(TRAILER.pack(index_offset))
+        # readers never see a partially written batch
+        os.replace(tmp_path, path)
+        stale = []
+        with self.lock:
+            live = self.live[path] = set()
+            for entry in index:
+                if self.batches.get(entry[0]) != path:
+                    # a resubmitted job no longer needs its previous config
+                    stale.append(self.discard(entry[0]))
+                live.add(entry[0])
+                self.batches[entry[0]] = path
+        for stale_path in stale:
+            self.remove_file(stale_path)
+        return path, refs
+
+    def discard(self, input_job_id):
+        path = self.batches.pop(input_job_id, None)
+        if path is None:
+            return None
+        self.live[path].discard(input_job_id)
+        if self.live[path]:
+            return None
+        del self.live[path]
+        return path
+
+    def release(self, input_job_id):
+        with self.lock:
+            path = self.discard(input_job_id)
+        return self.remove_file(path)
+
+    @staticmethod
+    def remove_file(path):
+        if path is None:
+            return False
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        return True
+
+    def cleanup(self, max_age, keep=()):
+        '''Remove batch files older than max_age seconds, e.g. left behind by a restarted agent
+
+           keep: set of input_job_ids still in Slurm (e.g. pending for longer than max_age), a file with
+           the config of any of them is kept and deleted once they are released
+           '''
+        removed = 0
+        now = time.time()
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                with self.lock:
+                    if path in self.live:
+                        continue
+                try:
+                    if now - os.path.getmtime(path) <= max_age:
+                        continue
+                    kept = keep and read_job_ids(path) & set(keep)
+                    if kept:
+                        self.adopt(path, kept)
+                    else:
+                        os.remove(path)
+                        removed += 1
+                except FileNotFoundError:
+                    pass
+        return removed
+
+    def adopt(self, path, input_job_ids):
+        # a file of a previous agent run, tracked like the written ones so release deletes it
+        with self.lock:
+            live = self.live.setdefault(path, set())
+            for input_job_id in input_job_ids:
+                if input_job_id not in self.batches:
+                    live.add(input_job_id)
+                    self.batches[input_job_id] = path
+            if not live:
+                del self.live[path]
+
+
+def read_index(mm):
+    index_offset = TRAILER.unpack(mm[-TRAILER.size:])[0]
+    return json.loads(mm[index_offset:-TRAILER.size])
+
+
+def read_job_ids(path):
+    '''input_job_ids of the configs in a batch file or an old single JSON file, empty if it cannot be read'''
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC)) != MAGIC:
+                f.seek(0)
+                job_config = json.load(f)
+                job_configs = job_config if isinstance(job_config, list) else [job_config]
+                return {c.get('input_job_id') for c in job_configs if isinstance(c, dict)}
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                return {entry[0] for entry in read_index(mm)}
+    except (ValueError, struct.error):
+        # e.g. a .tmp file of an interrupted write
+        return set()
+
+
+def read_job_config(ref, position=None):
+    '''Read a job config from a reference returned by JobConfigStore.write_batch
+
+       A plain path of a batch file returns the config at position (e.g. the Slurm array task id),
+       a path of an old single JSON file returns its content.
+       '''
+    path, sep, location = ref.partition(REF_SEPARATOR)
+    with open(path, 'rb') as f:
+        if sep:
+            offset, length = [int(el) for el in location.split(',')]
+            f.seek(offset)
+            return json.loads(f.read(length))
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            job_config = json.load(f)
+            return job_config[int(position or 0)] if isinstance(job_config, list) else job_config
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            input_job_id, offset, length = read_index(mm)[int(position or 0)]
+            return json.loads(mm[offset:offset + length])
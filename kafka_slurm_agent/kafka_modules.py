@@ -1,39 +1,74 @@
 import ast
+import asyncio
+import bisect
+import importlib.util
 import json
 import logging
 import math
+import multiprocessing
 import os.path
+import shlex
+import shutil
 import socket
 import sys
 import tempfile
 import time
 import traceback
-import urllib
+import urllib.request
 import datetime
 import uuid
-from queue import Queue
-from threading import Thread
+from collections import namedtuple
+from enum import Enum
+from itertools import islice
+from threading import Thread, Condition, Lock, Semaphore
 from urllib.error import URLError
+from urllib.parse import urlsplit
 
-from kafka import KafkaConsumer, KafkaProducer
+from kafka import KafkaAdminClient, KafkaConsumer, KafkaProducer, TopicPartition
 from kafka.coordinator.assignors.range import RangePartitionAssignor
 from kafka.coordinator.assignors.roundrobin import RoundRobinPartitionAssignor
 from kafka.errors import NoBrokersAvailable
+from kafka.structs import OffsetAndMetadata
 from simple_slurm import Slurm
 import getpass
+import http.client
 from os.path import expanduser
+from pydoc import locate
 
+import psutil
 from wrapt_timeout_decorator import timeout
 
-from kafka_slurm_agent.command import Command
+from kafka_slurm_agent.command import Command, kill
 from kafka_slurm_agent.config_module import Config
+from kafka_slurm_agent.blob_store import DirectoryBlobStore
+from kafka_slurm_agent.histogram import LatencyHistogram
+from kafka_slurm_agent.metrics import REGISTRY, COMMAND_DURATION
+from kafka_slurm_agent.tracing import TRACER, PROFILER
+from kafka_slurm_agent.job_store import JobConfigStore, read_job_config
+from kafka_slurm_agent.ledger import SubmissionLedger
+from kafka_slurm_agent.serializers import get_serializer, loads, FAUST_CODEC
+from kafka_slurm_agent.slurm_modules import SlurmQueueSnapshot, SlurmNodeSnapshot, expand_hostlist, parse_mem
 
 CONFIG_FILE = 'kafkaslurm_cfg.py'
+ARRAY_INPUT_ID = 'ARRAY'
+PILOT_INPUT_ID = 'PILOT'
+# set on the message of a job sent back by a pilot, such jobs are not passed to the pilots again
+PILOT_REJECTED = 'pilot_rejected'
+ACTIVE_STATUSES = ['SUBMITTED', 'WAITING', 'RUNNING', 'UPLOADING']
+TERMINAL_STATUSES = ['DONE', 'ERROR', 'TIMEOUT']
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+CYCLE_DURATION = REGISTRY.histogram('ksa_cycle_duration_seconds', 'Duration of the check cycles of the agent')
+POLL_SIZE_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+# table serializers whose output loads reads
+RAW_TABLE_CODECS = ['json', FAUST_CODEC]
 
 config_defaults = {
     'CLUSTER_NAME': 'my_cluster',
     'CLUSTER_JOB_NAME_SUFFIX': '_KSA',
     'POLL_INTERVAL': 30.0,
+    'POLL_INTERVAL_MIN': 1.0,
+    'POLL_INTERVAL_MAX': 120.0,  # keep below max_poll_interval_ms of the NEW topic consumer
+    'POLL_BACKOFF': 2.0,
     'BOOTSTRAP_SERVERS': 'localhost:9092',
     'MONITOR_AGENT_URL': 'http://localhost:6066/',
     'WORKER_AGENT_URL': 'http://localhost:6068/',
@@ -44,8 +79,14 @@ config_defaults = {
     'KAFKA_SASL_MECHANISM': None,
     'KAFKA_USERNAME': None,
     'KAFKA_PASSWORD': None,
-    'WORKER_AGENT_MAX_WORKERS': 2,
+    'WORKER_AGENT_MAX_WORKERS': None,  # = one runner per CPU core of the worker
     'WORKER_JOB_TIMEOUT': 86400,  # = 24h
+    'WORKER_AGENT_EXECUTOR': 'subprocess',
+    'WORKER_COMPUTING_CLASSES': {},
+    'WORKER_AGENT_CPUS': None,
+    'WORKER_AGENT_GPUS': None,
+    'WORKER_AGENT_MEM': None,
+    'WORKER_AGENT_PIN_CPUS': True,
     'HEARTBEAT_INTERVAL': 0.0,
     'KAFKA_CONSUMER_HEARTBEAT_INTERVAL_MS': 2000,
     'KAFKA_BROKER_MAX_POLL_RECORDS': 20,
@@ -56,8 +97,43 @@ config_defaults = {
     'MONITOR_ONLY_DO_NOT_SUBMIT': False,
     'KAFKA_PARTITION_ASSIGNMENT_STRATEGY': [RoundRobinPartitionAssignor, RangePartitionAssignor],
     'DELAY_BETWEEN_SUBMIT_MS': 0,
+    'KAFKA_SERIALIZER': 'json',
+    'KAFKA_PRODUCER_COMPRESSION_TYPE': None,
+    'KAFKA_PRODUCER_LINGER_MS': 0,
+    'KAFKA_PRODUCER_BATCH_SIZE': 16384,
+    'KAFKA_PRODUCER_ACKS': 1,
+    'RESULTS_OFFLOAD_THRESHOLD': 512 * 1024,
+    'MONITOR_CHECK_CHUNK_SIZE': 1000,
+    'MONITOR_STATS_PAGE_SIZE': 10000,
+    'MONITOR_STATS_CHUNK_SIZE': 1000,
+    'STATUS_ARCHIVE_AGE': None,
+    'TABLE_STORE': 'memory://',
+    'STATUS_ARCHIVE_INTERVAL': 600,
+    'CONSUMER_LAG_TTL': 5.0,
+    'TRACE_FORMAT': None,
+    'TRACE_MIN_DURATION': 0,
+    'PROFILE_SECONDS': 30,
+    'PROFILE_MAX_SECONDS': 600,
+    'SUBMITTER_MAX_IN_FLIGHT': 10000,
+    'SUBMITTER_MAX_ERRORS': 1000,
+    'SUBMITTER_LEDGER': None,
+    'SUBMITTER_LEDGER_SYNC_INTERVAL': 10.0,
+    'JOB_CONFIG_MAX_AGE': 7 * 86400,  # = 7 days
+    'JOB_CONFIG_CLEANUP_INTERVAL': 3600,
+    'STATUS_RELAY_SOCKET': os.path.join(tempfile.gettempdir(), 'kafka_slurm_relay_{}.sock'.format(getpass.getuser())),
+    'STATUS_RELAY_COMPRESSION': 'gzip',
+    'STATUS_RELAY_LINGER_MS': 100,
+    'STATUS_RELAY_BATCH_SIZE': 256 * 1024,
     'SLURM_JOB_TYPE': 'cpu',
     'SLURM_RESOURCES_REQUIRED': 1,
+    'SLURM_QUEUE_SNAPSHOT_TTL': 5.0,
+    'SLURM_NODE_SNAPSHOT_TTL': 5.0,
+    'SLURM_ARRAY_SUBMIT': False,
+    'SLURM_ARRAY_MAX_SIZE': 1000,
+    'SLURM_PILOT_JOBS': 0,
+    'PILOT_WALL_TIME': 3600,
+    'PILOT_IDLE_POLLS': 3,
+    'TOPIC_PILOT': None,
 }
 
 
@@ -83,8 +159,30 @@ class ConfigLoader:
             sys.exit(-1)
         config_defaults['PREFIX'] = rootpath
         config_defaults['SHARED_TMP'] = os.path.join(rootpath, 'tmp')
+        config_defaults['RESULTS_BLOB_DIR'] = os.path.join(rootpath, 'blobs')
+        config_defaults['STATUS_ARCHIVE_PATH'] = os.path.join(rootpath, 'status_archive.db')
+        # faust replaces {conf.name} with the name of the agent
+        config_defaults['TABLE_DATA_DIR'] = os.path.join(rootpath, '{conf.name}-data')
         self.config = Config(root_path=rootpath, defaults=config_defaults)
         self.config.from_pyfile(CONFIG_FILE)
+        check_config(self.config)
+
+
+def check_config(cfg):
+    '''Raise ValueError for settings the agents cannot start with'''
+    if cfg['WORKER_AGENT_EXECUTOR'] not in ['subprocess', 'forkserver']:
+        raise ValueError('Unknown WORKER_AGENT_EXECUTOR {}, use subprocess or forkserver'.format(
+            cfg['WORKER_AGENT_EXECUTOR']))
+    if cfg['WORKER_AGENT_EXECUTOR'] == 'forkserver':
+        classes = cfg['WORKER_COMPUTING_CLASSES']
+        if not classes or not isinstance(classes, dict):
+            raise ValueError('WORKER_AGENT_EXECUTOR = forkserver needs WORKER_COMPUTING_CLASSES, a dict of the scripts '
+                             'run by the jobs and their ClusterComputing classes, i.e. {"run.py": "run.MyComputing"}')
+        for script, class_path in classes.items():
+            if not isinstance(class_path, str) or len(class_path.rsplit('.', 1)) != 2 or not all(
+                    class_path.rsplit('.', 1)):
+                raise ValueError('WORKER_COMPUTING_CLASSES: computing class of {} must be module.ClassName, not {}'.format(
+                    script, class_path))
 
 config = ConfigLoader().get()
 
@@ -94,6 +192,8 @@ def setupLogger(directory, name, file_name=None):
         file_name = name + '.log'
     os.makedirs(directory, exist_ok=True)
     logger = logging.getLogger(name)
+    if logger.handlers:
+        return logger
     hlogger = logging.FileHandler(os.path.join(directory, file_name))
     formatter = logging.Formatter('%(asctime)s %(name)s || %(levelname)s %(message)s')
     hlogger.setFormatter(formatter)
@@ -102,6 +202,30 @@ def setupLogger(directory, name, file_name=None):
     return logger
 
 
+def setup_tracing(name):
+    # spans of the agent go to <name>_trace.jsonl (TRACE_FORMAT = 'json') or <name>_trace.json ('chrome') in LOGS_DIR
+    if config['TRACE_FORMAT'] and not TRACER.enabled:
+        ext = 'jsonl' if config['TRACE_FORMAT'] == 'json' else 'json'
+        TRACER.open(os.path.join(config['LOGS_DIR'], '{}_trace.{}'.format(name, ext)), config['TRACE_FORMAT'],
+                    config['TRACE_MIN_DURATION'])
+
+
+def start_profiler(name, seconds=None):
+    '''Profile the agent for seconds (PROFILE_SECONDS by default) into LOGS_DIR, returns (result, HTTP status)'''
+    try:
+        seconds = float(seconds) if seconds else config['PROFILE_SECONDS']
+    except ValueError:
+        return {'error': 'seconds must be a number'}, 400
+    if not 0 < seconds <= config['PROFILE_MAX_SECONDS']:
+        return {'error': 'seconds must be in (0, {}]'.format(config['PROFILE_MAX_SECONDS'])}, 400
+    path = os.path.join(config['LOGS_DIR'], '{}_profile_{}.txt'.format(name, datetime.datetime.now().strftime(
+        '%Y%m%d_%H%M%S')))
+    if not PROFILER.start(seconds, path):
+        return {'error': 'A profile is already running', 'path': PROFILER.path,
+                'until': datetime.datetime.fromtimestamp(PROFILER.until).strftime(TIMESTAMP_FORMAT)}, 409
+    return {'path': path, 'seconds': seconds}, 200
+
+
 class ClusterComputing:
     def __init__(self, input_args):
         self.input_job_id = input_args[1]
@@ -113,13 +237,16 @@ class ClusterComputing:
         if len(input_args) > 2:
             cfg_file = input_args[2].split('cfg_file=')[1]
             if cfg_file:
-                with open(cfg_file) as json_file:
-                    self.job_config = json.load(json_file)
+                # Slurm job array - each task picks its own job from the batch by index
+                self.job_config = read_job_config(cfg_file, os.getenv('SLURM_ARRAY_TASK_ID'))
+                self.input_job_id = self.job_config['input_job_id']
             else:
                 self.job_config = config_defaults
 
         if len(input_args) > 3:
             self.slurm_job_id = input_args[3].split('job_id=')[1]
+        elif os.getenv('SLURM_ARRAY_JOB_ID'):
+            self.slurm_job_id = '{}_{}'.format(os.getenv('SLURM_ARRAY_JOB_ID'), os.getenv('SLURM_ARRAY_TASK_ID'))
         else:
             self.slurm_job_id = os.getenv('SLURM_JOB_ID', -1)
         self.ss = StatusSender()
@@ -127,6 +254,12 @@ class ClusterComputing:
         self.logger = setupLogger(config['LOGS_DIR'], "clustercomputing_{}".format(socket.gethostname()))
         self.results = {'job_id': self.slurm_job_id, 'node': socket.gethostname(), 'cluster': config['CLUSTER_NAME']}
 
+    def load_job(self, job_config):
+        # Used by PilotRunner to switch to the next input job, override it if your class keeps per-job state
+        self.job_config = job_config
+        self.input_job_id = job_config['input_job_id']
+        self.results = {'job_id': self.slurm_job_id, 'node': socket.gethostname(), 'cluster': config['CLUSTER_NAME']}
+
     def do_compute(self):
         pass
 
@@ -167,9 +300,602 @@ class ClusterComputing:
             self.ss.producer.flush()
 
 
+class PilotRunner:
+    '''Run many input jobs one after another inside a single Slurm allocation
+
+       The pilot pulls jobs from the pilot topic, where the cluster agent puts the jobs of PILOT_SCRIPT, and calls
+       do_compute for each of them in the same process, so the interpreter, imports and the Kafka producer are set
+       up only once. Jobs of other scripts are sent back to the NEW topic marked so that an agent submits them as
+       usual. It stops after PILOT_WALL_TIME seconds or when PILOT_IDLE_POLLS polls in a row run no job.
+
+       computing: ClusterComputing - instance of your class created with the PILOT argument
+       script: string - only jobs submitted for this script are run by the pilot (defaults to the running script)
+       '''
+
+    def __init__(self, computing, script=None):
+        self.computing = computing
+        self.script = os.path.basename(script or sys.argv[0])
+        self.consumer = new_jobs_consumer(get_pilot_topic(), get_pilot_group(), max_poll_records=1)
+        self.started = time.monotonic()
+        self.processed = 0
+
+    def has_time_left(self):
+        return time.monotonic() - self.started < config['PILOT_WALL_TIME']
+
+    def run(self):
+        idle = 0
+        while self.has_time_left() and idle < config['PILOT_IDLE_POLLS']:
+            new_jobs = self.consumer.poll(max_records=1, timeout_ms=2000)
+            ran = [self.run_job(el.value) for els in new_jobs.values() for el in els]
+            idle = 0 if any(ran) else idle + 1
+        self.computing.logger.info('Pilot {} finished after {} jobs'.format(self.computing.slurm_job_id, self.processed))
+        self.consumer.close()
+        self.computing.ss.producer.flush()
+
+    def run_job(self, msg):
+        '''Run the job, returns False if it is not a job of this pilot'''
+        ss = self.computing.ss
+        if os.path.basename(msg['script'] or '') != self.script:
+            # Not a job for this pilot - the agents submit it as a separate slurm job
+            msg[PILOT_REJECTED] = True
+            ss.produce(config['TOPIC_NEW'], key=msg['input_job_id'].encode('utf-8'), value=msg)
+            ss.producer.flush()
+            self.consumer.commit()
+            return False
+        msg['ExecutorType'] = 'PILOT'
+        ss.send(msg['input_job_id'], 'SUBMITTED', job_id=self.computing.slurm_job_id, node=socket.gethostname())
+        self.consumer.commit()
+        self.computing.load_job(msg)
+        self.computing.compute()
+        self.processed += 1
+        return True
+
+
+class Status(str, Enum):
+    NEW = 'NEW'
+    SUBMITTED = 'SUBMITTED'
+    WAITING = 'WAITING'
+    RUNNING = 'RUNNING'
+    UPLOADING = 'UPLOADING'
+    DONE = 'DONE'
+    ERROR = 'ERROR'
+    TIMEOUT = 'TIMEOUT'
+
+
+def now_ms():
+    return int(time.time() * 1000)
+
+
+class JobStatus:
+    '''Status of a job as sent on TOPIC_STATUS and kept in the agents' job_status tables
+
+       The timestamp is in epoch milliseconds. Item access (js['status'], 'node' in js) works as for the
+       dicts used before, and from_value decodes both the current and the old message format.
+       '''
+    __slots__ = ('status', 'cluster', 'timestamp', 'job_id', 'node', 'error', 'message')
+    FIELDS = __slots__
+    # always in to_dict, the other fields only when they are set
+    REQUIRED_FIELDS = ('status', 'cluster', 'timestamp')
+
+    def __init__(self, status, cluster=None, timestamp=None, job_id=None, node=None, error=None, message=None):
+        try:
+            self.status = Status(status)
+        except ValueError:
+            # custom statuses sent by user code are kept as they are
+            self.status = status
+        self.cluster = cluster
+        self.timestamp = timestamp if timestamp is not None else now_ms()
+        self.job_id = job_id
+        self.node = node
+        self.error = error
+        self.message = message
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        if isinstance(timestamp, str):
+            return int(datetime.datetime.strptime(timestamp, TIMESTAMP_FORMAT).timestamp() * 1000)
+        return timestamp
+
+    @classmethod
+    def from_value(cls, value):
+        if value is None or value == '' or isinstance(value, JobStatus):
+            return value or None
+        if isinstance(value, bytes):
+            value = value.decode('utf-8')
+        if isinstance(value, str):
+            value = json.loads(value) if value.startswith('{"') else ast.literal_eval(value)
+        return cls(value['status'], value.get('cluster'), cls.parse_timestamp(value.get('timestamp')),
+                   value.get('job_id'), value.get('node'), value.get('error'), value.get('message'))
+
+    @property
+    def status_name(self):
+        return self.status.value if isinstance(self.status, Status) else self.status
+
+    def to_dict(self):
+        val = {'status': self.status_name,
+               'cluster': self.cluster, 'timestamp': self.timestamp}
+        for field in ('job_id', 'node', 'error', 'message'):
+            if getattr(self, field) is not None:
+                val[field] = getattr(self, field)
+        return val
+
+    def __json__(self):
+        return self.to_dict()
+
+    def __getitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self.REQUIRED_FIELDS or (key in self.FIELDS and getattr(self, key) is not None)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def __eq__(self, other):
+        return isinstance(other, JobStatus) and all(getattr(self, f) == getattr(other, f) for f in self.FIELDS)
+
+    def __repr__(self):
+        return 'JobStatus({})'.format(self.to_dict())
+
+
+class CycleScheduler:
+    '''Runs the agent's check cycle in an executor, one cycle at a time
+
+       The cycle runs every interval seconds, right after trigger() is called (but no more often than every
+       min_interval seconds) and less and less often, up to max_interval, while func returns True (idle).
+       Triggers arriving during a cycle are merged into a single following cycle.
+       '''
+
+    def __init__(self, func, interval, min_interval=1.0, max_interval=None, backoff=2.0, executor=None, logger=None):
+        self.func = func
+        self.interval = interval
+        self.min_interval = min(min_interval, interval)
+        self.max_interval = max(max_interval or interval, interval)
+        self.backoff = backoff
+        self.executor = executor
+        self.logger = logger
+        self.current_interval = interval
+        self.wakeup = None
+
+    def trigger(self):
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    def next_interval(self, idle):
+        if idle:
+            self.current_interval = min(self.current_interval * self.backoff, self.max_interval)
+        else:
+            self.current_interval = self.interval
+        return self.current_interval
+
+    async def run(self, loop):
+        self.wakeup = asyncio.Event()
+        # like a timer the first cycle runs after one interval, when the tables have been recovered
+        wait = self.interval
+        started = loop.time()
+        while True:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+            delay = self.min_interval - (loop.time() - started)
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.wakeup.clear()
+            started = loop.time()
+            try:
+                idle = await loop.run_in_executor(self.executor, self.func)
+            except Exception as e:
+                idle = False
+                if self.logger:
+                    self.logger.exception('Check cycle failed: {}'.format(e))
+            CYCLE_DURATION.observe(loop.time() - started)
+            wait = self.next_interval(idle)
+
+
+def get_cycle_scheduler(func, executor=None, logger=None):
+    return CycleScheduler(func, config['POLL_INTERVAL'], config['POLL_INTERVAL_MIN'], config['POLL_INTERVAL_MAX'],
+                          config['POLL_BACKOFF'], executor=executor, logger=logger)
+
+
+def iter_table_items(table):
+    '''Decoded (key, value) pairs of a faust table or a dict
+
+       Tables kept in RocksDB (TABLE_STORE) are read raw and decoded with loads, several times faster than
+       through the table's serializers when the whole table is scanned, e.g. to rebuild an index after a restart.
+       '''
+    store = getattr(table, 'data', None)
+    if hasattr(store, '_iteritems') and getattr(table, 'key_serializer', None) in RAW_TABLE_CODECS \
+            and getattr(table, 'value_serializer', None) in RAW_TABLE_CODECS:
+        for key, value in store._iteritems():
+            yield loads(key), loads(value)
+    else:
+        # the in-memory store of a faust table is a dict of the decoded values
+        yield from list((store if store is not None else table).items())
+
+
+async def expire_statuses(table, max_age, chunk_size=1000):
+    '''Delete the statuses of jobs that finished more than max_age seconds ago from a job_status table
+
+       The cluster and worker agents only need the unfinished jobs, the monitor archives the old ones instead
+       (see StatusArchive). Returns the number of deleted statuses.
+       '''
+    before = now_ms() - max_age * 1000
+    keys = list(table.keys())
+    deleted = 0
+    for i in range(0, len(keys), chunk_size):
+        for key in keys[i:i + chunk_size]:
+            js = JobStatus.from_value(table[key]) if key in table else None
+            if js is not None and js.status_name in TERMINAL_STATUSES and js.timestamp is not None \
+                    and js.timestamp < before:
+                del table[key]
+                deleted += 1
+        await asyncio.sleep(0)
+    return deleted
+
+
+class ActiveJobIndex:
+    '''Unfinished jobs of this agent kept up to date from the status events
+
+       The agents reconcile only these jobs instead of walking the whole status table on every poll.
+       rebuild runs in the agent's thread while update is called from the event loop, the updates made during
+       a rebuild are applied again to the rebuilt index so that none of them is lost.
+
+       match: callable - gets a status and tells if the job belongs to this cluster or node
+       '''
+
+    def __init__(self, match):
+        self.match = match
+        self.jobs = {}
+        self.ready = False
+        self.lock = Lock()
+        # updates made while the index is rebuilt, None when it is not
+        self.updates = None
+
+    def is_active(self, value):
+        return value is not None and value.status in ACTIVE_STATUSES and self.match(value)
+
+    def apply(self, jobs, key, value):
+        if self.is_active(value):
+            jobs[key] = value
+        else:
+            jobs.pop(key, None)
+
+    def update(self, key, value):
+        value = JobStatus.from_value(value)
+        with self.lock:
+            if self.updates is not None:
+                self.updates.append((key, value))
+            self.apply(self.jobs, key, value)
+
+    def rebuild(self, table):
+        # Once after a (re)start, the table may already hold jobs restored from its changelog
+        with self.lock:
+            self.updates = []
+        jobs = {}
+        try:
+            for key, value in iter_table_items(table):
+                value = JobStatus.from_value(value)
+                if self.is_active(value):
+                    jobs[key] = value
+        except Exception:
+            with self.lock:
+                self.updates = None
+            raise
+        with self.lock:
+            # the scan may have read the table before or after these updates, they are the latest statuses
+            for key, value in self.updates:
+                self.apply(jobs, key, value)
+            self.jobs = jobs
+            self.updates = None
+            self.ready = True
+
+    def get(self, key):
+        return self.jobs.get(key)
+
+    def items(self):
+        with self.lock:
+            return list(self.jobs.items())
+
+    def __contains__(self, key):
+        return key in self.jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+
+class RelayProducer:
+    '''Sends messages to the node-local status relay (kafka_slurm_agent.status_relay) instead of Kafka
+
+       Has the send/flush/close methods of KafkaProducer used by the senders. flush returns once the relay has
+       delivered all messages to Kafka. If the relay goes away a direct producer created by fallback is used
+       and the messages sent since the last confirmed flush are sent again through it, so none is lost but
+       those the relay delivered before it went away reach Kafka twice.
+       '''
+
+    def __init__(self, path, fallback):
+        self.fallback = fallback
+        self.producer = None
+        self.lock = Lock()
+        # frames written since the last flush confirmed by the relay
+        self.unconfirmed = []
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path)
+        self.reader = self.sock.makefile('rb')
+
+    def write(self, frame, headers=None):
+        with self.lock:
+            self.sock.sendall(json.dumps(frame).encode('utf-8') + b'\n')
+            self.unconfirmed.append((frame, headers))
+
+    def switch_to_kafka(self, e):
+        logging.getLogger(__name__).warning('Status relay unavailable ({}), connecting to Kafka directly'.format(e))
+        self.close()
+        self.producer = self.fallback()
+        with self.lock:
+            frames, self.unconfirmed = self.unconfirmed, []
+        for frame, headers in frames:
+            key = frame['key'].encode('utf-8') if frame['key'] is not None else None
+            self.producer.send(frame['topic'], key=key, value=frame['value'], headers=headers)
+
+    def send(self, topic, key=None, value=None, headers=None):
+        if self.producer is None:
+            try:
+                self.write({'topic': topic, 'key': key.decode('utf-8') if key is not None else None, 'value': value},
+                           headers)
+                return None
+            except OSError as e:
+                self.switch_to_kafka(e)
+        return self.producer.send(topic, key=key, value=value, headers=headers)
+
+    def flush(self, timeout=None):
+        if self.producer is None:
+            try:
+                with self.lock:
+                    self.sock.sendall(json.dumps({'flush': True}).encode('utf-8') + b'\n')
+                    if self.reader.readline().strip() == b'ok':
+                        self.unconfirmed = []
+                        return
+                raise OSError('no flush confirmation')
+            except OSError as e:
+                self.switch_to_kafka(e)
+        self.producer.flush(timeout=timeout)
+
+    def close(self, timeout=None):
+        if self.producer is not None:
+            self.producer.close(timeout=timeout)
+        try:
+            self.reader.close()
+            self.sock.close()
+        except OSError:
+            pass
+
+
+def connect_relay(fallback):
+    path = config['STATUS_RELAY_SOCKET']
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        return RelayProducer(path, fallback)
+    except OSError:
+        return None
+
+
+class SortedKeyIndex:
+    '''Keys of a table in sorted order, so that a page after a cursor is found by bisection
+
+       add and discard are O(1), the order is restored on the next read: new keys are merged into the sorted
+       list (Timsort merges the two sorted runs in linear time), removed keys - rare, the monitor archives them
+       in batches - rebuild it. New keys are also merged once there are more than an eighth of the sorted ones
+       (at least MERGE_MIN), so they do not pile up when nobody reads the index. Read returns a new list each
+       time it changed, a page being read keeps its own.
+       '''
+    MERGE_MIN = 1000
+
+    def __init__(self):
+        self.keys = []
+        self.members = set()
+        self.added = []
+        self.removed = False
+        self.ready = False
+
+    def rebuild(self, keys):
+        self.keys = sorted(keys)
+        self.members = set(self.keys)
+        self.added = []
+        self.removed = False
+        self.ready = True
+
+    def add(self, key):
+        if key not in self.members:
+            self.members.add(key)
+            self.added.append(key)
+            if len(self.added) > max(len(self.keys) // 8, self.MERGE_MIN):
+                self.read()
+
+    def discard(self, key):
+        if key in self.members:
+            self.members.discard(key)
+            self.removed = True
+
+    def read(self):
+        if self.removed:
+            self.keys = sorted(self.members)
+        elif self.added:
+            self.added.sort()
+            self.keys = sorted(self.keys + self.added)
+        self.added = []
+        self.removed = False
+        return self.keys
+
+    def after(self, cursor):
+        '''Return the sorted keys and the position of the first key after the cursor'''
+        keys = self.read()
+        return keys, bisect.bisect_right(keys, cursor) if cursor is not None else 0
+
+
+class StatusCounters:
+    '''Number of jobs per status, per cluster and per node, changed on every status update of a job
+
+       update needs the previous value of the job so that the counters never have to scan the table
+       (rebuild does it once, when the table has been recovered).
+       '''
+    SUM_STATUSES = {'SUBMITTED': 'submitted', 'WAITING': 'waiting', 'DONE': 'done', 'TIMEOUT': 'timeout',
+                    'ERROR': 'error'}
+
+    def __init__(self):
+        self.statuses = {}
+        self.clusters = {}
+        self.nodes = {}
+        self.ready = False
+
+    @staticmethod
+    def count(counters, status, n):
+        counters[status] = counters.get(status, 0) + n
+        if not counters[status]:
+            del counters[status]
+
+    def add(self, js, n):
+        if js is None:
+            return
+        status = js.status_name
+        self.count(self.statuses, status, n)
+        self.count(self.clusters.setdefault(js.cluster, {}), status, n)
+        if not self.clusters[js.cluster]:
+            del self.clusters[js.cluster]
+        # waiting jobs have the Slurm pending reason, e.g. (Resources), instead of a node
+        if js.node and not str(js.node).startswith('('):
+            self.count(self.nodes.setdefault(js.node, {}), status, n)
+            if not self.nodes[js.node]:
+                del self.nodes[js.node]
+
+    def update(self, old_value, new_value):
+        if self.ready:
+            self.add(JobStatus.from_value(old_value), -1)
+            self.add(JobStatus.from_value(new_value), 1)
+
+    def rebuild(self, table, archived=None):
+        '''Count the jobs in the table and the (status, cluster, node, number of jobs) rows of archived jobs'''
+        self.statuses, self.clusters, self.nodes = {}, {}, {}
+        groups = {}
+        for key, value in iter_table_items(table):
+            if isinstance(value, dict):
+                # values read from a persistent store, skips building a JobStatus for every job
+                group = (value.get('status'), value.get('cluster'), value.get('node'))
+            else:
+                js = JobStatus.from_value(value)
+                if js is None:
+                    continue
+                group = (js.status_name, js.cluster, js.node)
+            groups[group] = groups.get(group, 0) + 1
+        for status, cluster, node, n in list(archived or []) + [group + (n,) for group, n in groups.items()]:
+            self.add(JobStatus(status, cluster, node=node), n)
+        self.ready = True
+
+    def summary(self):
+        # the jobs part of the monitor's sum/ page, statuses other than the listed ones count as running
+        jobs = {name: 0 for name in ['submitted', 'waiting', 'running', 'done', 'timeout', 'error']}
+        for status, n in self.statuses.items():
+            jobs[self.SUM_STATUSES.get(status, 'running')] += n
+        return jobs
+
+
+class LatencyTracker:
+    '''Lifecycle timestamps of the jobs and per cluster histograms of the time spent in each phase
+
+       The lifecycle of a job is a dict of the epoch ms at which it first reached NEW (its message on TOPIC_NEW),
+       SUBMITTED, WAITING, RUNNING, UPLOADING and a terminal status, plus its cluster and the phases recorded so
+       far. A phase is recorded in the histograms of the cluster once its start and end are both known, in
+       whatever order the statuses arrive. A new NEW message (a resubmitted job) starts a new lifecycle.
+       '''
+    END = 'END'
+    # name, statuses that start the phase, statuses that end it - the first one reached counts
+    PHASES = [('queue', ['NEW'], ['SUBMITTED', 'WAITING', 'RUNNING']),
+              ('slurm_wait', ['SUBMITTED', 'WAITING'], ['RUNNING']),
+              ('run', ['RUNNING'], ['UPLOADING', END]),
+              ('upload', ['UPLOADING'], [END]),
+              ('total', ['NEW'], [END])]
+    TRACKED = ['NEW', 'SUBMITTED', 'WAITING', 'RUNNING', 'UPLOADING'] + TERMINAL_STATUSES
+
+    def __init__(self, precision=0.01):
+        self.precision = precision
+        self.histograms = {}
+        self.ready = False
+
+    @classmethod
+    def stamp(cls, lifecycle, statuses):
+        for status in statuses:
+            for name in (TERMINAL_STATUSES if status == cls.END else [status]):
+                if name in lifecycle:
+                    return lifecycle[name]
+        return None
+
+    def record(self, cluster, phase, duration):
+        histograms = self.histograms.setdefault(cluster, {})
+        if phase not in histograms:
+            histograms[phase] = LatencyHistogram(self.precision)
+        histograms[phase].record(duration)
+
+    def update(self, lifecycle, status, timestamp, cluster=None):
+        '''Return the lifecycle with the new status recorded or None if it does not change'''
+        status = getattr(status, 'value', status)
+        if status not in self.TRACKED or timestamp is None:
+            return None
+        if status == 'NEW':
+            if lifecycle and 'NEW' in lifecycle and lifecycle['NEW'] != timestamp:
+                lifecycle = None
+        elif lifecycle and (status in lifecycle or self.stamp(lifecycle, [self.END]) is not None):
+            # only the first time a status is reached counts, nothing after the job finished
+            return None
+        lifecycle = dict(lifecycle or {'phases': []}, **{status: timestamp})
+        if cluster is not None:
+            lifecycle['cluster'] = cluster
+        lifecycle['phases'] = list(lifecycle['phases'])
+        for phase, starts, ends in self.PHASES:
+            start, end = self.stamp(lifecycle, starts), self.stamp(lifecycle, ends)
+            if phase not in lifecycle['phases'] and start is not None and end is not None:
+                lifecycle['phases'].append(phase)
+                self.record(lifecycle.get('cluster'), phase, end - start)
+        return lifecycle
+
+    def rebuild(self, table):
+        '''Record the phases of all the lifecycles in the table again, e.g. after a restart'''
+        self.histograms = {}
+        phases = {phase: (starts, ends) for phase, starts, ends in self.PHASES}
+        for key, lifecycle in iter_table_items(table):
+            if not lifecycle:
+                continue
+            for phase in lifecycle.get('phases', []):
+                starts, ends = phases[phase]
+                self.record(lifecycle.get('cluster'), phase, self.stamp(lifecycle, ends) - self.stamp(lifecycle, starts))
+        self.ready = True
+
+    def summary(self, cluster=None, percentiles=(50, 95, 99)):
+        '''Percentiles of each phase per cluster and of all clusters together'''
+        clusters = {}
+        merged = {}
+        for name, histograms in self.histograms.items():
+            if cluster is not None and name != cluster:
+                continue
+            clusters[name] = {phase: hist.summary(percentiles) for phase, hist in histograms.items()}
+            for phase, hist in histograms.items():
+                merged.setdefault(phase, LatencyHistogram(self.precision)).merge(hist)
+        return {'clusters': clusters, 'all': {phase: hist.summary(percentiles) for phase, hist in merged.items()}}
+
+
+class Serialized(bytes):
+    '''A message value serialized already (i.e. to check its size), the producers send it as it is'''
+
+
 class KafkaSender:
     def __init__(self, producer=None):
         self.producer = None
+        # records sent and not acknowledged by Kafka yet
+        self.pending = 0
+        self.pending_lock = Lock()
+        self.serializer = get_serializer(config['KAFKA_SERIALIZER'])
         if not producer:
             try:
                 self.producer = self.init_producer()
@@ -180,77 +906,360 @@ class KafkaSender:
             self.producer = producer
 
     def init_producer(self):
+        # Jobs on a node with a running status relay share its producer
+        return connect_relay(self.init_kafka_producer) or self.init_kafka_producer()
+
+    @staticmethod
+    def get_producer_profile():
+        return {'compression_type': config['KAFKA_PRODUCER_COMPRESSION_TYPE'],
+                'linger_ms': config['KAFKA_PRODUCER_LINGER_MS'],
+                'batch_size': config['KAFKA_PRODUCER_BATCH_SIZE'],
+                'acks': config['KAFKA_PRODUCER_ACKS']}
+
+    def init_kafka_producer(self, **kwargs):
+        profile = self.get_producer_profile()
+        profile.update(kwargs)
         return KafkaProducer(bootstrap_servers=config['BOOTSTRAP_SERVERS'],
                                       client_id='{}_{}'.format(config['CLUSTER_NAME'], self.__class__.__name__.lower()),
                                       security_protocol=config['KAFKA_SECURITY_PROTOCOL'],
                                       sasl_mechanism=config['KAFKA_SASL_MECHANISM'],
                                       sasl_plain_username=config['KAFKA_USERNAME'],
                                       sasl_plain_password=config['KAFKA_PASSWORD'],
-                                      value_serializer=lambda v: json.dumps(v).encode('utf-8'),
-                                      request_timeout_ms=config['REQUEST_TIMEOUT_MS'])
+                                      value_serializer=self.dumps,
+                                      request_timeout_ms=config['REQUEST_TIMEOUT_MS'],
+                                      **profile)
                                       #transaction_timeout_ms=config['KAFKA_TRANSACTION_TIMEOUT_MS'])
 
+    def dumps(self, value):
+        return value if isinstance(value, Serialized) else self.serializer.dumps(value)
+
+    def produce(self, topic, key, value):
+        future = self.producer.send(topic, key=key, value=value)
+        if future is not None:
+            # a status relay producer returns no future, it confirms its messages on flush only
+            with self.pending_lock:
+                self.pending += 1
+            future.add_both(self.acknowledged)
+        return future
+
+    def acknowledged(self, result):
+        # called from the producer's thread on delivery or failure
+        with self.pending_lock:
+            self.pending -= 1
+
+    def in_flight(self):
+        return self.pending
+
 
 class StatusSender(KafkaSender):
     def send(self, jobid, status, job_id=None, node=None, error=None, custom_msg=None):
-        val = {'status': status, 'cluster': config['CLUSTER_NAME'], 'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
-        if job_id:
-            val['job_id'] = job_id
-        if node:
-            val['node'] = node
-        if error:
-            val['error'] = error
-        if custom_msg:
-            val['message'] = custom_msg
-        self.producer.send(config['TOPIC_STATUS'], key=jobid.encode('utf-8'), value=val)
+        val = JobStatus(status, config['CLUSTER_NAME'], job_id=job_id or None, node=node or None, error=error or None,
+                        message=custom_msg or None)
+        with TRACER.span('StatusSender.send', status=status):
+            self.produce(config['TOPIC_STATUS'], key=jobid.encode('utf-8'), value=val.to_dict())
 
     def remove(self, jobid):
-        self.producer.send(config['TOPIC_STATUS'], key=jobid.encode('utf-8'), value=None)
+        self.produce(config['TOPIC_STATUS'], key=jobid.encode('utf-8'), value=None)
+
+
+def get_blob_store():
+    if 'RESULTS_BLOB_STORE_CLASS' in config and config['RESULTS_BLOB_STORE_CLASS']:
+        return locate(config['RESULTS_BLOB_STORE_CLASS'])()
+    return DirectoryBlobStore(config['RESULTS_BLOB_DIR'])
+
+
+RESULTS_BLOB = 'results_blob'
+RESULTS_POINTER_FIELDS = ['job_id', 'node', 'cluster', 'timestamp']
 
 
 class ResultsSender(KafkaSender):
+    def __init__(self, producer=None):
+        super(ResultsSender, self).__init__(producer=producer)
+        self.blob_store = None
+
     def send(self, jobid, results):
         results['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.producer.send(config['TOPIC_DONE'], key=jobid.encode('utf-8'), value={'results': results})
+        value = {'results': results}
+        if config['RESULTS_OFFLOAD_THRESHOLD']:
+            data = self.serializer.dumps(value)
+            if len(data) > config['RESULTS_OFFLOAD_THRESHOLD']:
+                value = self.offload(data, results)
+            elif not isinstance(self.producer, RelayProducer):
+                # not serialized again by the producer, the status relay gets the message itself
+                value = Serialized(data)
+        self.produce(config['TOPIC_DONE'], key=jobid.encode('utf-8'), value=value)
+
+    def offload(self, data, results):
+        # Large results go to the blob store, the message only points to them (see resolve_results)
+        if self.blob_store is None:
+            self.blob_store = get_blob_store()
+        digest = self.blob_store.put(data)
+        return {'results': {k: results[k] for k in RESULTS_POINTER_FIELDS if k in results},
+                RESULTS_BLOB: {'sha256': digest, 'size': len(data), 'content_type': self.serializer.content_type}}
+
+
+def is_results_pointer(value):
+    return isinstance(value, dict) and RESULTS_BLOB in value
+
+
+def resolve_results(value, blob_store=None):
+    '''Return the message of TOPIC_DONE with the full results, loading them from the blob store if they were offloaded'''
+    if not is_results_pointer(value):
+        return value
+    blob = value[RESULTS_BLOB]
+    return loads((blob_store or get_blob_store()).get(blob['sha256']), blob['content_type'])
+
+
+def open_results(value, blob_store=None):
+    '''Stream the serialized results (as a binary file) of a message of TOPIC_DONE without loading them into memory
+
+       Returns None if the results were sent inline.
+       '''
+    if not is_results_pointer(value):
+        return None
+    return (blob_store or get_blob_store()).open(value[RESULTS_BLOB]['sha256'])
 
 
 class HeartbeatSender(KafkaSender):
     def send(self):
         timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.producer.send(config['TOPIC_HEARTBEAT'], key=config['CLUSTER_NAME'].encode('utf-8'), value={'timestamp': timestamp})
+        self.produce(config['TOPIC_HEARTBEAT'], key=config['CLUSTER_NAME'].encode('utf-8'), value={'timestamp': timestamp})
 
 
 class ErrorSender(KafkaSender):
     def send(self, jobid, results, error):
         results['results']['error'] = str(error)
         results['results']['timestamp'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-        self.producer.send(config['TOPIC_ERROR'], key=jobid.encode('utf-8'), value=results)
+        self.produce(config['TOPIC_ERROR'], key=jobid.encode('utf-8'), value=results)
+
+
+class MonitorClient:
+    '''Keep-alive HTTP connection to the monitor agent'''
+
+    def __init__(self, url=None):
+        url = urlsplit(url or config['MONITOR_AGENT_URL'])
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.netloc
+        self.path = url.path.rstrip('/') + '/' + config['MONITOR_AGENT_CONTEXT_PATH']
+        self.connection = None
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        headers = {'Content-Type': 'application/json'} if data is not None else {}
+        for attempt in range(2):
+            if self.connection is None:
+                self.connection = self.connection_class(self.host, timeout=config['REQUEST_TIMEOUT_MS'] / 1000)
+            try:
+                self.connection.request(method, self.path + path, body=data, headers=headers)
+                response = self.connection.getresponse()
+                res = response.read()
+                if response.status != 200:
+                    raise ClusterAgentException('Monitor Agent returned {} for {}: {}'.format(response.status, path, res[:200]))
+                return json.loads(res)
+            except (http.client.HTTPException, OSError) as e:
+                # the monitor closed the idle connection - reconnect once
+                self.close()
+                if attempt:
+                    raise ClusterAgentException('Cannot reach Monitor Agent at: {}{} ({})'.format(self.host, self.path, e))
+
+    def check_statuses(self, ids):
+        return self.request('POST', 'check/', list(ids))
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+
+class ConsumerLag:
+    '''Committed offsets of a consumer group against the end offsets of a topic, per partition
+
+       Queried in-process with an admin client instead of kafka-consumer-groups.sh. Results are cached for
+       ttl seconds, get returns the cached ones right away and refreshes them in a background thread once
+       they expire (it only waits for the first query of a group).
+       '''
+
+    def __init__(self, ttl=None, bootstrap_servers=None, logger=None):
+        self.ttl = config['CONSUMER_LAG_TTL'] if ttl is None else ttl
+        self.bootstrap_servers = bootstrap_servers or config.get('BOOTSTRAP_SERVERS_LOCAL', config['BOOTSTRAP_SERVERS'])
+        self.logger = logger
+        self.admin = None
+        self.consumer = None
+        self.lock = Lock()
+        self.cache = {}
+        self.refreshing = set()
+
+    def connect(self):
+        kwargs = dict(bootstrap_servers=self.bootstrap_servers,
+                      security_protocol=config['KAFKA_SECURITY_PROTOCOL'],
+                      sasl_mechanism=config['KAFKA_SASL_MECHANISM'],
+                      sasl_plain_username=config['KAFKA_USERNAME'],
+                      sasl_plain_password=config['KAFKA_PASSWORD'])
+        if self.admin is None:
+            self.admin = KafkaAdminClient(**kwargs)
+        if self.consumer is None:
+            # no group - only used to look up the partitions and their end offsets
+            self.consumer = KafkaConsumer(group_id=None, enable_auto_commit=False, **kwargs)
+
+    def query(self, group, topic):
+        with self.lock:
+            self.connect()
+            partitions = [TopicPartition(topic, p) for p in sorted(self.consumer.partitions_for_topic(topic) or [])]
+            committed = self.admin.list_consumer_group_offsets(group, partitions=partitions)
+            end_offsets = self.consumer.end_offsets(partitions)
+            beginning_offsets = self.consumer.beginning_offsets(partitions)
+        lag = {'partitions': [], 'current': 0, 'end': 0, 'lag': 0, 'timestamp': time.time()}
+        for tp in partitions:
+            offset = committed.get(tp)
+            current = offset.offset if offset is not None and offset.offset >= 0 else None
+            # nothing committed yet - all messages still kept in the partition are waiting
+            partition_lag = end_offsets[tp] - (current if current is not None else beginning_offsets[tp])
+            lag['partitions'].append({'partition': tp.partition, 'current': current, 'end': end_offsets[tp],
+                                      'lag': partition_lag})
+            lag['current'] += current or 0
+            lag['end'] += end_offsets[tp]
+            lag['lag'] += partition_lag
+        return lag
+
+    def refresh(self, group, topic):
+        try:
+            self.cache[(group, topic)] = self.query(group, topic)
+        except Exception as e:
+            # e.g. the broker is not reachable, the old values are kept until the next try
+            self.close()
+            if self.logger:
+                self.logger.error('Problem in checking offsets of {} on {}: {}'.format(group, topic, e))
+        finally:
+            self.refreshing.discard((group, topic))
+        return self.cache.get((group, topic))
+
+    def get(self, group, topic):
+        '''Return {'current', 'end', 'lag', 'partitions', 'timestamp'} or None if the offsets cannot be read'''
+        lag = self.cache.get((group, topic))
+        if lag is None:
+            return self.refresh(group, topic)
+        if time.time() - lag['timestamp'] > self.ttl and (group, topic) not in self.refreshing:
+            self.refreshing.add((group, topic))
+            Thread(target=self.refresh, args=(group, topic), daemon=True).start()
+        return lag
+
+    def close(self):
+        with self.lock:
+            if self.admin is not None:
+                self.admin.close()
+                self.admin = None
+            if self.consumer is not None:
+                self.consumer.close()
+                self.consumer = None
 
 
 class JobSubmitter(KafkaSender):
+    def __init__(self, producer=None, ledger=None):
+        super(JobSubmitter, self).__init__(producer=producer)
+        self.monitor = None
+        self.ledger = None
+        self.status_consumer = None
+        self.ledger_synced_at = 0
+        # ids whose delivery failed, appended from the producer's thread
+        self.failed_ids = []
+        ledger = ledger or config['SUBMITTER_LEDGER']
+        if ledger:
+            self.ledger = SubmissionLedger(ledger)
+
     def send(self, s_id, script='my_job.py', slurm_pars={'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu'}, check=True, flush=True, ignore_error_status=False, topic=config['TOPIC_NEW']):
-        status = None
-        if check:
-            status = self.check_status(s_id)
-            if status is not None:
-                if config['DEBUG']:
-                    print('{} already processed: {}'.format(s_id, status))
-                if not ignore_error_status or (ignore_error_status and status != 'ERROR'):
-                    return s_id, False, status
-        self.producer.send(topic, key=s_id.encode('utf-8'), value={'input_job_id': s_id, 'script': script,
-                                                                                 'slurm_pars': slurm_pars,
-                                                                                 'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")})
+        status = self.get_statuses([s_id], check=check, bulk=False).get(s_id)
+        return self.submit(s_id, script, slurm_pars, status, flush=flush, ignore_error_status=ignore_error_status, topic=topic)
+
+    def submit(self, s_id, script, slurm_pars, status, flush=True, ignore_error_status=False, topic=config['TOPIC_NEW']):
+        if status is not None:
+            if config['DEBUG']:
+                print('{} already processed: {}'.format(s_id, status))
+            if not ignore_error_status or (ignore_error_status and status != 'ERROR'):
+                return s_id, False, status
+        future = self.produce(topic, key=s_id.encode('utf-8'), value=self.get_job_message(s_id, script, slurm_pars))
+        self.mark_submitted(s_id, future, commit=flush)
         if flush:
             self.producer.flush()
+            self.forget_failed()
         return s_id, True, status
 
+    def mark_submitted(self, s_id, future, commit=True):
+        if self.ledger is None:
+            return
+        self.ledger.mark_submitted([s_id], commit=commit)
+        if future is not None:
+            # marked before the errback is added, it runs right away if the send has already failed
+            future.add_errback(lambda e: self.failed_ids.append(s_id))
+
+    def forget_failed(self):
+        '''Remove the ids whose messages were not delivered from the ledger so that they are submitted again'''
+        failed = []
+        while self.failed_ids:
+            failed.append(self.failed_ids.pop())
+        if failed and self.ledger is not None:
+            self.ledger.forget_submitted(failed)
+
+    def get_statuses(self, ids, check=True, bulk=True):
+        # Known statuses come from the local ledger (SUBMITTER_LEDGER), the monitor agent is asked only about the rest
+        statuses = {}
+        if self.ledger is not None:
+            self.sync_ledger()
+            statuses, ids = self.ledger.lookup(ids)
+        if check and ids:
+            statuses.update(self.check_statuses(ids) if bulk else {s_id: self.check_status(s_id) for s_id in ids})
+        return statuses
+
+    def sync_ledger(self, force=False):
+        '''Read the new messages of TOPIC_STATUS into the ledger, at most every SUBMITTER_LEDGER_SYNC_INTERVAL seconds'''
+        if not force and time.monotonic() - self.ledger_synced_at < config['SUBMITTER_LEDGER_SYNC_INTERVAL']:
+            return
+        if self.status_consumer is None:
+            self.status_consumer = KafkaConsumer(bootstrap_servers=config['BOOTSTRAP_SERVERS'],
+                                                 security_protocol=config['KAFKA_SECURITY_PROTOCOL'],
+                                                 sasl_mechanism=config['KAFKA_SASL_MECHANISM'],
+                                                 sasl_plain_username=config['KAFKA_USERNAME'],
+                                                 sasl_plain_password=config['KAFKA_PASSWORD'],
+                                                 enable_auto_commit=False,
+                                                 value_deserializer=loads)
+        consumer = self.status_consumer
+        tps = [TopicPartition(config['TOPIC_STATUS'], p) for p in consumer.partitions_for_topic(config['TOPIC_STATUS']) or []]
+        consumer.assign(tps)
+        offsets = self.ledger.get_offsets()
+        beginning = consumer.beginning_offsets(tps)
+        end = consumer.end_offsets(tps)
+        if not offsets:
+            self.ledger.set_complete(all(beginning[tp] == 0 for tp in tps))
+        for tp in tps:
+            next_offset = offsets.get(tp.partition, beginning[tp])
+            if next_offset < beginning[tp]:
+                # messages deleted by the topic retention before they were read
+                self.ledger.set_complete(False)
+                next_offset = beginning[tp]
+            consumer.seek(tp, next_offset)
+        while any(consumer.position(tp) < end[tp] for tp in tps):
+            records = consumer.poll(timeout_ms=1000, max_records=10000)
+            if not records:
+                break
+            updates = []
+            for els in records.values():
+                for el in els:
+                    js = JobStatus.from_value(el.value)
+                    updates.append((el.key.decode('utf-8'), js.status_name if js else None))
+            self.ledger.update(updates, {tp.partition: consumer.position(tp) for tp in tps})
+        self.ledger_synced_at = time.monotonic()
+
+    @staticmethod
+    def get_job_message(s_id, script, slurm_pars):
+        return {'input_job_id': s_id, 'script': script, 'slurm_pars': slurm_pars,
+                'timestamp': datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+
     @staticmethod
     def check_status(s_id):
         try:
             url = config['MONITOR_AGENT_URL'] + config['MONITOR_AGENT_CONTEXT_PATH'] + 'check/' + s_id + '/'
             response = urllib.request.urlopen(url)
             res = response.read().decode("utf-8")
-            status = ast.literal_eval(res)
+            status = json.loads(res)
             if status[s_id]:
                 return status[s_id]['status']
             else:
@@ -258,34 +1267,259 @@ class JobSubmitter(KafkaSender):
         except URLError as e:
             raise ClusterAgentException('Cannot reach Monitor Agent at: ' + url)
 
+    def check_statuses(self, ids):
+        # One POST to the monitor agent for the whole chunk of ids instead of one request per id
+        if self.monitor is None:
+            self.monitor = MonitorClient()
+        statuses = self.monitor.check_statuses(ids)
+        return {s_id: statuses[s_id]['status'] if statuses.get(s_id) else None for s_id in ids}
+
     def send_many(self, ids, script='my_job.py', slurm_pars={'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu'}, check=True, ignore_error_status=False, topic=config['TOPIC_NEW']):
         results = []
-        for s_id in ids:
-            results.append(self.send(s_id, script=script, slurm_pars=slurm_pars, check=check, flush=False, ignore_error_status=ignore_error_status, topic=topic))
+        ids = list(ids)
+        chunk_size = config['MONITOR_CHECK_CHUNK_SIZE']
+        for i in range(0, len(ids), chunk_size):
+            chunk = ids[i:i + chunk_size]
+            statuses = self.get_statuses(chunk, check=check)
+            for s_id in chunk:
+                results.append(self.submit(s_id, script, slurm_pars, statuses.get(s_id), flush=False, ignore_error_status=ignore_error_status, topic=topic))
         self.producer.flush()
+        if self.ledger is not None:
+            self.ledger.commit()
+            self.forget_failed()
         return results
 
+    def send_stream(self, ids, script='my_job.py', slurm_pars={'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu'}, check=True, ignore_error_status=False, topic=config['TOPIC_NEW'], max_in_flight=None, on_result=None):
+        '''Submit ids from any iterable (e.g. a generator) with at most max_in_flight records waiting for Kafka
+
+           on_result(s_id, sent, status, error) is called for every id when its record was delivered or failed
+           (from the producer's thread) or when it was skipped as already processed.
+           Returns a summary with the counts, the first SUBMITTER_MAX_ERRORS errors and the throughput.
+           '''
+        slots = Semaphore(max_in_flight or config['SUBMITTER_MAX_IN_FLIGHT'])
+        lock = Lock()
+        summary = {'submitted': 0, 'delivered': 0, 'failed': 0, 'skipped': 0, 'errors': []}
+
+        def delivered(s_id, error=None):
+            with lock:
+                if error is None:
+                    summary['delivered'] += 1
+                else:
+                    summary['failed'] += 1
+                    if len(summary['errors']) < config['SUBMITTER_MAX_ERRORS']:
+                        summary['errors'].append((s_id, str(error)))
+            slots.release()
+            if on_result:
+                on_result(s_id, error is None, None, error)
+
+        started = time.perf_counter()
+        ids = iter(ids)
+        while True:
+            chunk = list(islice(ids, config['MONITOR_CHECK_CHUNK_SIZE']))
+            if not chunk:
+                break
+            statuses = self.get_statuses(chunk, check=check)
+            for s_id in chunk:
+                status = statuses.get(s_id)
+                if status is not None and (not ignore_error_status or status != 'ERROR'):
+                    summary['skipped'] += 1
+                    if on_result:
+                        on_result(s_id, False, status, None)
+                    continue
+                slots.acquire()
+                summary['submitted'] += 1
+                try:
+                    future = self.produce(topic, s_id.encode('utf-8'), self.get_job_message(s_id, script, slurm_pars))
+                except Exception as e:
+                    delivered(s_id, e)
+                    continue
+                self.mark_submitted(s_id, future, commit=False)
+                if future is None:
+                    # sent through the status relay which confirms delivery only on flush
+                    delivered(s_id)
+                else:
+                    future.add_callback(lambda metadata, s_id=s_id: delivered(s_id))
+                    future.add_errback(lambda e, s_id=s_id: delivered(s_id, e))
+            if self.ledger is not None:
+                self.ledger.commit()
+                self.forget_failed()
+        self.producer.flush()
+        self.forget_failed()
+        summary['elapsed'] = time.perf_counter() - started
+        summary['rate'] = summary['submitted'] / summary['elapsed'] if summary['elapsed'] else 0
+        return summary
+
     def __del__(self):
         if self.producer is not None:
             self.producer.flush()
+        if getattr(self, 'monitor', None) is not None:
+            self.monitor.close()
+        if getattr(self, 'status_consumer', None) is not None:
+            self.status_consumer.close()
 
 
 class ClusterAgentException(Exception):
     pass
 
 
+def run_forked_job(class_path, args, env, out_file, cpus=None):
+    # Runs in a child of the fork server where the computing class has already been imported
+    with open(out_file, 'w') as out:
+        os.dup2(out.fileno(), 1)
+        os.dup2(out.fileno(), 2)
+    os.environ.update(env)
+    if cpus and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cpus)
+    sys.argv = args
+    try:
+        locate(class_path)(args).compute()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+
+
+class ForkServerExecutor:
+    '''Run worker jobs in processes forked from a warm fork server
+
+       The fork server imports the computing classes once, each job is a fresh fork of it,
+       so a crashing job cannot take down the agent but does not pay for the interpreter start and imports.
+       Jobs of scripts without a computing class are not run by the executor (see get_class_path).
+
+       classes: dict - scripts of the jobs and the ClusterComputing subclasses to run for them,
+                i.e. {'run.py': 'run.MyComputing'}
+       '''
+
+    def __init__(self, classes):
+        self.classes = {os.path.normpath(script): class_path for script, class_path in classes.items()}
+        modules = []
+        for script, class_path in self.classes.items():
+            module = class_path.rsplit('.', 1)[0]
+            try:
+                found = importlib.util.find_spec(module) is not None
+            except ImportError:
+                found = False
+            if not found:
+                raise ValueError('Module {} of the computing class of {} not found'.format(module, script))
+            modules.append(module)
+        self.context = multiprocessing.get_context('forkserver')
+        self.context.set_forkserver_preload(['kafka_slurm_agent.kafka_modules'] + modules)
+
+    def get_class_path(self, cmd):
+        '''The computing class of the script of the job command or None if the script has none'''
+        # cmd is the one of get_runner_batch_cmd: python script input_job_id cfg_file=... job_id=...
+        args = shlex.split(cmd)[1:]
+        return self.classes.get(os.path.normpath(args[0])) if args else None
+
+    def run(self, cmd, timeout, env=None, cpus=None):
+        class_path = self.get_class_path(cmd)
+        if class_path is None:
+            raise ValueError('No computing class for the script of {}'.format(cmd))
+        args = shlex.split(cmd)[1:]
+        out_file = os.path.join(tempfile.gettempdir(), 'ksa_job_{}.out'.format(uuid.uuid4().hex))
+        process = self.context.Process(target=run_forked_job, args=(class_path, args, env or {}, out_file, cpus))
+        process.start()
+        process.join(timeout)
+        try:
+            if process.is_alive():
+                kill(process.pid)
+                process.join()
+                raise TimeoutError('Job {} has been terminated by timeout after {}'.format(cmd, timeout))
+            out = ''
+            # a child that failed before redirecting its output leaves no file
+            if os.path.exists(out_file):
+                with open(out_file, errors='ignore') as f:
+                    out = f.read()
+        finally:
+            if os.path.exists(out_file):
+                os.remove(out_file)
+        return process.exitcode, out, ''
+
+
+Allocation = namedtuple('Allocation', ['cpus', 'gpus', 'mem'])
+
+
+class ResourceQueue:
+    '''Queue of worker jobs that hands out a job only when its CPUs, GPUs and memory are free
+
+       Jobs are taken in FIFO order, but a job that does not fit yet does not block smaller jobs behind it.
+
+       cpus: list - ids of the CPU cores jobs can be pinned to
+       gpus: list - GPU indices as used in CUDA_VISIBLE_DEVICES
+       mem: int - (MB) - memory available for jobs
+       '''
+
+    def __init__(self, cpus, gpus, mem):
+        self.cpus = list(cpus)
+        self.gpus = list(gpus)
+        self.mem = mem
+        self.free_cpus = list(cpus)
+        self.free_gpus = list(gpus)
+        self.free_mem = mem
+        self.pending = []
+        self.running = 0
+        self.cond = Condition()
+
+    def fits(self, req):
+        cpus, gpus, mem = req
+        return cpus <= len(self.free_cpus) and gpus <= len(self.free_gpus) and mem <= self.free_mem
+
+    def can_fit(self, req):
+        cpus, gpus, mem = req
+        return cpus <= len(self.cpus) and gpus <= len(self.gpus) and mem <= self.mem
+
+    def free_jobs(self, req):
+        # How many more jobs of this size would fit right now
+        cpus, gpus, mem = req
+        counts = [len(self.free_cpus) // cpus if cpus else None, len(self.free_gpus) // gpus if gpus else None,
+                  self.free_mem // mem if mem else None]
+        counts = [c for c in counts if c is not None]
+        return min(counts) if counts else len(self.free_cpus)
+
+    def put(self, item, req=(1, 0, 0)):
+        with self.cond:
+            self.pending.append((item, req))
+            self.cond.notify_all()
+
+    def get(self):
+        with self.cond:
+            while True:
+                for i, (item, req) in enumerate(self.pending):
+                    if self.fits(req):
+                        self.pending.pop(i)
+                        cpus, gpus, mem = req
+                        alloc = Allocation(self.free_cpus[:cpus], self.free_gpus[:gpus], mem)
+                        del self.free_cpus[:cpus]
+                        del self.free_gpus[:gpus]
+                        self.free_mem -= mem
+                        self.running += 1
+                        return item, alloc
+                self.cond.wait()
+
+    def release(self, alloc):
+        with self.cond:
+            self.free_cpus = sorted(self.free_cpus + alloc.cpus)
+            self.free_gpus.extend(alloc.gpus)
+            self.free_mem += alloc.mem
+            self.running -= 1
+            self.cond.notify_all()
+
+    def qsize(self):
+        return len(self.pending)
+
+
 class WorkerRunner(Thread):
-    def __init__(self, queue, logger, stat_send, processing, submitted):
+    def __init__(self, queue, logger, stat_send, processing, submitted, executor=None):
         Thread.__init__(self)
         self.queue = queue
         self.logger = logger
         self.stat_send = stat_send
         self.processing = processing
         self.submitted = submitted
+        self.executor = executor
 
     def run(self):
         while True:
-            job_id, input_job_id, cmd, time_out = self.queue.get()
+            (job_id, input_job_id, cmd, time_out), alloc = self.queue.get()
             finished_ok = False
             rcode = -1000
             out = ''
@@ -296,10 +1530,17 @@ class WorkerRunner(Thread):
                 self.processing.append(job_id)
                 if job_id in self.submitted:
                     self.submitted.remove(job_id)
-                os.environ["SLURM_JOB_ID"] = job_id
                 if not time_out:
                     time_out = config['WORKER_JOB_TIMEOUT'] 
-                rcode, out, error = WorkingAgent.run_command(cmd, time_out)
+                env = {'SLURM_JOB_ID': job_id}
+                if self.queue.gpus:
+                    env['CUDA_VISIBLE_DEVICES'] = ','.join(str(g) for g in alloc.gpus)
+                cpus = alloc.cpus if config['WORKER_AGENT_PIN_CPUS'] else None
+                self.logger.info('Resources {}: cpus {}, gpus {}, mem {}'.format(job_id, alloc.cpus, alloc.gpus, alloc.mem))
+                if self.executor and self.executor.get_class_path(cmd):
+                    rcode, out, error = self.executor.run(cmd, time_out, env=env, cpus=cpus)
+                else:
+                    rcode, out, error = WorkingAgent.run_command(cmd, time_out, env=env, cpus=cpus)
                 if rcode != 0:
                     finished_ok = False
                     self.logger.error('Return code {}: {}'.format(job_id, rcode))
@@ -327,26 +1568,59 @@ class WorkerRunner(Thread):
                     self.stat_send.send(input_job_id, 'ERROR', job_id, node=socket.gethostname(), error='{}: {}, {}'.format(rcode, out, error[:2000] if error and len(error)>2000 else error))
                 else:
                     self.logger.info('Finalizing job {}: {}'.format(job_id, cmd))
-                self.queue.task_done()
+                self.queue.release(alloc)
+
+
+def get_pilot_topic():
+    # jobs the cluster agent passes to its pilot jobs
+    return config['TOPIC_PILOT'] or config['TOPIC_NEW'] + '-pilot'
+
+
+def get_pilot_group():
+    return config['CLUSTER_AGENT_NEW_GROUP'] + '_pilot'
+
+
+def new_jobs_consumer(topic=None, group_id=None, **kwargs):
+    return KafkaConsumer(topic or config['TOPIC_NEW'],
+                         bootstrap_servers=config['BOOTSTRAP_SERVERS'],
+                         security_protocol=config['KAFKA_SECURITY_PROTOCOL'],
+                         sasl_mechanism=config['KAFKA_SASL_MECHANISM'],
+                         sasl_plain_username=config['KAFKA_USERNAME'],
+                         sasl_plain_password=config['KAFKA_PASSWORD'],
+                         enable_auto_commit=False,
+                         heartbeat_interval_ms=config['KAFKA_CONSUMER_HEARTBEAT_INTERVAL_MS'],
+                         group_id=group_id or config['CLUSTER_AGENT_NEW_GROUP'],
+                         partition_assignment_strategy=config['KAFKA_PARTITION_ASSIGNMENT_STRATEGY'],
+                         #[RoundRobinPartitionAssignor, RangePartitionAssignor],
+                         value_deserializer=loads,
+                         **kwargs)
 
 
 class WorkingAgent:
     def __init__(self):
-        self.consumer = KafkaConsumer(config['TOPIC_NEW'],
-                                 bootstrap_servers=config['BOOTSTRAP_SERVERS'],
-                                 security_protocol=config['KAFKA_SECURITY_PROTOCOL'],
-                                 sasl_mechanism=config['KAFKA_SASL_MECHANISM'],
-                                 sasl_plain_username=config['KAFKA_USERNAME'],
-                                 sasl_plain_password=config['KAFKA_PASSWORD'],
-                                 enable_auto_commit=False,
-                                 heartbeat_interval_ms=config['KAFKA_CONSUMER_HEARTBEAT_INTERVAL_MS'],
-                                 group_id=config['CLUSTER_AGENT_NEW_GROUP'],
-                                 partition_assignment_strategy=config['KAFKA_PARTITION_ASSIGNMENT_STRATEGY'],
-                                      #[RoundRobinPartitionAssignor, RangePartitionAssignor],
-                                 value_deserializer=lambda x: json.loads(x.decode('utf-8')))
+        self.consumer = new_jobs_consumer()
+        self.consumer_lag = ConsumerLag(bootstrap_servers=config['BOOTSTRAP_SERVERS'])
         self.stat_send = StatusSender()
         self.script_name = None
         self.job_name_suffix = '_CLAG'
+        self.executor_type = None
+        self.job_store = JobConfigStore(os.path.join(config['SHARED_TMP'], 'jobs'))
+        self.prepared_configs = {}
+        self.job_store_cleaned_at = 0
+        self.new_jobs = None
+        # (topic, partition, offset) of records handed off but not committed as an earlier one was not handed off
+        self.uncommitted = set()
+        self.register_metrics(REGISTRY)
+
+    def register_metrics(self, registry):
+        '''Declare the metrics of the agent's metrics page, subclasses add their own after calling super'''
+        self.jobs_submitted = registry.counter('ksa_jobs_submitted_total', 'Jobs taken from the NEW topic and submitted')
+        self.poll_size = registry.histogram('ksa_poll_records', 'Records returned by a poll of the NEW topic',
+                                            buckets=POLL_SIZE_BUCKETS)
+        registry.gauge('ksa_producer_in_flight_records', 'Status messages sent and not yet acknowledged by Kafka',
+                       func=lambda: self.stat_send.in_flight())
+        registry.gauge('ksa_consumer_lag', 'Jobs on the NEW topic not taken by the agents of the group yet, as of the '
+                                           'last check cycle', func=lambda: self.new_jobs)
 
     def get_job_name(self, input_job_id):
         # TODO - override the method according to your needs
@@ -359,12 +1633,144 @@ class WorkingAgent:
         return self.get_job_type(slurm_pars) == 'gpu'
 
     def write_job_config(self, job_config):
-        if not os.path.isdir(config['SHARED_TMP']):
-            os.makedirs(config['SHARED_TMP'])
-        tfile = tempfile.NamedTemporaryFile(dir=config['SHARED_TMP'], mode="w+", delete=False)
-        json.dump(job_config, tfile)
-        tfile.flush()
-        return tfile.name
+        # A list of jobs (Slurm job array) is read back by the array task id
+        if isinstance(job_config, list):
+            return self.job_store.write_batch(job_config)[0]
+        if job_config.get('input_job_id') in self.prepared_configs:
+            return self.prepared_configs.pop(job_config['input_job_id'])
+        return self.job_store.write_batch([job_config])[1][0]
+
+    def prepare_job_configs(self, msgs):
+        # Writes the configs of all polled jobs into one batch file, write_job_config then returns their references
+        if not msgs:
+            return
+        if self.executor_type:
+            for msg in msgs:
+                msg['ExecutorType'] = self.executor_type
+        path, refs = self.job_store.write_batch(msgs)
+        self.prepared_configs = {msg['input_job_id']: ref for msg, ref in zip(msgs, refs)}
+
+    def release_job_config(self, input_job_id):
+        # Called when the job reached a terminal status
+        self.job_store.release(input_job_id)
+
+    def cleanup_job_configs(self, keep=()):
+        '''keep: input_job_ids of the jobs not finished yet, their configs are kept however old'''
+        if time.time() - self.job_store_cleaned_at < config['JOB_CONFIG_CLEANUP_INTERVAL']:
+            return
+        self.job_store_cleaned_at = time.time()
+        removed = self.job_store.cleanup(config['JOB_CONFIG_MAX_AGE'], keep)
+        if removed:
+            self.logger.info('Removed {} old job config files'.format(removed))
+
+    def count_new_jobs(self, group=None, topic=None):
+        '''Jobs on the NEW topic (or topic) not yet taken by any agent of the group
+
+           The committed offsets of all partitions are read with one request instead of one per partition.
+           '''
+        with TRACER.span('consumer.count_new_jobs'):
+            try:
+                return self.consumer_lag.query(group or config['CLUSTER_AGENT_NEW_GROUP'], topic or config['TOPIC_NEW'])['lag']
+            except Exception:
+                # connect again in the next cycle
+                self.consumer_lag.close()
+                raise
+
+    def poll_new_jobs(self, slots, timeout_ms=2000):
+        '''Poll at most slots records from the NEW topic
+
+           While there are no free slots the partitions stay paused so the jobs are left for other agents.
+           '''
+        if slots <= 0:
+            self.consumer.pause(*self.consumer.assignment())
+            # keeps the consumer in its group, records of partitions assigned just now are given back
+            with TRACER.span('consumer.poll', slots=0):
+                self.rewind(self.get_records(self.consumer.poll(timeout_ms=0)))
+            return []
+        self.consumer.resume(*self.consumer.paused())
+        with TRACER.span('consumer.poll', slots=slots) as span:
+            records = self.get_records(self.consumer.poll(max_records=slots, timeout_ms=timeout_ms))
+            span['records'] = len(records)
+        self.poll_size.observe(len(records))
+        return records
+
+    @staticmethod
+    def get_records(polled):
+        return [el for records in polled.values() for el in records]
+
+    def rewind(self, records, offsets=None):
+        # seek back to the first record of each partition that was not handed off
+        offsets = offsets or {}
+        rewound = set()
+        for el in records:
+            tp = TopicPartition(el.topic, el.partition)
+            if tp not in rewound and (tp not in offsets or offsets[tp].offset <= el.offset):
+                self.consumer.seek(tp, el.offset)
+                rewound.add(tp)
+
+    def hand_off_jobs(self, records, submit, batch=False):
+        '''Call submit for the polled records and commit the offsets of the records handed off to it
+
+           submit gets a single message or, with batch=True, the list of all messages and yields lists of the
+           messages it handed off (i.e. one per sbatch --array), their offsets are committed right away.
+           If submit fails the remaining records are polled again in the next cycle. Records handed off after one
+           that was not cannot be committed yet, they are skipped when they are polled again.
+           '''
+        if not records:
+            return
+        pending = [el for el in records if (el.topic, el.partition, el.offset) not in self.uncommitted]
+        committed = {}
+        try:
+            if batch:
+                by_msg = {id(el.value): el for el in pending}
+                for msgs in submit([el.value for el in pending]):
+                    self.uncommitted.update((el.topic, el.partition, el.offset) for el in (by_msg[id(msg)] for msg in msgs))
+                    self.jobs_submitted.inc(len(msgs))
+                    self.commit_handed_off(records, committed)
+            else:
+                for el in pending:
+                    submit(el.value)
+                    self.uncommitted.add((el.topic, el.partition, el.offset))
+                    self.jobs_submitted.inc()
+        except Exception:
+            self.rewind(records, self.commit_handed_off(records, committed))
+            raise
+        self.commit_handed_off(records, committed)
+
+    def commit_handed_off(self, records, committed):
+        '''Commit the offsets of the records handed off up to the first one in each partition that was not
+
+           committed: dict - offsets committed so far for these records, updated and returned
+           '''
+        offsets = {}
+        blocked = set()
+        for el in records:
+            tp = TopicPartition(el.topic, el.partition)
+            if tp in blocked:
+                continue
+            if (el.topic, el.partition, el.offset) in self.uncommitted or (
+                    tp in committed and el.offset < committed[tp].offset):
+                offsets[tp] = OffsetAndMetadata(el.offset + 1, '')
+            else:
+                blocked.add(tp)
+        offsets = {tp: meta for tp, meta in offsets.items() if tp not in committed or committed[tp] != meta}
+        if offsets:
+            with TRACER.span('consumer.commit', partitions=len(offsets)):
+                self.consumer.commit(offsets)
+            committed.update(offsets)
+            self.uncommitted = {(topic, partition, offset) for topic, partition, offset in self.uncommitted
+                                if TopicPartition(topic, partition) not in committed or
+                                offset >= committed[TopicPartition(topic, partition)].offset}
+        return committed
+
+    def is_idle(self):
+        # Nothing waiting on the NEW topic - the agent can poll less often
+        try:
+            self.new_jobs = self.count_new_jobs()
+            return self.new_jobs == 0
+        except Exception as e:
+            self.logger.warning('Cannot count new jobs: {}'.format(e))
+            return False
 
     def get_runner_batch_cmd(self, input_job_id, script, msg=None, job_id=None):
         # TODO - override the method according to your needs
@@ -382,9 +1788,11 @@ class WorkingAgent:
         return cmd, time_out
 
     @staticmethod
-    def run_command(cmd, timeout=10):
+    def run_command(cmd, timeout=10, env=None, cpus=None):
+        if cpus and shutil.which('taskset'):
+            cmd = 'taskset -c {} {}'.format(','.join(str(c) for c in cpus), cmd)
         comd = Command(cmd)
-        comd.run(timeout=timeout)
+        comd.run(timeout=timeout, env=env)
         return comd.getReturnCode(), comd.getOut(), comd.getError()
 
 
@@ -392,40 +1800,100 @@ class WorkerAgent(WorkingAgent):
     def __init__(self):
         super(WorkerAgent, self).__init__()
         self.logger = setupLogger(config['LOGS_DIR'], "workeragent_{}".format(socket.gethostname()))
+        setup_tracing(self.logger.name)
         self.logger.info('Worker Agent Started')
-        self.workers = config['WORKER_AGENT_MAX_WORKERS']
-        self.queue = Queue()
+        self.queue = ResourceQueue(self.get_worker_cpus(), self.get_worker_gpus(), self.get_worker_mem())
+        # every job takes at least one core, so one runner per core can always fill the worker
+        self.workers = config['WORKER_AGENT_MAX_WORKERS'] or len(self.queue.cpus)
+        self.logger.info('Resources: cpus {}, gpus {}, mem {}MB, runners {}'.format(
+            self.queue.cpus, self.queue.gpus, self.queue.mem, self.workers))
         self.processing = []
         self.submitted = []
         self.is_accepting_jobs = True
+        self.executor = None
+        self.executor_type = 'WRK_AGNT'
+        if config['WORKER_AGENT_EXECUTOR'] == 'forkserver':
+            self.executor = ForkServerExecutor(config['WORKER_COMPUTING_CLASSES'])
         self.start_workers()
 
+    def register_metrics(self, registry):
+        super(WorkerAgent, self).register_metrics(registry)
+        registry.gauge('ksa_worker_queue_depth', 'Jobs waiting in the worker queue for free resources',
+                       func=lambda: len(self.queue.pending))
+
     @staticmethod
     def unique_id():
         return hex(uuid.uuid4().time)[2:-1]
 
+    @staticmethod
+    def get_worker_cpus():
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+        if isinstance(config['WORKER_AGENT_CPUS'], int):
+            return cpus[:config['WORKER_AGENT_CPUS']]
+        return config['WORKER_AGENT_CPUS'] or cpus
+
+    @staticmethod
+    def get_worker_gpus():
+        gpus = config['WORKER_AGENT_GPUS']
+        if isinstance(gpus, int):
+            return list(range(gpus))
+        if gpus is None:
+            if os.getenv('CUDA_VISIBLE_DEVICES'):
+                return os.getenv('CUDA_VISIBLE_DEVICES').split(',')
+            if shutil.which('nvidia-smi'):
+                rcode, out, _ = WorkingAgent.run_command('nvidia-smi -L')
+                return list(range(len(out.splitlines()))) if rcode == 0 and out else []
+            return []
+        return gpus
+
+    @staticmethod
+    def get_worker_mem():
+        if config['WORKER_AGENT_MEM']:
+            return parse_mem(config['WORKER_AGENT_MEM'])
+        return psutil.virtual_memory().total // 1024 ** 2
+
+    def get_job_requirements(self, slurm_pars):
+        # (cpus, gpus, mem in MB) a job needs on this worker
+        res_req = int(slurm_pars['RESOURCES_REQUIRED'] if slurm_pars and 'RESOURCES_REQUIRED' in slurm_pars else config['SLURM_RESOURCES_REQUIRED'])
+        mem = parse_mem(slurm_pars['MEM']) if slurm_pars and 'MEM' in slurm_pars else 0
+        if self.is_job_gpu(slurm_pars):
+            return 1, res_req, mem
+        return max(res_req, 1), 0, mem
+
     def check_queue_submit(self):
         if not self.is_accepting_jobs:
+            self.poll_new_jobs(0)
             return
         i = 0
-        while self.queue.qsize() < self.workers and i < self.workers*4:
+        default_req = self.get_job_requirements(None)
+        while i < self.workers*4:
             i += 1
-            new_jobs = self.consumer.poll(max_records=max(math.floor(self.workers / config['SLURM_RESOURCES_REQUIRED']), 1),
-                                          timeout_ms=2000)
+            new_jobs = self.poll_new_jobs(self.get_free_slots(default_req))
             #self.logger.info('Got {} new jobs'.format(len(new_jobs)))
-            for job in new_jobs.items():
-                self.logger.info(job)
-                for el in job[1]:
-                    msg = el.value
-                    msg['ExecutorType'] = 'WRK_AGNT'
-                    self.logger.debug(msg['input_job_id'])
-                    job_id = self.unique_id()
-                    cmd, time_out = self.get_runner_batch_cmd(msg['input_job_id'], msg['script'], msg, job_id)
-                    self.queue.put((job_id, msg['input_job_id'], cmd, time_out))
-                    self.stat_send.send(msg['input_job_id'], 'SUBMITTED', job_id, node=socket.gethostname())
-                    self.submitted.append(job_id)
-
-            self.consumer.commit()
+            if not new_jobs:
+                break
+            self.prepare_job_configs([el.value for el in new_jobs])
+            self.hand_off_jobs(new_jobs, self.queue_job)
+
+    def get_free_slots(self, req):
+        # jobs that can start right now: free resources, but no more than the idle runners, minus the queued jobs
+        idle_runners = self.workers - self.queue.running
+        return max(min(self.queue.free_jobs(req), idle_runners) - self.queue.qsize(), 0)
+
+    def queue_job(self, msg):
+        self.logger.info(msg)
+        msg['ExecutorType'] = 'WRK_AGNT'
+        job_id = self.unique_id()
+        req = self.get_job_requirements(msg['slurm_pars'])
+        if not self.queue.can_fit(req):
+            self.stat_send.send(msg['input_job_id'], 'ERROR', job_id, node=socket.gethostname(),
+                                error='Job needs (cpus, gpus, mem) {} but worker has only {}'.format(
+                                    req, (len(self.queue.cpus), len(self.queue.gpus), self.queue.mem)))
+            return
+        cmd, time_out = self.get_runner_batch_cmd(msg['input_job_id'], msg['script'], msg, job_id)
+        self.queue.put((job_id, msg['input_job_id'], cmd, time_out), req)
+        self.stat_send.send(msg['input_job_id'], 'SUBMITTED', job_id, node=socket.gethostname())
+        self.submitted.append(job_id)
 
     def check_job_status(self, job_id):
         if job_id in self.processing:
@@ -443,71 +1911,166 @@ class WorkerAgent(WorkingAgent):
 
     def start_workers(self):
         for n in range(self.workers):
-            worker = WorkerRunner(self.queue, self.logger, self.stat_send, self.processing, self.submitted)
+            worker = WorkerRunner(self.queue, self.logger, self.stat_send, self.processing, self.submitted, self.executor)
             worker.daemon = True
             worker.start()
-        self.queue.join()
 
 
 class ClusterAgent(WorkingAgent):
     def __init__(self):
         super(ClusterAgent, self).__init__()
         self.job_name_suffix = config['CLUSTER_JOB_NAME_SUFFIX']
+        self.executor_type = 'CL_AGNT'
         self.logger = setupLogger(config['LOGS_DIR'], "clusteragent_{}".format(socket.gethostname()))
+        setup_tracing(self.logger.name)
+        self.queue_snapshot = SlurmQueueSnapshot(getpass.getuser(), self.job_name_suffix,
+                                                 ttl=config['SLURM_QUEUE_SNAPSHOT_TTL'])
+        self.node_snapshot = SlurmNodeSnapshot(ttl=config['SLURM_NODE_SNAPSHOT_TTL'])
+        self.array_tasks = {}
         self.logger.info('Cluster Agent Started')
 
+    def get_array_job_name(self):
+        return ARRAY_INPUT_ID + self.job_name_suffix
+
+    def get_pilot_job_name(self):
+        return PILOT_INPUT_ID + self.job_name_suffix
+
+    def is_job_alive(self, job_id):
+        return self.queue_snapshot.get_job(job_id) is not None
+
     def check_queue_submit(self):
+        if config['SLURM_PILOT_JOBS'] > 0:
+            return self.check_pilots_submit()
+        slots = self.count_free_slots()
+        self.logger.info('Polling: {}'.format(slots))
+        new_jobs = self.poll_new_jobs(slots)
+        if new_jobs:
+            self.logger.info('Got {} new jobs'.format(len(new_jobs)))
+        if config['SLURM_ARRAY_SUBMIT']:
+            self.hand_off_jobs(new_jobs, self.submit_slurm_arrays, batch=True)
+        else:
+            self.prepare_job_configs([el.value for el in new_jobs])
+            self.hand_off_jobs(new_jobs, self.submit_new_job)
+
+    def submit_new_job(self, msg):
+        self.logger.debug(msg['input_job_id'])
+        if config['DELAY_BETWEEN_SUBMIT_MS'] > 0:
+            time.sleep(0.001*config['DELAY_BETWEEN_SUBMIT_MS'])
+        job_id = self.submit_slurm_job(msg['input_job_id'], msg['script'], msg['slurm_pars'], msg)
+        self.stat_send.send(msg['input_job_id'], 'SUBMITTED', job_id)
+
+    def count_free_slots(self):
+        # how many new slurm jobs can be submitted now
         func_name = 'self.slurm_get_idle_' + self.get_job_type(None) + 's'
         free = eval(func_name + "()")
         self.logger.info('Free {}s: {}'.format(config['SLURM_JOB_TYPE'].upper(), free))
         if 'SLURM_EXCLUDE' in config and config['SLURM_EXCLUDE'] != '':
-            self.logger.info('Excluded nodes: {}/{}'.format(config['SLURM_EXCLUDE'], ClusterAgent.slurm_get_idle_excluded_cpus()))
+            self.logger.info('Excluded nodes: {}/{}'.format(config['SLURM_EXCLUDE'], self.slurm_get_idle_excluded_cpus()))
         w = self.slurm_check_jobs_waiting()
         self.logger.info('Waiting: {}'.format(w))
-        if w <= 1:
-            self.logger.info('Polling: {}'.format(max(math.floor(free / config['SLURM_RESOURCES_REQUIRED']), 1)))
-            new_jobs = self.consumer.poll(max_records=max(math.floor(free / config['SLURM_RESOURCES_REQUIRED']), 1),
-                                          timeout_ms=2000)
-            self.logger.info('Got {} new jobs'.format(len(new_jobs)))
-            for job in new_jobs.items():
-                self.logger.debug(job)
-                for el in job[1]:
-                    self.logger.debug(el.value['input_job_id'])
-                    if config['DELAY_BETWEEN_SUBMIT_MS'] > 0:
-                        time.sleep(0.001*config['DELAY_BETWEEN_SUBMIT_MS'])
-                    #msg = ast.literal_eval(job.value().decode('utf-8'))
-                    job_id = self.submit_slurm_job(el.value['input_job_id'], el.value['script'], el.value['slurm_pars'], el.value)
-                    self.stat_send.send(el.value['input_job_id'], 'SUBMITTED', job_id)
-            self.consumer.commit()
-
-    def check_job_statuses(self):
-        cmd = 'squeue -o "%j %i %R %M %u" | grep {} | grep {}'.format(getpass.getuser(), self.job_name_suffix)
-        comd = Command(cmd)
-        comd.run(20)
-        res = comd.getOut()
+        return math.floor(free / config['SLURM_RESOURCES_REQUIRED']) if w <= 1 else 0
+
+    def is_pilot_job(self, msg):
+        script = config['PILOT_SCRIPT'] if 'PILOT_SCRIPT' in config else self.script_name
+        return not msg.get(PILOT_REJECTED) and os.path.basename(msg['script'] or self.script_name or '') == \
+            os.path.basename(script or '')
+
+    def check_pilots_submit(self):
+        # The jobs of PILOT_SCRIPT go to the pilots, the others are submitted as usual while there are free slots
+        new_jobs = self.poll_new_jobs(config['KAFKA_BROKER_MAX_POLL_RECORDS'])
+        slots = self.count_free_slots() if any(not self.is_pilot_job(el.value) for el in new_jobs) else 0
+        taken = 0
+        for el in new_jobs:
+            if not self.is_pilot_job(el.value):
+                if slots <= 0:
+                    break
+                slots -= 1
+            taken += 1
+        if taken < len(new_jobs):
+            self.rewind(new_jobs[taken:])
+        self.hand_off_jobs(new_jobs[:taken], self.dispatch_jobs, batch=True)
+        pilots = [e for e in self.queue_snapshot.jobs() if e.name == self.get_pilot_job_name()]
+        pilot_jobs = self.count_new_jobs(get_pilot_group(), get_pilot_topic())
+        self.logger.info('Pilots: {}, jobs for pilots: {}'.format(len(pilots), pilot_jobs))
+        for i in range(min(config['SLURM_PILOT_JOBS'], pilot_jobs) - len(pilots)):
+            self.submit_pilot_job()
+
+    def dispatch_jobs(self, msgs):
+        # yields the messages handed off - first all the jobs passed to the pilots, then each job submitted
+        pilot_msgs = [msg for msg in msgs if self.is_pilot_job(msg)]
+        if pilot_msgs:
+            futures = []
+            for msg in pilot_msgs:
+                msg['script'] = msg['script'] or self.script_name
+                futures.append(self.stat_send.produce(get_pilot_topic(), key=msg['input_job_id'].encode('utf-8'),
+                                                      value=msg))
+            self.stat_send.producer.flush()
+            failed = [future for future in futures if future is not None and future.failed()]
+            yield [msg for msg, future in zip(pilot_msgs, futures) if future is None or not future.failed()]
+            if failed:
+                raise failed[0].exception
+        other_msgs = [msg for msg in msgs if not self.is_pilot_job(msg)]
+        self.prepare_job_configs(other_msgs)
+        for msg in other_msgs:
+            self.submit_new_job(msg)
+            yield [msg]
+
+    def submit_slurm_arrays(self, msgs):
+        # Jobs with the same script and slurm parameters can share one sbatch --array call, yields the submitted chunks
+        groups = {}
+        for msg in msgs:
+            groups.setdefault((msg['script'], json.dumps(msg['slurm_pars'], sort_keys=True)), []).append(msg)
+        for group in groups.values():
+            for i in range(0, len(group), config['SLURM_ARRAY_MAX_SIZE']):
+                chunk = group[i:i + config['SLURM_ARRAY_MAX_SIZE']]
+                if config['DELAY_BETWEEN_SUBMIT_MS'] > 0:
+                    time.sleep(0.001 * config['DELAY_BETWEEN_SUBMIT_MS'])
+                if len(chunk) == 1:
+                    job_ids = [self.submit_slurm_job(chunk[0]['input_job_id'], chunk[0]['script'], chunk[0]['slurm_pars'], chunk[0])]
+                else:
+                    job_ids = self.submit_slurm_array(chunk[0]['script'], chunk[0]['slurm_pars'], chunk)
+                for msg, job_id in zip(chunk, job_ids):
+                    self.stat_send.send(msg['input_job_id'], 'SUBMITTED', job_id)
+                yield chunk
+
+    def check_job_statuses(self, known_jobs=None):
+        '''Return {input_job_id: (slurm_job_id, status, node or reason, run time)} for all jobs in the slurm queue
+
+           known_jobs: dict - slurm job id (str) to input_job_id, used to resolve job array tasks (jobid_taskid)
+           '''
+        # A fresh snapshot for each cycle, all the other queries of this cycle reuse it
+        self.queue_snapshot.refresh()
+        self.array_tasks = {k: v for k, v in self.array_tasks.items() if k in self.queue_snapshot.by_id}
         statuses = {}
-        if res:
-            for line in res.splitlines():
-                # 36315_AF2 596717 troll-8 6:53:54 prubach
-                els = line.split(" ")
-                input_job_id = ''.join(els[0][:-len(self.job_name_suffix)])
-                slurm_job_id = ''.join(els[1])
-                node = ''.join(els[2])
-                run_time = ''.join(els[3])
-                statuses[input_job_id] = (int(slurm_job_id), 'WAITING' if node.startswith('(') else 'RUNNING', node, self.parse_run_time(run_time))
+        for entry in self.queue_snapshot.jobs():
+            # 596717|RUNNING|6:53:54|prubach|troll-8|36315_AF2
+            if entry.name == self.get_pilot_job_name():
+                continue
+            if entry.name == self.get_array_job_name():
+                input_job_id = (known_jobs or {}).get(entry.job_id, self.array_tasks.get(entry.job_id))
+                if not input_job_id:
+                    self.logger.debug('Unknown array task: {}'.format(entry.job_id))
+                    continue
+                slurm_job_id = entry.job_id
+            else:
+                input_job_id = entry.name[:-len(self.job_name_suffix)]
+                slurm_job_id = int(entry.job_id)
+            statuses[input_job_id] = (slurm_job_id, 'WAITING' if SlurmQueueSnapshot.is_waiting(entry) else 'RUNNING',
+                                      entry.reason, self.parse_run_time(entry.run_time))
         return statuses
 
-    @staticmethod
-    def check_job_status(job_id):
-        cmd = 'squeue -o "%i %R %M" | grep ' + str(job_id)
-        comd = Command(cmd)
-        comd.run(10)
-        res = comd.getOut()
-        if res:
-            res = res.splitlines()[0]
-            node = ''.join(res.strip().split(" ")[1])
-            run_time = ''.join(res.strip().split(" ")[2])
-            return 'WAITING' if node.startswith('(') else 'RUNNING', node, ClusterAgent.parse_run_time(run_time)
+    def get_queued_job_ids(self):
+        '''input_job_ids of the jobs in the last squeue snapshot, pilots and unknown array tasks left out'''
+        job_ids = set(self.array_tasks.values())
+        for entry in self.queue_snapshot.entries:
+            if entry.name not in (self.get_pilot_job_name(), self.get_array_job_name()):
+                job_ids.add(entry.name[:-len(self.job_name_suffix)])
+        return job_ids
+
+    def check_job_status(self, job_id):
+        entry = self.queue_snapshot.get_job(job_id)
+        if entry:
+            return 'WAITING' if SlurmQueueSnapshot.is_waiting(entry) else 'RUNNING', entry.reason, ClusterAgent.parse_run_time(entry.run_time)
         else:
             return None, None, None
 
@@ -528,28 +2091,20 @@ class ClusterAgent(WorkingAgent):
             sec = int(hr_min_sec[1])
         return days * 24 * 60 * 60 + hrs * 60 * 60 + min * 60 + sec
 
-    @staticmethod
-    def cancel_job(job_id):
+    def cancel_job(self, job_id):
         cmd = 'scancel {}'.format(job_id)
         comd = Command(cmd)
         comd.run(10)
         i = 0
-        is_running = True
-        while i < 30 and is_running:
-            i+=1
-            cmd = 'squeue -o "%i %R %M" | grep ' + str(job_id)
-            comd = Command(cmd)
-            comd.run(10)
-            res = comd.getOut()
-            if not res:
+        while i < 30:
+            i += 1
+            # Only wait for the next squeue if the current snapshot still shows the job
+            if not self.queue_snapshot.get_job(job_id):
                 return True
             time.sleep(1)
         return False
 
-    def submit_slurm_job(self, input_job_id, script, slurm_params, msg=None):
-        if not script:
-            script = self.script_name
-        job_name = self.get_job_name(input_job_id)
+    def get_slurm_pars(self, job_name, slurm_params):
         slurm_out_dir = config['SLURM_OUT_DIR'] if 'SLURM_OUT_DIR' in config else config['PREFIX']
         slurm_pars = {'cpus_per_task': slurm_params[
             'RESOURCES_REQUIRED'] if slurm_params and 'RESOURCES_REQUIRED' in slurm_params else config[
@@ -565,73 +2120,84 @@ class ClusterAgent(WorkingAgent):
             slurm_pars['gres'] = 'gpu:{}'.format(res_req) if res_req > 1 else 'gpu'
         if 'SLURM_EXCLUDE' in config and config['SLURM_EXCLUDE'] != '':
             slurm_pars['exclude'] = config['SLURM_EXCLUDE']
-        slurm = Slurm(**slurm_pars)
+        return slurm_pars
+
+    def submit_slurm_job(self, input_job_id, script, slurm_params, msg=None):
+        if not script:
+            script = self.script_name
+        slurm = Slurm(**self.get_slurm_pars(self.get_job_name(input_job_id), slurm_params))
         if msg:
             msg['ExecutorType'] = 'CL_AGNT'
         cmd, time_out = self.get_runner_batch_cmd(input_job_id, script, msg)
-        slurm_job_id = slurm.sbatch(cmd)
+        with TRACER.span('submit_slurm_job', input_job_id=input_job_id), COMMAND_DURATION.time(command='sbatch'):
+            slurm_job_id = slurm.sbatch(cmd)
         self.logger.info('Submitted: {}, id: {}'.format(input_job_id, slurm_job_id))
         return slurm_job_id
 
+    def submit_pilot_job(self, script=None, slurm_params=None):
+        if not script:
+            script = config['PILOT_SCRIPT'] if 'PILOT_SCRIPT' in config else self.script_name
+        slurm_params = dict(slurm_params or {'RESOURCES_REQUIRED': config['SLURM_RESOURCES_REQUIRED'],
+                                             'JOB_TYPE': config['SLURM_JOB_TYPE']})
+        if 'SLURM_MEM' in config and 'MEM' not in slurm_params:
+            slurm_params['MEM'] = config['SLURM_MEM']
+        slurm_pars = self.get_slurm_pars(self.get_pilot_job_name(), slurm_params)
+        if 'PILOT_SLURM_TIME' in config:
+            slurm_pars['time'] = config['PILOT_SLURM_TIME']
+        slurm = Slurm(**slurm_pars)
+        cmd, time_out = self.get_runner_batch_cmd(PILOT_INPUT_ID, script)
+        with TRACER.span('submit_pilot_job'), COMMAND_DURATION.time(command='sbatch'):
+            slurm_job_id = slurm.sbatch(cmd)
+        self.logger.info('Submitted pilot, id: {}'.format(slurm_job_id))
+        return slurm_job_id
+
+    def submit_slurm_array(self, script, slurm_params, msgs):
+        if not script:
+            script = self.script_name
+        job_name = self.get_array_job_name()
+        slurm_pars = self.get_slurm_pars(job_name, slurm_params)
+        slurm_pars['array'] = '0-{}'.format(len(msgs) - 1)
+        slurm_pars['output'] = slurm_pars['output'].replace(Slurm.JOB_ARRAY_MASTER_ID, '{}_{}'.format(Slurm.JOB_ARRAY_MASTER_ID, Slurm.JOB_ARRAY_ID))
+        slurm = Slurm(**slurm_pars)
+        for msg in msgs:
+            msg['ExecutorType'] = 'CL_AGNT'
+        cmd, time_out = self.get_runner_batch_cmd(ARRAY_INPUT_ID, script)
+        cmd += ' cfg_file=' + self.write_job_config(msgs)
+        with TRACER.span('submit_slurm_array', jobs=len(msgs)), COMMAND_DURATION.time(command='sbatch'):
+            array_job_id = slurm.sbatch(cmd)
+        job_ids = ['{}_{}'.format(array_job_id, i) for i in range(len(msgs))]
+        for job_id, msg in zip(job_ids, msgs):
+            self.array_tasks[job_id] = msg['input_job_id']
+        self.logger.info('Submitted array of {} jobs, id: {}'.format(len(msgs), array_job_id))
+        return job_ids
+
     def slurm_check_jobs_waiting(self):
-        _, res, _ = self.run_command('squeue -o "%j %R %u" | grep ' + getpass.getuser() + ' | grep ' + self.job_name_suffix)
         waiting = 0
-        if res:
-            lines = res.splitlines()
-            for line in lines:
-                results = line.strip().split(" ")
-                jobname, status, user = results[:3]
-                if jobname.endswith(self.job_name_suffix) and status.startswith('(') and not status.startswith('(launch'):
-                    waiting += 1
+        for entry in self.queue_snapshot.jobs():
+            if SlurmQueueSnapshot.is_waiting(entry) and not entry.reason.startswith('(launch'):
+                waiting += 1
         return waiting
 
     @staticmethod
-    def slurm_get_idle_gpus(state='idle'):
-        _, res, _ = ClusterAgent.run_command('sinfo -o "%G %.3D %.6t %P" | grep ' + state + ' | grep gpu | grep ' + config['SLURM_PARTITION'] + "| awk '{print $1,$2}'")
-        if res:
-            lines = res.splitlines()
-            gpus = 0
-            for line in lines:
-                els = line.strip().split(" ")
-                gpus += int(els[0].split(":")[1].strip())*int(els[1].strip())
-            return gpus
-        else:
-            return 0
+    def get_partitions():
+        return [p.strip() for p in config['SLURM_PARTITION'].split(',')]
 
     @staticmethod
-    def slurm_get_idle_cpus():
-        _, res, _ = ClusterAgent.run_command(
-            'sinfo -o "%C %.3D %.6t %P" | grep idle | grep ' + config['SLURM_PARTITION'] + "| awk '{print $1,$2}'")
-        cpus = 0
-        if res:
-            lines = res.splitlines()
-            for line in lines:
-                els = line.strip().split(" ")
-                cpus += int(els[0].split("/")[1].strip())
-        _, res, _ = ClusterAgent.run_command(
-            'sinfo -o "%C %.3D %.6t %P" | grep mix | grep ' + config['SLURM_PARTITION'] + "| awk '{print $1,$2}'")
-        if res:
-            lines = res.splitlines()
-            for line in lines:
-                els = line.strip().split(" ")
-                cpus += int(els[0].split("/")[1].strip())
-        # Exclude cpus of excluded nodes
-        excl_cpus = 0
+    def get_excluded_nodes():
         if 'SLURM_EXCLUDE' in config and config['SLURM_EXCLUDE'] != '':
-            excl_cpus = ClusterAgent.slurm_get_idle_excluded_cpus()
-        return cpus - excl_cpus
+            return expand_hostlist(config['SLURM_EXCLUDE'])
+        return set()
 
-    @staticmethod
-    def slurm_get_idle_excluded_cpus():
-        excl_cpus = 0
-        for node in config['SLURM_EXCLUDE'].split(','):
-            _, res, _ = ClusterAgent.run_command(
-                'sinfo --Node --long | grep ' + node + ' | grep ' + config['SLURM_PARTITION'] + "| awk '{print $5}'")
-            if res:
-                lines = res.splitlines()
-                for line in lines:
-                    excl_cpus += int(line.strip())
-        return excl_cpus
+    def slurm_get_idle_gpus(self):
+        return self.node_snapshot.idle_gpus(self.get_partitions(), self.get_excluded_nodes())
+
+    def slurm_get_idle_cpus(self):
+        return self.node_snapshot.idle_cpus(self.get_partitions(), self.get_excluded_nodes())
+
+    def slurm_get_idle_excluded_cpus(self):
+        excluded = self.get_excluded_nodes()
+        return sum(n.cpus_total for n in self.node_snapshot.select(self.get_partitions(), available=False)
+                   if n.name in excluded)
 
 
 class DataUpdaterException(Exception):
@@ -0,0 +1,79 @@
+import sqlite3
+import time
+
+
+LEDGER_SUBMITTED = 'SUBMITTED'
+LOOKUP_CHUNK = 500
+
+
+class SubmissionLedger:
+    '''Local on-disk index of the submitted ids and their last known status
+
+       Filled by the submitter (ids it submitted) and synced from TOPIC_STATUS (the offsets read so far are
+       stored with it). While the ledger holds the whole history of TOPIC_STATUS (complete) an id missing
+       from it was never processed, otherwise only the ids found in the ledger have a certain answer.
+       '''
+
+    def __init__(self, path):
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT, updated INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS offsets (partition INTEGER PRIMARY KEY, next_offset INTEGER)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.conn.commit()
+
+    def get_offsets(self):
+        return dict(self.conn.execute('SELECT partition, next_offset FROM offsets'))
+
+    def is_complete(self):
+        row = self.conn.execute("SELECT value FROM meta WHERE key = 'complete'").fetchone()
+        return row is not None and row[0] == '1'
+
+    def set_complete(self, complete):
+        self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('complete', ?)", ('1' if complete else '0',))
+        self.conn.commit()
+
+    def update(self, statuses, offsets=None):
+        '''Store (id, status) pairs read from TOPIC_STATUS, a None status (deleted job) removes the id'''
+        now = int(time.time() * 1000)
+        self.conn.executemany('INSERT OR REPLACE INTO jobs (id, status, updated) VALUES (?, ?, ?)',
+                              [(s_id, status, now) for s_id, status in statuses if status is not None])
+        self.conn.executemany('DELETE FROM jobs WHERE id = ?', [(s_id,) for s_id, status in statuses if status is None])
+        if offsets:
+            self.conn.executemany('INSERT OR REPLACE INTO offsets (partition, next_offset) VALUES (?, ?)',
+                                  list(offsets.items()))
+        self.conn.commit()
+
+    def mark_submitted(self, ids, commit=True):
+        now = int(time.time() * 1000)
+        self.conn.executemany('INSERT OR REPLACE INTO jobs (id, status, updated) VALUES (?, ?, ?)',
+                              [(s_id, LEDGER_SUBMITTED, now) for s_id in ids])
+        if commit:
+            self.conn.commit()
+
+    def forget_submitted(self, ids):
+        # ids marked as submitted whose messages Kafka did not accept, ids that got a status since are kept
+        self.conn.executemany('DELETE FROM jobs WHERE id = ? AND status = ?', [(s_id, LEDGER_SUBMITTED) for s_id in ids])
+        self.conn.commit()
+
+    def commit(self):
+        self.conn.commit()
+
+    def get(self, ids):
+        statuses = {}
+        ids = list(ids)
+        for i in range(0, len(ids), LOOKUP_CHUNK):
+            chunk = ids[i:i + LOOKUP_CHUNK]
+            statuses.update(self.conn.execute('SELECT id, status FROM jobs WHERE id IN ({})'.format(
+                ','.join('?' * len(chunk))), chunk))
+        return statuses
+
+    def lookup(self, ids):
+        '''Return the statuses known for sure ({id: status or None}) and the list of ids still to be checked'''
+        statuses = self.get(ids)
+        if self.is_complete():
+            return {s_id: statuses.get(s_id) for s_id in ids}, []
+        return statuses, [s_id for s_id in ids if s_id not in statuses]
+
+    def close(self):
+        self.conn.close()
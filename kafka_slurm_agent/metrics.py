@@ -0,0 +1,201 @@
+import bisect
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+
+def format_value(value):
+    if value is None or (isinstance(value, float) and math.isnan(value)):
+        return 'NaN'
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')) for name, value in zip(names, values)) + '}'
+
+
+class Metric:
+    '''A metric family in the Prometheus text format, the values are kept per tuple of label values'''
+    type = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    def key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('{} needs the labels {}, got {}'.format(self.name, self.labelnames, tuple(labels)))
+        return tuple(labels[name] for name in self.labelnames)
+
+    def samples(self):
+        '''Yield (suffix, label names, label values, value)'''
+        with self.lock:
+            values = list(self.values.items())
+        for key, value in values:
+            yield '', self.labelnames, key, value
+
+    def expose(self):
+        lines = ['# HELP {} {}'.format(self.name, self.documentation.replace('\\', '\\\\').replace('\n', '\\n')),
+                 '# TYPE {} {}'.format(self.name, self.type)]
+        for suffix, names, values, value in self.samples():
+            lines.append('{}{}{} {}'.format(self.name, suffix, format_labels(names, values), format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    '''A value that goes up and down, set directly or read from func (called with no arguments) at every scrape
+
+       func returns a number or, for a gauge with labels, a dict of {tuple of label values: number}.
+       '''
+    type = 'gauge'
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        super(Gauge, self).__init__(name, documentation, labelnames)
+        self.func = func
+
+    def set(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def samples(self):
+        if self.func is None:
+            yield from super(Gauge, self).samples()
+            return
+        try:
+            value = self.func()
+        except Exception:
+            # a failing callback must not break the whole page
+            value = None
+        values = value.items() if isinstance(value, dict) else [((), value)]
+        for key, value in values:
+            yield '', self.labelnames, key, value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # one count per bucket (the last one is +Inf) and the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[i] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def samples(self):
+        with self.lock:
+            values = [(key, list(counts)) for key, counts in self.values.items()]
+        names = self.labelnames + ('le',)
+        for key, counts in values:
+            total = 0
+            for bound, n in zip(self.buckets + (math.inf,), counts):
+                total += n
+                yield '_bucket', names, key + (format_value(bound),), total
+            yield '_count', self.labelnames, key, total
+            yield '_sum', self.labelnames, key, counts[-1]
+
+
+class Registry:
+    '''Metric families exposed on the /metrics page of an agent
+
+       counter, gauge and histogram return the family already registered under the name, so modules and
+       agent subclasses can declare the metrics they use independently.
+       '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.metrics = {}
+
+    def register(self, metric):
+        with self.lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if type(existing) is not type(metric) or existing.labelnames != metric.labelnames:
+                    raise ValueError('Metric {} is already registered as a different {}'.format(
+                        metric.name, existing.type))
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def unregister(self, name):
+        with self.lock:
+            return self.metrics.pop(name, None)
+
+    def counter(self, name, documentation, labelnames=()):
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=(), func=None):
+        gauge = self.register(Gauge(name, documentation, labelnames, func))
+        if func is not None:
+            # the latest callback wins, e.g. after the agent was created again
+            gauge.func = func
+        return gauge
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def expose(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.expose() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+# Slurm and other commands run through command.Command (or simple_slurm for sbatch)
+COMMAND_TYPES = ['squeue', 'sinfo', 'sbatch', 'scancel', 'sacct', 'scontrol']
+COMMAND_DURATION = REGISTRY.histogram('ksa_command_duration_seconds', 'Time of the Slurm commands by command',
+                                      ['command'])
+
+
+def get_command_type(cmd):
+    '''Slurm command run by a command line or None for other commands'''
+    words = cmd.split(None, 1)
+    name = words[0].rsplit('/', 1)[-1] if words else None
+    return name if name in COMMAND_TYPES else None
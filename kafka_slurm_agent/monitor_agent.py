@@ -1,8 +1,18 @@
+import asyncio
+import heapq
+import json
+import os
 import socket
 import faust
+from aiohttp.web import StreamResponse
 
-from kafka_slurm_agent.kafka_modules import setupLogger, config
-from kafka_slurm_agent.command import Command
+from kafka_slurm_agent.kafka_modules import setupLogger, config, JobStatus, StatusCounters, SortedKeyIndex, ConsumerLag, \
+    LatencyTracker, TERMINAL_STATUSES, now_ms, start_profiler
+# re-exported for the done_topic agents of my_monitor_agent.py (see runner.py)
+from kafka_slurm_agent.kafka_modules import resolve_results, open_results  # noqa: F401
+from kafka_slurm_agent.status_archive import StatusArchive
+from kafka_slurm_agent.metrics import REGISTRY, CONTENT_TYPE
+from kafka_slurm_agent.serializers import register_faust_codec
 #from concurrent.futures import ThreadPoolExecutor
 
 app = faust.App(config['MONITOR_AGENT_NEW_GROUP'] if 'MONITOR_AGENT_NEW_GROUP' in config else socket.gethostname() + '_monitor_agent_new',
@@ -12,27 +22,146 @@ app = faust.App(config['MONITOR_AGENT_NEW_GROUP'] if 'MONITOR_AGENT_NEW_GROUP' i
                 #group_id=config['MONITOR_AGENT_NEW_GROUP'],
                 #processing_guarantee='exactly_once',
                 heartbeat_interval_ms=config['MONITOR_HEARTBEAT_INTERVAL_MS'],
+                store=config['TABLE_STORE'],
+                datadir=config['TABLE_DATA_DIR'],
                 topic_partitions=1)
 
-#store='rocksdb://',
 logger = setupLogger(config['LOGS_DIR'], "monitor_agent")
-jobs_topic = app.topic(config['TOPIC_STATUS'])
-done_topic = app.topic(config['TOPIC_DONE'], partitions=1)
-error_topic = app.topic(config['TOPIC_ERROR'], partitions=1)
-new_topic = app.topic(config['TOPIC_NEW'])
-heartbeat_topic = app.topic(config['TOPIC_HEARTBEAT'])
+# reads messages of all serializers (KAFKA_SERIALIZER) of the senders
+codec = register_faust_codec()
+jobs_topic = app.topic(config['TOPIC_STATUS'], value_serializer=codec)
+done_topic = app.topic(config['TOPIC_DONE'], partitions=1, value_serializer=codec)
+error_topic = app.topic(config['TOPIC_ERROR'], partitions=1, value_serializer=codec)
+new_topic = app.topic(config['TOPIC_NEW'], value_serializer=codec)
+heartbeat_topic = app.topic(config['TOPIC_HEARTBEAT'], value_serializer=codec)
 job_status = app.Table('job_status', default='')
+# written from both TOPIC_NEW and TOPIC_STATUS so the changelog partition comes from the key
+job_lifecycle = app.Table('job_lifecycle', default='', use_partitioner=True)
+counters = StatusCounters()
+# ids of job_status in order for the pages of stats/
+status_keys = SortedKeyIndex()
+latency = LatencyTracker()
+consumer_lag = ConsumerLag(logger=logger)
+# finished jobs older than STATUS_ARCHIVE_AGE are moved from job_status to the archive
+archive = StatusArchive(config['STATUS_ARCHIVE_PATH']) \
+    if config['STATUS_ARCHIVE_AGE'] is not None or os.path.isfile(config['STATUS_ARCHIVE_PATH']) else None
+# ids in the archive, so that the status events of new jobs do not query it
+archived_ids = None
+# no jobs are moved to the archive between reading its counts and the table for the counters
+archive_lock = asyncio.Lock()
 #stats_thread_pool = ThreadPoolExecutor(max_workers=1)
 
+
+async def rebuild_counters():
+    async with archive_lock:
+        if counters.ready:
+            return
+        archived = await app.loop.run_in_executor(None, archive.counts) if archive is not None else None
+        counters.rebuild(job_status, archived)
+
+
+async def load_archived_ids():
+    global archived_ids
+    if archived_ids is None:
+        ids = await app.loop.run_in_executor(None, archive.ids)
+        if archived_ids is None:
+            archived_ids = ids
+    return archived_ids
+
+
+async def pop_archived(key):
+    # an archived job that gets a new status (e.g. it was resubmitted) goes back to job_status
+    if archive is None or key not in await load_archived_ids():
+        return None
+    archived_ids.discard(key)
+    value = (await app.loop.run_in_executor(None, archive.get, [key])).get(key)
+    if value is not None:
+        await app.loop.run_in_executor(None, archive.delete, [key])
+    return JobStatus.from_value(value)
+
+
+def track(key, status, timestamp, cluster=None):
+    if not latency.ready:
+        latency.rebuild(job_lifecycle)
+    lifecycle = latency.update(job_lifecycle[key] if key in job_lifecycle else None, status, timestamp, cluster)
+    if lifecycle is not None:
+        job_lifecycle[key] = lifecycle
+
+
 @app.agent(jobs_topic)
 async def process_jobs(stream):
     async for event in stream.events():
-        job_status[event.key.decode('UTF-8')] = event.value
+        key = event.key.decode('UTF-8')
+        if not counters.ready:
+            await rebuild_counters()
+        value = JobStatus.from_value(event.value)
+        counters.update(job_status[key] if key in job_status else await pop_archived(key), value)
+        job_status[key] = value
+        if value is not None:
+            status_keys.add(key)
+            track(key, value.status, value.timestamp, value.cluster)
+        else:
+            status_keys.discard(key)
+            if key in job_lifecycle:
+                del job_lifecycle[key]
+
+
+@app.agent(new_topic)
+async def process_new(stream):
+    # the time a job was sent is the timestamp of its message
+    async for event in stream.events():
+        if event.key is not None:
+            track(event.key.decode('UTF-8'), 'NEW', int(event.message.timestamp * 1000))
+
+
+def get_archived_value(key, js):
+    value = js.to_dict()
+    if key in job_lifecycle:
+        value['lifecycle'] = job_lifecycle[key]
+    return value
+
+
+@app.timer(interval=config['STATUS_ARCHIVE_INTERVAL'])
+async def archive_statuses():
+    if archive is None or config['STATUS_ARCHIVE_AGE'] is None:
+        return
+    before = now_ms() - config['STATUS_ARCHIVE_AGE'] * 1000
+    ids = await load_archived_ids()
+    keys = list(job_status.keys())
+    chunk_size = config['MONITOR_STATS_CHUNK_SIZE']
+    archived = 0
+    for i in range(0, len(keys), chunk_size):
+        old = []
+        for key in keys[i:i + chunk_size]:
+            js = JobStatus.from_value(job_status[key]) if key in job_status else None
+            if js is not None and js.status_name in TERMINAL_STATUSES and js.timestamp is not None \
+                    and js.timestamp < before:
+                old.append((key, js))
+        if old:
+            async with archive_lock:
+                await app.loop.run_in_executor(None, archive.put, [(key, get_archived_value(key, js)) for key, js in old])
+                changed = []
+                for key, js in old:
+                    # the job may have got a new status while it was written to the archive
+                    if key in job_status and JobStatus.from_value(job_status[key]) == js:
+                        del job_status[key]
+                        status_keys.discard(key)
+                        if key in job_lifecycle:
+                            del job_lifecycle[key]
+                        ids.add(key)
+                        archived += 1
+                    else:
+                        changed.append(key)
+                if changed:
+                    await app.loop.run_in_executor(None, archive.delete, changed)
+        await asyncio.sleep(0)
+    if archived:
+        logger.info('Archived {} finished jobs'.format(archived))
 
 
 @app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'done/')
 async def get_stats_done(web, request):
-    cur, log_end, lag = get_monitor_processed()
+    cur, log_end, lag = await app.loop.run_in_executor(None, get_monitor_processed)
     return web.json({
             'done': {'current': cur, 'all': log_end, 'lag': lag}
         })
@@ -40,89 +169,201 @@ async def get_stats_done(web, request):
 
 @app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'sum/')
 async def get_stats(web, request):
-    done = 0
-    running = 0
-    error = 0
-    waiting = 0
-    timedout = 0
-    submitted = 0
-    new_waiting, new_done, new_all = get_new()
-    for key in job_status.keys():
-        if job_status[key]['status'] == 'DONE':
-            done += 1
-        elif job_status[key]['status'] == 'ERROR':
-            error += 1
-        elif job_status[key]['status'] == 'SUBMITTED':
-            submitted += 1
-        elif job_status[key]['status'] == 'WAITING':
-            waiting += 1
-        elif job_status[key]['status'] == 'TIMEOUT':
-            timedout += 1
-        else:
-            running += 1
+    new_waiting, new_done, new_all = await app.loop.run_in_executor(None, get_new)
+    if not counters.ready:
+        await rebuild_counters()
     return web.json({
-        'jobs': {'submitted': submitted, 'waiting': waiting, 'running': running, 'done': done, 'timeout': timedout, 'error': error},
-        'new': {'waiting': new_waiting, 'processed': new_done, 'all':  new_all}
+        'jobs': counters.summary(),
+        'new': {'waiting': new_waiting, 'processed': new_done, 'all':  new_all},
+        'clusters': counters.clusters,
+        'nodes': counters.nodes,
     })
 
 
+def check_status(input_job_id):
+    if input_job_id in job_status:
+        return JobStatus.from_value(job_status[input_job_id]) or ''
+    return ''
+
+
+async def check_statuses(ids):
+    statuses = {input_job_id: check_status(input_job_id) for input_job_id in ids}
+    missing = [input_job_id for input_job_id, js in statuses.items() if not isinstance(js, JobStatus)]
+    if missing and archive is not None:
+        archived = await app.loop.run_in_executor(None, archive.get, missing)
+        statuses.update((input_job_id, JobStatus.from_value(value)) for input_job_id, value in archived.items())
+    return statuses
+
+
 @app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'check/{input_job_id}/')
 async def get_stats(web, request, input_job_id):
-    if input_job_id in job_status:
-        result = job_status[input_job_id]
-    else:
-        result = ''
-    return web.json({
-        input_job_id: result,
-    })
+    return web.json(await check_statuses([input_job_id]))
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'check/')
+class CheckStatuses(faust.web.View):
+    # Bulk version of check/{input_job_id}/ - POST a JSON list of ids, used by JobSubmitter.send_many
+    async def post(self, request):
+        ids = await request.json()
+        return self.json(await check_statuses(ids))
+
+
+def get_stats_filters(query):
+    filters = {}
+    for field in ['status', 'cluster', 'node']:
+        if query.get(field):
+            filters[field] = set(query[field].split(','))
+    for field in ['since', 'until']:
+        if query.get(field):
+            # epoch milliseconds or a TIMESTAMP_FORMAT date
+            value = query[field]
+            filters[field] = int(value) if value.isdigit() else JobStatus.parse_timestamp(value)
+    return filters
+
+
+def matches(js, filters):
+    if js is None:
+        return False
+    if 'status' in filters and js.status_name not in filters['status']:
+        return False
+    if 'cluster' in filters and js.cluster not in filters['cluster']:
+        return False
+    if 'node' in filters and js.node not in filters['node']:
+        return False
+    if 'since' in filters and (js.timestamp is None or js.timestamp < filters['since']):
+        return False
+    if 'until' in filters and (js.timestamp is None or js.timestamp >= filters['until']):
+        return False
+    return True
+
+
+async def select_statuses(filters, cursor, limit, chunk_size):
+    # a page of the matching jobs with ids after the cursor in id order, the ids are read from the cursor on
+    # in chunks so that process_jobs keeps running in between, until the page is full
+    if not status_keys.ready:
+        status_keys.rebuild(job_status.keys())
+    keys, i = status_keys.after(cursor)
+    page = []
+    while i < len(keys) and len(page) < limit:
+        for key in keys[i:i + chunk_size]:
+            js = JobStatus.from_value(job_status[key]) if key in job_status else None
+            if matches(js, filters):
+                page.append((key, js))
+        i += chunk_size
+        await asyncio.sleep(0)
+    page = page[:limit]
+    if archive is not None:
+        archived = await app.loop.run_in_executor(None, lambda: archive.select(
+            filters.get('status'), filters.get('cluster'), filters.get('node'), filters.get('since'),
+            filters.get('until'), cursor, limit))
+        page = heapq.nsmallest(limit, page + [(key, JobStatus.from_value(value)) for key, value in archived
+                                              if key not in job_status], key=lambda el: el[0])
+    return page
 
 
 @app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'stats/')
 async def get_stat(web, request):
-      statuses = {}
-      for key in job_status.keys():
-          statuses[key] = job_status[key]
-      return web.json({
-          'result': statuses,
-      })
+    '''Statuses of the jobs as NDJSON, one {"id": ..., "status": ...} object per line, ordered by id
+
+       Query parameters: status, cluster, node (comma separated values), since, until (epoch ms or
+       TIMESTAMP_FORMAT), limit (MONITOR_STATS_PAGE_SIZE by default) and cursor - the X-Next-Cursor header
+       of the previous page, it is only set when there may be more jobs. Archived jobs are included.
+       '''
+    try:
+        filters = get_stats_filters(request.query)
+        limit = int(request.query.get('limit', config['MONITOR_STATS_PAGE_SIZE']))
+        if limit <= 0:
+            raise ValueError('limit must be positive')
+    except ValueError as e:
+        return web.json({'error': str(e)}, status=400)
+    chunk_size = config['MONITOR_STATS_CHUNK_SIZE']
+    page = await select_statuses(filters, request.query.get('cursor'), limit, chunk_size)
+    response = StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+    if page and len(page) == limit:
+        response.headers['X-Next-Cursor'] = page[-1][0]
+    await response.prepare(request)
+    for i in range(0, len(page), chunk_size):
+        lines = [json.dumps(dict(id=key, **js.to_dict())) for key, js in page[i:i + chunk_size]]
+        await response.write(('\n'.join(lines) + '\n').encode('utf-8'))
+        await asyncio.sleep(0)
+    await response.write_eof()
+    return response
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'latency/')
+async def get_latency(web, request):
+    # p50, p95 and p99 in ms of the phases of the jobs (see LatencyTracker) per cluster, ?cluster= to select one
+    if not latency.ready:
+        latency.rebuild(job_lifecycle)
+    return web.json(latency.summary(request.query.get('cluster')))
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'lifecycle/{input_job_id}/')
+async def get_lifecycle(web, request, input_job_id):
+    lifecycle = job_lifecycle[input_job_id] if input_job_id in job_lifecycle else None
+    if lifecycle is None and archive is not None:
+        archived = await app.loop.run_in_executor(None, archive.get, [input_job_id])
+        lifecycle = archived.get(input_job_id, {}).get('lifecycle')
+    return web.json({
+        input_job_id: lifecycle or '',
+    })
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'lag/')
+async def get_lag(web, request):
+    new_lag, done_lag = await app.loop.run_in_executor(None, get_lags)
+    return web.json({
+        'new': new_lag,
+        'done': done_lag,
+    })
+
+
+@app.timer(interval=config['CONSUMER_LAG_TTL'])
+async def refresh_lags():
+    # keeps the cached offsets warm so that sum/, done/ and lag/ do not wait for Kafka
+    await app.loop.run_in_executor(None, get_lags)
+
+
+def get_lags():
+    # offsets of the cluster agents on the new jobs and of this monitor on the done jobs, per partition
+    return (consumer_lag.get(config['CLUSTER_AGENT_NEW_GROUP'], config['TOPIC_NEW']),
+            consumer_lag.get(app.conf.id, config['TOPIC_DONE']))
+
+
+def get_cached_lags():
+    # read at every scrape of metrics/ - only the cached offsets, refresh_lags keeps them up to date
+    return {key: lag['lag'] for key, lag in list(consumer_lag.cache.items()) if lag is not None}
+
+
+REGISTRY.gauge('ksa_consumer_group_lag', 'Messages not yet read by a consumer group, as of the last offsets check',
+               ['group', 'topic'], func=get_cached_lags)
+REGISTRY.gauge('ksa_jobs', 'Jobs in the job_status table and in the archive by status', ['status'],
+               func=lambda: {(status,): n for status, n in counters.statuses.items()})
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'metrics')
+async def get_metrics(web, request):
+    if not counters.ready:
+        await rebuild_counters()
+    return web.text(REGISTRY.expose(), headers={'Content-Type': CONTENT_TYPE})
+
+
+@app.page(config['MONITOR_AGENT_CONTEXT_PATH'] + 'profile/')
+async def get_profile(web, request):
+    # ?seconds=N samples the stacks of the agent for N seconds into a file in LOGS_DIR
+    result, status = start_profiler(logger.name, request.query.get('seconds'))
+    return web.json(result, status=status)
 
 
 def get_new():
-    if 'BOOTSTRAP_SERVERS_LOCAL' not in config:
-        config['BOOTSTRAP_SERVERS_LOCAL'] = config['BOOTSTRAP_SERVERS']
-    cmd = config['KAFKA_HOME'] + "/bin/kafka-consumer-groups.sh --bootstrap-server " + config['BOOTSTRAP_SERVERS_LOCAL'] + " --describe --group " + config['CLUSTER_AGENT_NEW_GROUP'] + "| grep " + config['TOPIC_NEW'] + "| awk {'printf (\"%s %s %s\\n\", $4, $5, $6)'}"
-    comd = Command(cmd)
-    comd.run(10)
-    res = comd.getOut()
-    waiting = 0
-    all = 0
-    running_done = 0
-    if res:
-        lines = res.splitlines()
-        for line in lines:
-            try:
-                run_done, done, left = line.split(' ')
-                running_done += int(run_done)
-                waiting += int(left)
-                all += int(done)
-            except Exception as e:
-                logger.error('Problem in checking new: {}'.format(e))
-    return waiting, running_done, all
+    lag = consumer_lag.get(config['CLUSTER_AGENT_NEW_GROUP'], config['TOPIC_NEW'])
+    if lag is None:
+        return 0, 0, 0
+    return lag['lag'], lag['current'], lag['end']
 
 
 def get_monitor_processed():
-    if 'BOOTSTRAP_SERVERS_LOCAL' not in config:
-        config['BOOTSTRAP_SERVERS_LOCAL'] = config['BOOTSTRAP_SERVERS']
-    cmd = config['KAFKA_HOME'] + "/bin/kafka-consumer-groups.sh --bootstrap-server " + config['BOOTSTRAP_SERVERS_LOCAL'] + " --describe --group " + config['MONITOR_AGENT_NEW_GROUP'] + "| grep " + config['TOPIC_DONE'] + "| awk '{print $4, $5, $6}'"
-    comd = Command(cmd)
-    comd.run(10)
-    res = comd.getOut()
-    cur = None
-    log_end = None
-    lag = None
-    if res:
-        results = res.split(' ')
-        cur = int(results[0].strip())
-        log_end = int(results[1].strip())
-        lag = int(results[2].strip())
-    return cur, log_end, lag
+    lag = consumer_lag.get(app.conf.id, config['TOPIC_DONE'])
+    if lag is None:
+        return None, None, None
+    return lag['current'], lag['end'], lag['lag']
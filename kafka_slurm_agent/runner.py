@@ -13,12 +13,13 @@ CONFIG_FILE = 'kafkaslurm_cfg.py__'
 
 SCRIPTS = {
     'start_cluster_agent': '#!/bin/bash\nfaust -A kafka_slurm_agent.cluster_agent -l info worker\n',
-    'my_monitor_agent.py': "from kafka_slurm_agent.monitor_agent import app, job_status, done_topic\n\n"
+    'my_monitor_agent.py': "from kafka_slurm_agent.monitor_agent import app, job_status, done_topic, resolve_results\n\n"
                         "#TODO Put your monitor agent code here\n\n\n"
                         "@app.agent(done_topic)\n"
                         "async def process_done(stream):\n"
                         "    async for msg in stream.events():\n"
-                        "        print('Got {}: {}'.format(msg.key, msg.value))\n",
+                        "        # results larger than RESULTS_OFFLOAD_THRESHOLD are loaded from the blob store\n"
+                        "        print('Got {}: {}'.format(msg.key, resolve_results(msg.value)))\n",
     # 'my_cluster_agent.py': "from kafka_slurm_agent.kafka_modules import ClusterAgent\n\n"
     #                        "class MyClusterAgent(ClusterAgent):\n"
     #                        "\tdef __init__(self):\n"
@@ -37,15 +38,19 @@ SCRIPTS = {
                            "        return str(input_job_id) + self.job_name_suffix\n",
     'start_monitor_agent': '#!/bin/bash\nfaust -A my_monitor_agent -l info worker -p 6067\n',
     'start_worker_agent': '#!/bin/bash\nfaust -A kafka_slurm_agent.worker_agent -l info worker -p 6068\n',
+    'start_status_relay': '#!/bin/bash\n# Optional - run on a compute node so that its jobs share one Kafka producer\n'
+                          'python -m kafka_slurm_agent.status_relay\n',
     'submitter.py': "from kafka_slurm_agent.kafka_modules import JobSubmitter\n\n"
                     "js = JobSubmitter()\n"
                     "job_ids = ['job_id_1', 'job_id_2']\n"
                     "# check (default: True) - don't submit if was already computed\n"
                     "# ignore_error_status (default: False) - don't submit if previously generated an error\n"
                     "results = js.send_many(job_ids, 'run.py', {'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu'}, ignore_error_status=True, check=False)\n"
-                    "print(results)\n",
+                    "print(results)\n"
+                    "# For millions of ids pass a generator to send_stream, it returns a summary with the delivery errors and throughput\n"
+                    "# summary = js.send_stream(('job_id_{}'.format(i) for i in range(1000000)), 'run.py', check=False)\n",
     'run.py':   "import sys\n"
-                "from kafka_slurm_agent.kafka_modules import ClusterComputing\n\n\n"
+                "from kafka_slurm_agent.kafka_modules import ClusterComputing, PilotRunner, PILOT_INPUT_ID\n\n\n"
                 "class MyComputing(ClusterComputing):\n"
                 "    def __init__(self, args):\n"
                 "        super().__init__(args)\n"
@@ -59,7 +64,11 @@ SCRIPTS = {
                 "        print('Sent results: {}'.format(self.results))\n\n\n"
                 "if __name__ == '__main__':\n"
                 "    # To test it during development run this python script proving the input_job_id as input parameter. i.e.: python run.py 0001\n"
-                "    MyComputing(sys.argv).compute()\n"
+                "    if sys.argv[1] == PILOT_INPUT_ID:\n"
+                "        # Pilot job (SLURM_PILOT_JOBS) - run many jobs in this process\n"
+                "        PilotRunner(MyComputing(sys.argv)).run()\n"
+                "    else:\n"
+                "        MyComputing(sys.argv).compute()\n"
 }
 
 START_SCRIPTS = ['monitor_agent', 'cluster_agent', 'worker_agent']
@@ -0,0 +1,87 @@
+import json
+from collections import namedtuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:  # pragma: no cover
+    msgpack = None
+
+
+JSON_CONTENT_TYPE = 'application/json'
+MSGPACK_CONTENT_TYPE = 'application/msgpack'
+FAUST_CODEC = 'ksa'
+
+Serializer = namedtuple('Serializer', ['name', 'content_type', 'dumps', 'loads'])
+
+serializers = {}
+content_types = {}
+
+
+def register_serializer(name, content_type, dumps, loads):
+    '''Register a serializer for the KAFKA_SERIALIZER config key
+
+       dumps turns a message (a dict or None) into bytes, loads does the opposite.
+       The first serializer registered for a content type is used to decode it.
+       '''
+    serializers[name] = Serializer(name, content_type, dumps, loads)
+    content_types.setdefault(content_type, serializers[name])
+    return serializers[name]
+
+
+def get_serializer(name):
+    if name not in serializers:
+        raise ValueError('Unknown serializer {} (is the package installed?), available: {}'.format(
+            name, ', '.join(serializers)))
+    return serializers[name]
+
+
+def loads(data, content_type=None):
+    '''Decode a message of any registered content type
+
+       Kafka messages carry no content type, it is guessed from the first byte: all messages are maps or null
+       and those start with a byte >= 0x80 in msgpack and with an ASCII character in JSON. Offloaded results
+       pass the content type recorded in their pointer.
+       '''
+    if data is None:
+        return None
+    if content_type is None:
+        content_type = MSGPACK_CONTENT_TYPE if data and data[0] >= 0x80 else JSON_CONTENT_TYPE
+    return content_types[content_type].loads(data)
+
+
+def orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # the json serializer writes NaN and Infinity, which orjson rejects
+        return json.loads(data)
+
+
+# orjson goes first so that it decodes all JSON messages when it is installed
+if orjson is not None:
+    register_serializer('orjson', JSON_CONTENT_TYPE, orjson.dumps, orjson_loads)
+register_serializer('json', JSON_CONTENT_TYPE, lambda v: json.dumps(v).encode('utf-8'), json.loads)
+if msgpack is not None:
+    register_serializer('msgpack', MSGPACK_CONTENT_TYPE, lambda v: msgpack.packb(v, use_bin_type=True),
+                        lambda v: msgpack.unpackb(v, raw=False))
+
+
+def register_faust_codec():
+    '''Register the "ksa" faust codec reading messages of any registered content type'''
+    from faust.serializers import codecs
+    from faust.utils import json as faust_json
+
+    class KsaCodec(codecs.Codec):
+        def _loads(self, s):
+            return loads(s)
+
+        def _dumps(self, s):
+            return codecs.want_bytes(faust_json.dumps(s))
+
+    codecs.register(FAUST_CODEC, KsaCodec())
+    return FAUST_CODEC
@@ -0,0 +1,255 @@
+import threading
+import time
+from collections import namedtuple
+
+from kafka_slurm_agent.command import Command
+
+
+SLURM_DELIMITER = '|'
+
+SlurmQueueEntry = namedtuple('SlurmQueueEntry', ['job_id', 'state', 'reason', 'run_time', 'user', 'name'])
+
+
+class SlurmException(Exception):
+    pass
+
+
+class SlurmSnapshot:
+    '''Cached result of a single Slurm query shared by all readers until it expires
+
+       ttl: float - (seconds) - how long a loaded snapshot is considered fresh
+       timeout: int - (seconds) - how long to wait for the Slurm command
+       '''
+
+    def __init__(self, ttl=5.0, timeout=20):
+        self.ttl = ttl
+        self.timeout = timeout
+        self.loaded_at = None
+        self.lock = threading.RLock()
+
+    def get_cmd(self):
+        raise NotImplementedError
+
+    def query(self):
+        comd = Command(self.get_cmd())
+        comd.run(self.timeout)
+        if comd.getReturnCode() != 0:
+            raise SlurmException('{} failed with code {}: {}'.format(self.get_cmd(), comd.getReturnCode(),
+                                                                     comd.getError()))
+        return comd.getOut() or ''
+
+    def load(self, output):
+        raise NotImplementedError
+
+    def is_fresh(self):
+        return self.loaded_at is not None and time.monotonic() - self.loaded_at < self.ttl
+
+    def refresh(self):
+        with self.lock:
+            self.load(self.query())
+            self.loaded_at = time.monotonic()
+        return self
+
+    def get(self):
+        with self.lock:
+            if not self.is_fresh():
+                self.refresh()
+        return self
+
+    def invalidate(self):
+        self.loaded_at = None
+
+
+class SlurmQueueSnapshot(SlurmSnapshot):
+    '''One squeue call per cycle indexed by job id and job name
+
+       user: string - only list jobs of this user
+       name_suffix: string - only keep jobs whose name ends with this suffix (None keeps all)
+       '''
+
+    FIELDS = '%i|%T|%M|%u|%R|%j'
+
+    def __init__(self, user, name_suffix=None, ttl=5.0, timeout=20):
+        super(SlurmQueueSnapshot, self).__init__(ttl=ttl, timeout=timeout)
+        self.user = user
+        self.name_suffix = name_suffix
+        self.entries = []
+        self.by_id = {}
+        self.by_name = {}
+
+    def get_cmd(self):
+        # --array lists every pending array task on its own line as jobid_taskid
+        return 'squeue --noheader --array --user {} -o "{}"'.format(self.user, self.FIELDS)
+
+    @staticmethod
+    def parse(output):
+        entries = []
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            # the job name goes last so that it may contain the delimiter
+            job_id, state, run_time, user, reason, name = line.strip().split(SLURM_DELIMITER, 5)
+            entries.append(SlurmQueueEntry(job_id, state, reason, run_time, user, name))
+        return entries
+
+    def load(self, output):
+        entries = [e for e in self.parse(output) if not self.name_suffix or e.name.endswith(self.name_suffix)]
+        self.entries = entries
+        self.by_id = {e.job_id: e for e in entries}
+        self.by_name = {e.name: e for e in entries}
+
+    def get_job(self, job_id):
+        return self.get().by_id.get(str(job_id))
+
+    def get_job_by_name(self, name):
+        return self.get().by_name.get(name)
+
+    def jobs(self):
+        return list(self.get().entries)
+
+    @staticmethod
+    def is_waiting(entry):
+        return entry.reason.startswith('(')
+
+
+SlurmNode = namedtuple('SlurmNode', ['name', 'partitions', 'state', 'cpus_alloc', 'cpus_idle', 'cpus_total',
+                                     'memory', 'alloc_mem', 'free_mem', 'gres', 'gres_used'])
+
+
+def split_outside_brackets(value, sep=','):
+    parts = []
+    depth = 0
+    cur = ''
+    for c in value:
+        if c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        if c == sep and depth == 0:
+            parts.append(cur)
+            cur = ''
+        else:
+            cur += c
+    if cur:
+        parts.append(cur)
+    return parts
+
+
+def expand_hostlist(hostlist):
+    '''Expand a Slurm hostlist such as "node[1-3,7],gpu01" into a set of node names'''
+    nodes = set()
+    for part in split_outside_brackets(hostlist or ''):
+        part = part.strip()
+        if '[' not in part:
+            if part:
+                nodes.add(part)
+            continue
+        prefix, rest = part.split('[', 1)
+        ranges, suffix = rest.split(']', 1)
+        for rng in ranges.split(','):
+            if '-' in rng:
+                start, end = rng.split('-')
+                for i in range(int(start), int(end) + 1):
+                    nodes.add('{}{}{}'.format(prefix, str(i).zfill(len(start)), suffix))
+            else:
+                nodes.add(prefix + rng + suffix)
+    return nodes
+
+
+def parse_gres(gres):
+    '''Parse "gpu:tesla:4(S:0-1),shard:8" into {'gpu': 4, 'shard': 8}'''
+    counts = {}
+    if not gres or gres == '(null)':
+        return counts
+    for item in split_outside_brackets(gres):
+        item = item.split('(')[0]
+        els = item.split(':')
+        if len(els) < 2 or not els[-1].isdigit():
+            continue
+        counts[els[0]] = counts.get(els[0], 0) + int(els[-1])
+    return counts
+
+
+def to_int(value):
+    try:
+        return int(value)
+    except ValueError:
+        return 0
+
+
+class SlurmNodeSnapshot(SlurmSnapshot):
+    '''One sinfo --Node call per cycle holding the capacity of every node.
+
+       Partition filtering and node exclusion are done in memory so the number of Slurm calls
+       does not depend on the number of excluded nodes.
+       '''
+
+    FIELDS = ['NodeList:64', 'Partition:32', 'StateCompact:16', 'CPUsState:32', 'Memory:16', 'AllocMem:16',
+              'FreeMem:16', 'Gres:128', 'GresUsed:128']
+    AVAILABLE_STATES = ['idle', 'mix']
+
+    def __init__(self, ttl=5.0, timeout=20):
+        super(SlurmNodeSnapshot, self).__init__(ttl=ttl, timeout=timeout)
+        self.nodes = {}
+
+    def get_cmd(self):
+        return 'sinfo --Node --noheader -O "{}"'.format(','.join(f + SLURM_DELIMITER for f in self.FIELDS))
+
+    @staticmethod
+    def parse(output):
+        nodes = {}
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            name, partition, state, cpus, memory, alloc_mem, free_mem, gres, gres_used = \
+                [el.strip() for el in line.split(SLURM_DELIMITER)[:9]]
+            partition = partition.rstrip('*')
+            if name in nodes:
+                nodes[name].partitions.add(partition)
+                continue
+            # CPUsState is allocated/idle/other/total
+            cpus_alloc, cpus_idle, _, cpus_total = [to_int(c) for c in cpus.split('/')]
+            nodes[name] = SlurmNode(name, {partition}, state, cpus_alloc, cpus_idle, cpus_total, to_int(memory),
+                                    to_int(alloc_mem), to_int(free_mem), parse_gres(gres), parse_gres(gres_used))
+        return nodes
+
+    def load(self, output):
+        self.nodes = self.parse(output)
+
+    @staticmethod
+    def is_available(node):
+        # "*" marks nodes that are not responding, other flags (e.g. "~" powered down) can still get jobs
+        return node.state.rstrip('*~#!%$@^-') in SlurmNodeSnapshot.AVAILABLE_STATES and '*' not in node.state
+
+    def select(self, partitions=None, exclude=None, available=True):
+        partitions = set(partitions) if partitions else None
+        exclude = exclude or set()
+        selected = []
+        for node in self.get().nodes.values():
+            if node.name in exclude or (partitions and not partitions & node.partitions):
+                continue
+            if available and not self.is_available(node):
+                continue
+            selected.append(node)
+        return selected
+
+    def idle_cpus(self, partitions=None, exclude=None):
+        return sum(n.cpus_idle for n in self.select(partitions, exclude))
+
+    def idle_gpus(self, partitions=None, exclude=None, gres_name='gpu'):
+        return sum(max(n.gres.get(gres_name, 0) - n.gres_used.get(gres_name, 0), 0)
+                   for n in self.select(partitions, exclude))
+
+    def free_memory(self, partitions=None, exclude=None):
+        return sum(max(n.memory - n.alloc_mem, 0) for n in self.select(partitions, exclude))
+
+
+def parse_mem(mem):
+    '''Convert a Slurm memory spec ("15gb", "500M", 2048) into MB'''
+    if isinstance(mem, (int, float)):
+        return int(mem)
+    mem = str(mem).strip().upper().rstrip('B')
+    units = {'K': 1.0 / 1024, 'M': 1, 'G': 1024, 'T': 1024 ** 2}
+    if mem and mem[-1] in units:
+        return int(float(mem[:-1]) * units[mem[-1]])
+    return int(float(mem))
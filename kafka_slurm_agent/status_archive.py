@@ -0,0 +1,85 @@
+import json
+import sqlite3
+import threading
+
+
+LOOKUP_CHUNK = 500
+
+
+class StatusArchive:
+    '''On-disk archive of the statuses of finished jobs moved out of the monitor's job_status table
+
+       Statuses are kept as JSON with the id, status, cluster, node and timestamp columns indexed so that
+       single and bulk lookups by id and filtered, id ordered pages (see select) do not scan the archive.
+       '''
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS statuses (id TEXT PRIMARY KEY, status TEXT, cluster TEXT, '
+                          'node TEXT, timestamp INTEGER, value TEXT)')
+        for column in ['status', 'cluster', 'timestamp']:
+            self.conn.execute('CREATE INDEX IF NOT EXISTS statuses_{0} ON statuses ({0})'.format(column))
+        self.conn.commit()
+
+    def put(self, statuses):
+        '''Store (id, status dict) pairs, the dicts have the status, cluster, node and timestamp keys'''
+        rows = [(s_id, value['status'], value.get('cluster'), value.get('node'), value.get('timestamp'),
+                 json.dumps(value)) for s_id, value in statuses]
+        with self.lock:
+            self.conn.executemany('INSERT OR REPLACE INTO statuses (id, status, cluster, node, timestamp, value) '
+                                  'VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.conn.commit()
+        return len(rows)
+
+    def get(self, ids):
+        statuses = {}
+        ids = list(ids)
+        with self.lock:
+            for i in range(0, len(ids), LOOKUP_CHUNK):
+                chunk = ids[i:i + LOOKUP_CHUNK]
+                for s_id, value in self.conn.execute('SELECT id, value FROM statuses WHERE id IN ({})'.format(
+                        ','.join('?' * len(chunk))), chunk):
+                    statuses[s_id] = json.loads(value)
+        return statuses
+
+    def delete(self, ids):
+        ids = list(ids)
+        with self.lock:
+            self.conn.executemany('DELETE FROM statuses WHERE id = ?', [(s_id,) for s_id in ids])
+            self.conn.commit()
+
+    def ids(self):
+        with self.lock:
+            return {s_id for s_id, in self.conn.execute('SELECT id FROM statuses')}
+
+    def counts(self):
+        '''Return (status, cluster, node, number of jobs) rows, e.g. to rebuild counters of all the jobs'''
+        with self.lock:
+            return self.conn.execute('SELECT status, cluster, node, COUNT(*) FROM statuses '
+                                     'GROUP BY status, cluster, node').fetchall()
+
+    def select(self, statuses=None, clusters=None, nodes=None, since=None, until=None, cursor=None, limit=1000):
+        '''Return up to limit (id, status dict) pairs with ids after the cursor, ordered by id'''
+        conditions = []
+        params = []
+        for column, values in [('status', statuses), ('cluster', clusters), ('node', nodes)]:
+            if values:
+                values = list(values)
+                conditions.append('{} IN ({})'.format(column, ','.join('?' * len(values))))
+                params.extend(values)
+        for condition, value in [('timestamp >= ?', since), ('timestamp < ?', until), ('id > ?', cursor)]:
+            if value is not None:
+                conditions.append(condition)
+                params.append(value)
+        query = 'SELECT id, value FROM statuses'
+        if conditions:
+            query += ' WHERE ' + ' AND '.join(conditions)
+        with self.lock:
+            rows = self.conn.execute(query + ' ORDER BY id LIMIT ?', params + [limit]).fetchall()
+        return [(s_id, json.loads(value)) for s_id, value in rows]
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
@@ -0,0 +1,76 @@
+import json
+import os
+import socket
+import socketserver
+import sys
+
+from kafka_slurm_agent.kafka_modules import config, setupLogger, KafkaSender
+
+
+class RelayHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                frame = json.loads(line)
+                if 'flush' in frame:
+                    self.server.sender.producer.flush()
+                    self.wfile.write(b'ok\n')
+                    self.wfile.flush()
+                else:
+                    key = frame['key'].encode('utf-8') if frame['key'] is not None else None
+                    self.server.sender.produce(frame['topic'], key, frame['value'])
+            except (ValueError, KeyError) as e:
+                self.server.logger.warning('Invalid message {}: {}'.format(line[:200], e))
+            except BrokenPipeError:
+                return
+
+
+class StatusRelay(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    '''Node-local daemon forwarding the messages of all jobs on the node to Kafka over one producer
+
+       ClusterComputing jobs find it through STATUS_RELAY_SOCKET (see RelayProducer). The producer batches
+       the messages of all jobs (STATUS_RELAY_LINGER_MS, STATUS_RELAY_BATCH_SIZE), compresses them and
+       serializes them with KAFKA_SERIALIZER.
+       '''
+    daemon_threads = True
+
+    def __init__(self, path, sender, logger):
+        if os.path.exists(path):
+            # a socket left by a relay that did not shut down cleanly
+            os.remove(path)
+        super(StatusRelay, self).__init__(path, RelayHandler)
+        os.chmod(path, 0o600)
+        self.path = path
+        self.sender = sender
+        self.logger = logger
+
+    def server_close(self):
+        super(StatusRelay, self).server_close()
+        self.sender.producer.flush()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RelaySender(KafkaSender):
+    def init_producer(self):
+        # the relay itself must not connect to another relay
+        return self.init_kafka_producer(compression_type=config['STATUS_RELAY_COMPRESSION'],
+                                        linger_ms=config['STATUS_RELAY_LINGER_MS'],
+                                        batch_size=config['STATUS_RELAY_BATCH_SIZE'])
+
+
+def main():
+    path = sys.argv[1] if len(sys.argv) > 1 else config['STATUS_RELAY_SOCKET']
+    logger = setupLogger(config['LOGS_DIR'], 'statusrelay_{}'.format(socket.gethostname()))
+    relay = StatusRelay(path, RelaySender(), logger)
+    logger.info('Status relay listening on {}'.format(path))
+    try:
+        relay.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        relay.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+TRACE_FORMATS = ['json', 'chrome']
+
+
+class Tracer:
+    '''Timing spans of the hot paths of an agent written to a file as JSON lines or Chrome trace events
+
+       Every span is one complete ('X') trace event with the start (ts) and duration (dur) in microseconds, the
+       process and thread ids and the arguments of the span. The json format writes one event per line, the
+       chrome format writes a JSON array that chrome://tracing and Perfetto load as it is (the closing bracket is
+       optional). Spans shorter than min_duration seconds are dropped. Until open is called span only checks
+       that the tracer is off.
+       '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.file = None
+        self.format = None
+        self.min_duration = 0
+        self.pid = os.getpid()
+
+    @property
+    def enabled(self):
+        return self.file is not None
+
+    def open(self, path, format='json', min_duration=0):
+        if format not in TRACE_FORMATS:
+            raise ValueError('Unknown trace format {}, use one of {}'.format(format, TRACE_FORMATS))
+        self.close()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        new = not os.path.isfile(path) or not os.path.getsize(path)
+        trace_file = open(path, 'a', buffering=1)
+        if format == 'chrome' and new:
+            trace_file.write('[\n')
+        with self.lock:
+            self.file = trace_file
+            self.format = format
+            self.min_duration = min_duration or 0
+            self.pid = os.getpid()
+
+    def write(self, name, start, duration, args):
+        if duration < self.min_duration:
+            return
+        line = json.dumps({'name': name, 'cat': 'ksa', 'ph': 'X', 'ts': int(start * 1e6), 'dur': int(duration * 1e6),
+                           'pid': self.pid, 'tid': threading.get_ident(), 'args': args}, default=str)
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line + (',\n' if self.format == 'chrome' else '\n'))
+
+    @contextmanager
+    def span(self, name, **args):
+        '''Time the with block, the yielded dict are the arguments of the span so results can be added to it'''
+        if self.file is None:
+            yield args
+            return
+        start = time.time()
+        started = time.perf_counter()
+        try:
+            yield args
+        finally:
+            self.write(name, start, time.perf_counter() - started, args)
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+class SamplingProfiler:
+    '''Samples the stacks of all threads of the process every interval seconds for a given time
+
+       The result is written in the collapsed stack format (one "thread;outer;...;inner count" line per stack)
+       read by speedscope and flamegraph.pl. Only one profile runs at a time.
+       '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.thread = None
+        self.path = None
+        self.until = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, seconds, path):
+        '''Start profiling in a background thread, returns False if a profile is already running'''
+        with self.lock:
+            if self.running:
+                return False
+            self.path = path
+            self.until = time.time() + seconds
+            self.thread = threading.Thread(target=self.run, args=(seconds, path), name='ksa-profiler', daemon=True)
+            self.thread.start()
+            return True
+
+    @staticmethod
+    def frame_name(frame):
+        code = frame.f_code
+        return '{} ({}:{})'.format(code.co_name, os.path.basename(code.co_filename), code.co_firstlineno).replace(
+            ';', ':')
+
+    def sample(self, stacks, thread_names):
+        own = threading.get_ident()
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            names = []
+            while frame is not None:
+                names.append(self.frame_name(frame))
+                frame = frame.f_back
+            names.append(thread_names.get(thread_id, str(thread_id)).replace(';', ':'))
+            stack = ';'.join(reversed(names))
+            stacks[stack] = stacks.get(stack, 0) + 1
+
+    def run(self, seconds, path):
+        stacks = {}
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end:
+            self.sample(stacks, {t.ident: t.name for t in threading.enumerate()})
+            time.sleep(self.interval)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in sorted(stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+TRACER = Tracer()
+PROFILER = SamplingProfiler()
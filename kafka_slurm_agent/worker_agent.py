@@ -1,11 +1,13 @@
-import ast
 import os
 import socket
 
 import faust
 import sys
 from pydoc import locate
-from kafka_slurm_agent.kafka_modules import config, HeartbeatSender
+from kafka_slurm_agent.kafka_modules import config, HeartbeatSender, JobStatus, TERMINAL_STATUSES, get_cycle_scheduler, ActiveJobIndex, \
+    start_profiler, expire_statuses
+from kafka_slurm_agent.serializers import register_faust_codec
+from kafka_slurm_agent.metrics import REGISTRY, CONTENT_TYPE
 from concurrent.futures import ThreadPoolExecutor
 
 app = faust.App(config['WORKER_NAME'] + '_worker_agent',
@@ -16,9 +18,10 @@ app = faust.App(config['WORKER_NAME'] + '_worker_agent',
                 consumer_max_fetch_size=config['KAFKA_CONSUMER_MAX_FETCH_SIZE'],
                 broker_max_poll_records=config['KAFKA_BROKER_MAX_POLL_RECORDS'],
                 transaction_timeout_ms=config['KAFKA_TRANSACTION_TIMEOUT_MS'],
+                store=config['TABLE_STORE'],
+                datadir=config['TABLE_DATA_DIR'],
                 topic_partitions=1)
-#store='rocksdb://',
-jobs_topic = app.topic(config['TOPIC_STATUS'], partitions=1)
+jobs_topic = app.topic(config['TOPIC_STATUS'], partitions=1, value_serializer=register_faust_codec())
 job_status = app.Table('job_status', default='')
 
 thread_pool = ThreadPoolExecutor(max_workers=1)
@@ -27,38 +30,48 @@ ca_class = locate(config['WORKER_AGENT_CLASS'])
 ca = ca_class()
 heartbeat_sender = HeartbeatSender()
 current_jobs = {}
+active_jobs = ActiveJobIndex(lambda js: js.node == socket.gethostname())
 
 
 def run_cluster_agent_check():
-    for key in list(job_status.keys()):
-        if key in job_status.keys():
-            js = ast.literal_eval(str(job_status[key]))
-            if 'node' in js and js['node'] == socket.gethostname() and js['status'] in ['SUBMITTED', 'WAITING', 'RUNNING', 'UPLOADING']:
-                status, reason = ca.check_job_status(js['job_id'])
-                current_jobs[key] = {'job_id': js['job_id'], 'status': status, 'timestamp': js['timestamp']}
-                if not status:
-                    ca.stat_send.send(key, 'ERROR', js['job_id'], node=reason, error='Missing from worker queue')
-                    if key in current_jobs.keys():
-                        current_jobs.pop(key)
-                elif js['status'] != status:
-                    ca.stat_send.send(key, status, js['job_id'], node=reason)
-                    current_jobs[key] = {'job_id': js['job_id'], 'status': status, 'timestamp': js['timestamp']}
-                else:
-                    current_jobs[key] = {'job_id': js['job_id'], 'status': status, 'timestamp': js['timestamp']}
-            elif key in current_jobs.keys() and js['status'] in ['DONE', 'ERROR']:
-                current_jobs.pop(key)
+    if not active_jobs.ready:
+        active_jobs.rebuild(job_status)
+    for key, js in active_jobs.items():
+        status, reason = ca.check_job_status(js.job_id)
+        if not status:
+            ca.stat_send.send(key, 'ERROR', js.job_id, node=reason, error='Missing from worker queue')
+            current_jobs.pop(key, None)
+        else:
+            if js.status != status:
+                ca.stat_send.send(key, status, js.job_id, node=reason)
+            current_jobs[key] = {'job_id': js.job_id, 'status': status, 'timestamp': js.timestamp}
+    for key in list(current_jobs.keys()):
+        if key not in active_jobs:
+            current_jobs.pop(key)
     ca.check_queue_submit()
+    ca.cleanup_job_configs(keep=set(current_jobs))
+    return ca.is_idle()
+
+
+scheduler = get_cycle_scheduler(run_cluster_agent_check, executor=thread_pool, logger=ca.logger)
 
 
 @app.agent(jobs_topic)
 async def process(stream):
     async for event in stream.events():
-        job_status[event.key.decode('UTF-8')] = event.value
+        key = event.key.decode('UTF-8')
+        value = JobStatus.from_value(event.value)
+        job_status[key] = value
+        active_jobs.update(key, value)
+        if value and value.status in TERMINAL_STATUSES and active_jobs.match(value):
+            ca.release_job_config(key)
+            # A slot was freed - submit the next jobs without waiting for the poll interval
+            scheduler.trigger()
 
 
-@app.timer(interval=config['POLL_INTERVAL'])
+@app.task
 async def check_statuses(app):
-    app.loop.run_in_executor(executor=thread_pool, func=run_cluster_agent_check)
+    await scheduler.run(app.loop)
 
 
 @app.timer(interval=config['HEARTBEAT_INTERVAL'] if config['HEARTBEAT_INTERVAL'] > 0 else 1440000)
@@ -67,6 +80,16 @@ async def send_heartbeat(app):
         heartbeat_sender.send()
 
 
+@app.timer(interval=config['STATUS_ARCHIVE_INTERVAL'])
+async def expire_old_statuses(app):
+    # finished jobs older than STATUS_ARCHIVE_AGE are not needed here, the monitor keeps them
+    if config['STATUS_ARCHIVE_AGE'] is None:
+        return
+    deleted = await expire_statuses(job_status, config['STATUS_ARCHIVE_AGE'], config['MONITOR_STATS_CHUNK_SIZE'])
+    if deleted:
+        ca.logger.info('Removed {} finished jobs from the job_status table'.format(deleted))
+
+
 @app.page(config['WORKER_AGENT_CONTEXT_PATH'] + 'stats/')
 async def get_jobs(web, request):
     return web.json({
@@ -93,5 +116,17 @@ async def get_stat(web, request):
     })
 
 
+@app.page(config['WORKER_AGENT_CONTEXT_PATH'] + 'metrics')
+async def get_metrics(web, request):
+    return web.text(REGISTRY.expose(), headers={'Content-Type': CONTENT_TYPE})
+
+
+@app.page(config['WORKER_AGENT_CONTEXT_PATH'] + 'profile/')
+async def get_profile(web, request):
+    # ?seconds=N samples the stacks of the agent for N seconds into a file in LOGS_DIR
+    result, status = start_profiler(ca.logger.name, request.query.get('seconds'))
+    return web.json(result, status=status)
+
+
 if __name__ == '__main__':
     app.main()
@@ -33,6 +33,13 @@ setup(
     install_requires=[
         'simple-slurm', 'kafka-python-ng', 'psutil>=5.6.6', 'python-math', 'faust-streaming', 'werkzeug', 'wrapt-timeout-decorator'
     ],
+    extras_require={
+        # TABLE_STORE = 'rocksdb://'
+        'rocksdb': ['faust-streaming[rocksdict]'],
+        # KAFKA_SERIALIZER = 'orjson' or 'msgpack'
+        'orjson': ['orjson'],
+        'msgpack': ['msgpack'],
+    },
     python_requires='>=3.6.0',
     classifiers=[
         "Programming Language :: Python :: 3",
@@ -0,0 +1,52 @@
+import os
+
+from kafka_slurm_agent.blob_store import DirectoryBlobStore
+from kafka_slurm_agent.kafka_modules import config, ResultsSender, Serialized, resolve_results
+from kafka_slurm_agent.serializers import loads
+
+
+def test_put_get(tmp_path):
+    store = DirectoryBlobStore(str(tmp_path))
+    data = os.urandom(100000)
+    digest = store.put(data)
+    assert store.exists(digest)
+    assert store.put(data) == digest
+    assert store.get(digest) == data
+    with store.open(digest) as f:
+        assert f.read(10) == data[:10]
+
+
+def test_corrupted_blob(tmp_path):
+    store = DirectoryBlobStore(str(tmp_path))
+    digest = store.put(b'results')
+    with open(store.get_path(digest), 'wb') as f:
+        f.write(b'changed')
+    try:
+        store.get(digest)
+        assert False
+    except ValueError:
+        pass
+
+
+class Producer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, key=None, value=None, headers=None):
+        self.sent.append(value)
+
+
+def test_results_sender(tmp_path, monkeypatch):
+    monkeypatch.setitem(config, 'RESULTS_OFFLOAD_THRESHOLD', 1000)
+    sender = ResultsSender(producer=Producer())
+    sender.blob_store = DirectoryBlobStore(str(tmp_path))
+    dumps = sender.serializer.dumps
+    calls = []
+    sender.serializer = sender.serializer._replace(dumps=lambda value: calls.append(1) or dumps(value))
+    sender.send('small', {'value': 1})
+    sender.send('large', {'value': 'x' * 2000})
+    small, large = sender.producer.sent
+    # the small results are serialized once, the producer sends these bytes
+    assert isinstance(small, Serialized) and sender.dumps(small) is small and len(calls) == 2
+    assert loads(small)['results']['value'] == 1
+    assert resolve_results(large, sender.blob_store)['results']['value'] == 'x' * 2000
@@ -0,0 +1,27 @@
+import pytest
+
+from kafka_slurm_agent.kafka_modules import check_config, ForkServerExecutor
+
+
+def test_check_config():
+    check_config({'WORKER_AGENT_EXECUTOR': 'subprocess', 'WORKER_COMPUTING_CLASSES': {}})
+    check_config({'WORKER_AGENT_EXECUTOR': 'forkserver', 'WORKER_COMPUTING_CLASSES': {'run.py': 'run.MyComputing'}})
+    for executor, classes in [('forkserver', {}), ('forkserver', 'run.MyComputing'), ('forkserver', {'run.py': 'run'}),
+                              ('forkserver', {'run.py': 'run.'}), ('threads', {})]:
+        with pytest.raises(ValueError):
+            check_config({'WORKER_AGENT_EXECUTOR': executor, 'WORKER_COMPUTING_CLASSES': classes})
+
+
+def test_class_per_script():
+    executor = ForkServerExecutor({'run.py': 'kafka_slurm_agent.kafka_modules.ClusterComputing',
+                                   'jobs/other.py': 'json.JSONDecoder'})
+    assert executor.get_class_path('python run.py 12 cfg_file=a job_id=1') == \
+        'kafka_slurm_agent.kafka_modules.ClusterComputing'
+    assert executor.get_class_path('/venv/bin/python ./jobs/other.py 12') == 'json.JSONDecoder'
+    # other scripts are not run by the executor
+    assert executor.get_class_path('python other.py 12') is None
+    assert executor.get_class_path('python') is None
+    with pytest.raises(ValueError):
+        executor.run('python other.py 12', 10)
+    with pytest.raises(ValueError):
+        ForkServerExecutor({'run.py': 'no_such_module.MyComputing'})
@@ -0,0 +1,28 @@
+import random
+
+from kafka_slurm_agent.histogram import LatencyHistogram
+
+
+def test_percentiles():
+    values = [random.lognormvariate(8, 2) for _ in range(20000)]
+    hist = LatencyHistogram()
+    for value in values:
+        hist.record(value)
+    values.sort()
+    for q in [50, 95, 99]:
+        exact = values[int(q / 100 * len(values)) - 1]
+        assert abs(hist.percentile(q) - exact) <= 0.02 * exact
+    assert hist.percentile(100) == values[-1]
+    assert hist.summary()['count'] == 20000
+
+
+def test_merge():
+    first, second = LatencyHistogram(), LatencyHistogram()
+    for value in [0, 10, 20]:
+        first.record(value)
+    second.record(1000, n=3)
+    merged = LatencyHistogram().merge(first).merge(second)
+    assert merged.count == 6
+    assert (merged.min, merged.max) == (0, 1000)
+    assert abs(merged.percentile(50) - 20) <= 0.2
+    assert LatencyHistogram().summary()['p99'] is None
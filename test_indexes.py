@@ -0,0 +1,77 @@
+from kafka_slurm_agent.kafka_modules import SortedKeyIndex, ActiveJobIndex, JobStatus
+
+
+def test_sorted_keys():
+    index = SortedKeyIndex()
+    index.rebuild(['c', 'a', 'e'])
+    page = index.read()
+    index.add('d')
+    index.add('b')
+    index.add('a')
+    keys, start = index.after('b')
+    assert keys == ['a', 'b', 'c', 'd', 'e'] and keys[start:] == ['c', 'd', 'e']
+    # a page being read keeps the keys it started with
+    assert page == ['a', 'c', 'e']
+    index.discard('c')
+    index.discard('x')
+    index.add('f')
+    keys, start = index.after('c')
+    assert keys == ['a', 'b', 'd', 'e', 'f'] and start == 2
+    assert index.after(None)[1] == 0
+    assert index.after('z')[1] == 5
+
+
+def test_sorted_keys_merged_without_reads():
+    index = SortedKeyIndex()
+    index.rebuild([])
+    for i in range(index.MERGE_MIN * 20):
+        index.add('{:06d}'.format(i))
+        assert len(index.added) <= max(len(index.keys) // 8, index.MERGE_MIN)
+    assert index.read() == sorted(index.members) and len(index.keys) == index.MERGE_MIN * 20
+
+
+def test_active_jobs():
+    index = ActiveJobIndex(lambda js: js.cluster == 'c1')
+    table = {'a': JobStatus('RUNNING', 'c1', job_id=1).to_dict(),
+             'b': JobStatus('DONE', 'c1', job_id=2).to_dict(),
+             'c': JobStatus('WAITING', 'c2', job_id=3).to_dict(),
+             'd': str(JobStatus('SUBMITTED', 'c1', job_id=4).to_dict()),
+             'e': ''}
+    index.rebuild(table)
+    assert index.ready and sorted(key for key, js in index.items()) == ['a', 'd']
+    assert index.get('d').job_id == 4
+    # status events keep it in line with the table
+    index.update('a', JobStatus('DONE', 'c1', job_id=1))
+    index.update('b', JobStatus('SUBMITTED', 'c1', job_id=5).to_dict())
+    index.update('c', JobStatus('RUNNING', 'c1', job_id=3))
+    index.update('d', None)
+    assert sorted(key for key, js in index.items()) == ['b', 'c']
+    assert 'a' not in index and len(index) == 2
+
+
+class UpdatedTable(dict):
+    '''Status table that gets status events while the index scans it'''
+
+    def __init__(self, index, events, *args):
+        super().__init__(*args)
+        self.index = index
+        self.events = events
+
+    def items(self):
+        for key, value in list(super().items()):
+            yield key, value
+            for event_key, event_value in self.events.pop(key, []):
+                self[event_key] = event_value
+                self.index.update(event_key, event_value)
+
+
+def test_active_jobs_update_during_rebuild():
+    index = ActiveJobIndex(lambda js: js.cluster == 'c1')
+    # a was read as SUBMITTED before it started running, b was read as RUNNING before it finished
+    events = {'a': [('a', JobStatus('RUNNING', 'c1', job_id=1)), ('b', JobStatus('DONE', 'c1', job_id=2))]}
+    table = UpdatedTable(index, events, {'a': JobStatus('SUBMITTED', 'c1', job_id=1),
+                                         'b': JobStatus('RUNNING', 'c1', job_id=2)})
+    index.rebuild(table)
+    assert [(key, js.status) for key, js in index.items()] == [('a', 'RUNNING')]
+    # updates after the rebuild are not kept for the next one
+    assert index.updates is None
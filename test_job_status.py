@@ -0,0 +1,44 @@
+import asyncio
+import json
+
+import pytest
+
+from kafka_slurm_agent.kafka_modules import JobStatus, Status, ActiveJobIndex, expire_statuses, now_ms
+
+OLD_STATUS = {'status': 'RUNNING', 'cluster': 'c1', 'job_id': 7, 'node': 'n1', 'timestamp': '2024-01-02 03:04:05'}
+
+
+def test_from_value():
+    # the dicts the agents sent before JobStatus, as a dict, its str() kept in old tables and as JSON
+    for value in [OLD_STATUS, str(OLD_STATUS), json.dumps(OLD_STATUS), json.dumps(OLD_STATUS).encode('utf-8')]:
+        js = JobStatus.from_value(value)
+        assert (js.status, js.cluster, js.job_id, js.node) == (Status.RUNNING, 'c1', 7, 'n1')
+        assert js.timestamp == JobStatus.parse_timestamp('2024-01-02 03:04:05')
+    js = JobStatus.from_value({'status': 'MY_STATUS'})
+    assert (js.status_name, js.cluster, js.job_id) == ('MY_STATUS', None, None)
+    assert JobStatus.from_value(js.to_dict()) == js
+    assert JobStatus.from_value(js) is js
+    assert JobStatus.from_value(None) is None and JobStatus.from_value('') is None
+
+
+def test_item_access():
+    js = JobStatus('DONE', None, job_id=3)
+    assert js['cluster'] is None and 'cluster' in js
+    assert js['job_id'] == 3 and js.get('node') is None and 'node' not in js
+    with pytest.raises(KeyError):
+        js['node']
+    # a status without a cluster does not break the index of a cluster agent
+    index = ActiveJobIndex(lambda js: js.cluster == 'c1')
+    index.update('a', JobStatus('RUNNING', None, job_id=1))
+    index.update('b', JobStatus('RUNNING', 'c1', job_id=2))
+    assert 'a' not in index and 'b' in index
+
+
+def test_expire_statuses():
+    old = now_ms() - 3600 * 1000
+    table = {'done': JobStatus('DONE', 'c1', job_id=1, timestamp=old).to_dict(),
+             'running': JobStatus('RUNNING', 'c1', job_id=2, timestamp=old).to_dict(),
+             'new': JobStatus('DONE', 'c1', job_id=3).to_dict(),
+             'deleted': None}
+    assert asyncio.run(expire_statuses(table, 60, chunk_size=2)) == 1
+    assert sorted(table) == ['deleted', 'new', 'running']
@@ -0,0 +1,52 @@
+import json
+import os
+
+from kafka_slurm_agent.job_store import JobConfigStore, read_job_config
+
+
+def test_write_read_batch(tmp_path):
+    store = JobConfigStore(str(tmp_path))
+    jobs = [{'input_job_id': 'id{}'.format(i), 'script': 'my_job.py', 'slurm_pars': {'N': i}} for i in range(5)]
+    path, refs = store.write_batch(jobs)
+    assert os.path.dirname(path) != str(tmp_path)
+    assert [read_job_config(ref) for ref in refs] == jobs
+    # job array tasks read the batch by their index
+    assert read_job_config(path, '3') == jobs[3]
+
+
+def test_release(tmp_path):
+    store = JobConfigStore(str(tmp_path))
+    path, refs = store.write_batch([{'input_job_id': 'a'}, {'input_job_id': 'b'}])
+    assert not store.release('a')
+    assert os.path.exists(path)
+    assert store.release('b')
+    assert not os.path.exists(path)
+    assert not store.release('b')
+
+
+def test_old_config_file(tmp_path):
+    cfg_file = tmp_path / 'old.json'
+    cfg_file.write_text(json.dumps([{'input_job_id': 'a'}, {'input_job_id': 'b'}]))
+    assert read_job_config(str(cfg_file), '1') == {'input_job_id': 'b'}
+
+
+def test_resubmitted_job(tmp_path):
+    store = JobConfigStore(str(tmp_path))
+    old_path, refs = store.write_batch([{'input_job_id': 'a'}])
+    path, refs = store.write_batch([{'input_job_id': 'a'}, {'input_job_id': 'a'}])
+    assert not os.path.exists(old_path)
+    assert store.release('a')
+    assert not os.path.exists(path)
+
+
+def test_cleanup_keeps_queued_jobs(tmp_path):
+    store = JobConfigStore(str(tmp_path))
+    old_path, refs = store.write_batch([{'input_job_id': 'a'}, {'input_job_id': 'b'}])
+    done_path, refs = store.write_batch([{'input_job_id': 'c'}])
+    # left behind by a previous agent run, 'a' is still pending in Slurm
+    store = JobConfigStore(str(tmp_path))
+    assert store.cleanup(-1, keep={'a', 'x'}) == 1
+    assert os.path.exists(old_path) and not os.path.exists(done_path)
+    assert store.cleanup(-1, keep={'a'}) == 0
+    assert store.release('a')
+    assert not os.path.exists(old_path)
@@ -0,0 +1,26 @@
+from kafka_slurm_agent.ledger import SubmissionLedger
+
+
+def test_lookup(tmp_path):
+    ledger = SubmissionLedger(str(tmp_path / 'ledger.db'))
+    ledger.update([('a', 'DONE'), ('b', 'ERROR'), ('c', 'RUNNING')], {0: 3})
+    ledger.update([('c', None)])
+    ledger.mark_submitted(['d'])
+    assert ledger.get_offsets() == {0: 3}
+    known, uncertain = ledger.lookup(['a', 'b', 'c', 'd'])
+    assert known == {'a': 'DONE', 'b': 'ERROR', 'd': 'SUBMITTED'}
+    assert uncertain == ['c']
+    # with the whole TOPIC_STATUS history a missing id was never processed
+    ledger.set_complete(True)
+    known, uncertain = ledger.lookup(['a', 'c'])
+    assert known == {'a': 'DONE', 'c': None}
+    assert uncertain == []
+
+
+def test_reopen(tmp_path):
+    path = str(tmp_path / 'ledger.db')
+    ledger = SubmissionLedger(path)
+    ledger.mark_submitted(['id{}'.format(i) for i in range(2000)], commit=False)
+    ledger.commit()
+    ledger.close()
+    assert len(SubmissionLedger(path).get('id{}'.format(i) for i in range(2000))) == 2000
@@ -0,0 +1,37 @@
+import pytest
+
+from kafka_slurm_agent.metrics import Registry, get_command_type
+
+
+def test_expose():
+    registry = Registry()
+    jobs = registry.counter('ksa_jobs_total', 'Jobs', ['cluster'])
+    jobs.inc(cluster='c1')
+    jobs.inc(2, cluster='c1')
+    registry.gauge('ksa_queue', 'Queue', func=lambda: 7)
+    registry.gauge('ksa_lag', 'Lag', ['group', 'topic'], func=lambda: {('g', 't'): 3})
+    duration = registry.histogram('ksa_duration_seconds', 'Duration', buckets=(1, 5))
+    for value in [0.5, 2, 10]:
+        duration.observe(value)
+    lines = registry.expose().splitlines()
+    assert '# TYPE ksa_jobs_total counter' in lines
+    assert 'ksa_jobs_total{cluster="c1"} 3' in lines
+    assert 'ksa_queue 7' in lines
+    assert 'ksa_lag{group="g",topic="t"} 3' in lines
+    assert 'ksa_duration_seconds_bucket{le="1"} 1' in lines
+    assert 'ksa_duration_seconds_bucket{le="5"} 2' in lines
+    assert 'ksa_duration_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'ksa_duration_seconds_count 3' in lines
+    assert 'ksa_duration_seconds_sum 12.5' in lines
+
+
+def test_register():
+    registry = Registry()
+    counter = registry.counter('ksa_jobs_total', 'Jobs')
+    assert registry.counter('ksa_jobs_total', 'Jobs') is counter
+    with pytest.raises(ValueError):
+        registry.gauge('ksa_jobs_total', 'Jobs')
+    with pytest.raises(ValueError):
+        counter.inc(cluster='c1')
+    assert get_command_type('/usr/bin/squeue -u user') == 'squeue'
+    assert get_command_type('ls -l') is None
@@ -0,0 +1,72 @@
+from kafka_slurm_agent.kafka_modules import JobStatus, LatencyTracker, StatusCounters
+
+
+def test_counters():
+    table = {'a': JobStatus('RUNNING', 'c1', node='n1').to_dict(),
+             'b': JobStatus('WAITING', 'c1', node='(Resources)').to_dict(),
+             'c': JobStatus('DONE', 'c2', node='n2'),
+             'd': ''}
+    counters = StatusCounters()
+    counters.update(None, table['a'])
+    assert counters.statuses == {}
+    counters.rebuild(table, archived=[('DONE', 'c2', 'n2', 10), ('ERROR', 'c1', None, 2)])
+    assert counters.statuses == {'RUNNING': 1, 'WAITING': 1, 'DONE': 11, 'ERROR': 2}
+    assert counters.clusters == {'c1': {'RUNNING': 1, 'WAITING': 1, 'ERROR': 2}, 'c2': {'DONE': 11}}
+    # the pending reason of a waiting job is not a node
+    assert counters.nodes == {'n1': {'RUNNING': 1}, 'n2': {'DONE': 11}}
+    counters.update(table['a'], JobStatus('DONE', 'c1', node='n1'))
+    counters.update(table['b'], None)
+    counters.update(None, JobStatus('SUBMITTED', 'c1'))
+    assert counters.statuses == {'DONE': 12, 'ERROR': 2, 'SUBMITTED': 1}
+    assert counters.clusters['c1'] == {'DONE': 1, 'ERROR': 2, 'SUBMITTED': 1}
+    assert counters.nodes == {'n1': {'DONE': 1}, 'n2': {'DONE': 11}}
+    assert counters.summary() == {'submitted': 1, 'waiting': 0, 'running': 0, 'done': 12, 'timeout': 0, 'error': 2}
+
+
+def test_latency_phases():
+    tracker = LatencyTracker()
+    assert tracker.update(None, 'PREPARING', 1000) is None
+    # statuses arriving out of order still record the phase once both ends are known
+    lifecycle = tracker.update(None, 'RUNNING', 5000, 'c1')
+    assert lifecycle == {'phases': [], 'RUNNING': 5000, 'cluster': 'c1'}
+    new = tracker.update(lifecycle, 'NEW', 1000)
+    assert new is not lifecycle and lifecycle['phases'] == []
+    # queue ends at RUNNING here, SUBMITTED was not known yet when it was recorded
+    assert new['phases'] == ['queue']
+    assert tracker.update(new, 'RUNNING', 6000) is None
+    lifecycle = tracker.update(new, 'SUBMITTED', 2000)
+    assert lifecycle['phases'] == ['queue', 'slurm_wait']
+    lifecycle = tracker.update(lifecycle, 'UPLOADING', 8000)
+    lifecycle = tracker.update(lifecycle, 'DONE', 9000)
+    assert lifecycle['phases'] == ['queue', 'slurm_wait', 'run', 'upload', 'total']
+    # nothing counts after the job finished
+    assert tracker.update(lifecycle, 'ERROR', 10000) is None
+    assert {phase: hist.total for phase, hist in tracker.histograms['c1'].items()} == {
+        'queue': 4000, 'slurm_wait': 3000, 'run': 3000, 'upload': 1000, 'total': 8000}
+    # a replayed NEW message does not record the phases again, a resubmitted job starts a new lifecycle
+    assert tracker.update(lifecycle, 'NEW', 1000) == lifecycle
+    assert tracker.histograms['c1']['total'].count == 1
+    assert tracker.update(lifecycle, 'NEW', 20000) == {'phases': [], 'NEW': 20000}
+
+
+def test_latency_summary():
+    tracker = LatencyTracker()
+    table = {}
+    for i in range(100):
+        cluster = 'c1' if i % 2 else 'c2'
+        lifecycle = tracker.update(None, 'NEW', 0, cluster)
+        table[str(i)] = tracker.update(lifecycle, 'RUNNING', (i + 1) * 1000)
+    table['empty'] = None
+    summary = tracker.summary()
+    assert summary['clusters']['c1']['queue']['count'] == 50
+    assert summary['clusters']['c2']['queue']['max'] == 99000
+    queue = summary['all']['queue']
+    assert (queue['count'], queue['min'], queue['max'], queue['mean']) == (100, 1000, 100000, 50500)
+    for q, exact in [('p50', 50000), ('p95', 95000), ('p99', 99000)]:
+        assert abs(queue[q] - exact) <= exact * 0.01
+    assert list(tracker.summary('c1')['clusters']) == ['c1']
+    assert tracker.summary('c1')['all']['queue']['count'] == 50
+    rebuilt = LatencyTracker()
+    rebuilt.rebuild(table)
+    assert rebuilt.ready
+    assert rebuilt.summary() == summary
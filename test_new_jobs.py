@@ -0,0 +1,156 @@
+from types import SimpleNamespace
+
+import pytest
+from kafka import TopicPartition
+from kafka.structs import OffsetAndMetadata
+
+from kafka_slurm_agent.kafka_modules import WorkingAgent, ConsumerLag
+from kafka_slurm_agent.metrics import Registry
+
+P0 = TopicPartition('new', 0)
+P1 = TopicPartition('new', 1)
+
+
+class Consumer:
+    '''Records the calls the agent makes to its NEW topic consumer'''
+
+    def __init__(self, polled):
+        self.polled = polled
+        self.paused_tps = set()
+        self.seeks = {}
+        self.commits = []
+        self.polls = []
+
+    def assignment(self):
+        return {P0, P1}
+
+    def pause(self, *tps):
+        self.paused_tps.update(tps)
+
+    def resume(self, *tps):
+        self.paused_tps.difference_update(tps)
+
+    def paused(self):
+        return set(self.paused_tps)
+
+    def poll(self, timeout_ms=0, max_records=None):
+        self.polls.append(max_records)
+        return self.polled
+
+    def seek(self, tp, offset):
+        self.seeks[tp] = offset
+
+    def commit(self, offsets):
+        self.commits.append({tp: meta.offset for tp, meta in offsets.items()})
+
+
+def record(tp, offset):
+    return SimpleNamespace(topic=tp.topic, partition=tp.partition, offset=offset, value={'input_job_id': str(offset)})
+
+
+def get_agent(polled):
+    agent = WorkingAgent.__new__(WorkingAgent)
+    agent.consumer = Consumer(polled)
+    agent.uncommitted = set()
+    agent.register_metrics(Registry())
+    return agent
+
+
+def test_poll():
+    agent = get_agent({P0: [record(P0, 5), record(P0, 6)]})
+    # no free slots - the partitions are paused and the records polled anyway are given back
+    assert agent.poll_new_jobs(0) == []
+    assert agent.consumer.paused() == {P0, P1} and agent.consumer.seeks == {P0: 5}
+    assert [el.offset for el in agent.poll_new_jobs(2)] == [5, 6]
+    assert agent.consumer.paused() == set() and agent.consumer.polls == [None, 2]
+
+
+def test_hand_off():
+    records = [record(P0, 5), record(P1, 3), record(P0, 6), record(P1, 4), record(P0, 7)]
+    agent = get_agent({})
+    submitted = []
+    agent.hand_off_jobs(records, submitted.append)
+    assert len(submitted) == 5 and agent.consumer.commits == [{P0: 8, P1: 5}]
+    assert agent.jobs_submitted.values[()] == 5
+
+    def submit(msg):
+        if msg['input_job_id'] == '6':
+            raise ValueError('sbatch failed')
+
+    agent = get_agent({})
+    with pytest.raises(ValueError):
+        agent.hand_off_jobs(records, submit)
+    # the records handed off are committed, the others are polled again from the first one not handed off
+    assert agent.consumer.commits == [{P0: 6, P1: 4}]
+    assert agent.consumer.seeks == {P0: 6, P1: 4}
+    assert agent.jobs_submitted.values[()] == 2
+
+    def submit_array(msgs):
+        raise ValueError('sbatch --array failed')
+
+    agent = get_agent({})
+    with pytest.raises(ValueError):
+        agent.hand_off_jobs(records, submit_array, batch=True)
+    assert agent.consumer.commits == [] and agent.consumer.seeks == {P0: 5, P1: 3}
+
+
+def test_hand_off_arrays():
+    records = [record(P0, 5), record(P1, 3), record(P0, 6), record(P1, 4), record(P0, 7)]
+    groups = [['5', '7'], ['3'], ['6', '4']]
+
+    def submit_arrays(msgs):
+        # one sbatch --array per group, the third one fails
+        by_id = {msg['input_job_id']: msg for msg in msgs}
+        for group in groups:
+            if group == ['6', '4']:
+                raise ValueError('sbatch --array failed')
+            yield [by_id[input_job_id] for input_job_id in group if input_job_id in by_id]
+
+    agent = get_agent({})
+    with pytest.raises(ValueError):
+        agent.hand_off_jobs(records, submit_arrays, batch=True)
+    # the groups are committed once they are submitted, 7 only after 6 which has to be polled again
+    assert agent.consumer.commits == [{P0: 6}, {P1: 4}]
+    assert agent.consumer.seeks == {P0: 6, P1: 4}
+    assert agent.uncommitted == {('new', 0, 7)}
+    assert agent.jobs_submitted.values[()] == 3
+    # the records polled again are submitted once, 7 is not submitted a second time
+    submitted = []
+    groups = [['6', '4'], ['7']]
+
+    def submit_again(msgs):
+        submitted.extend(msg['input_job_id'] for msg in msgs)
+        yield msgs
+
+    agent.hand_off_jobs([record(P0, 6), record(P1, 4), record(P0, 7)], submit_again, batch=True)
+    assert submitted == ['6', '4']
+    assert agent.consumer.commits[-1] == {P0: 8, P1: 5} and agent.uncommitted == set()
+
+
+class Offsets:
+    '''Admin client and group-less consumer of ConsumerLag, counts the requests for committed offsets'''
+
+    def __init__(self):
+        self.requests = []
+
+    def partitions_for_topic(self, topic):
+        return {0, 1}
+
+    def list_consumer_group_offsets(self, group, partitions=None):
+        self.requests.append((group, partitions))
+        # nothing committed for partition 1 yet
+        return {P0: OffsetAndMetadata(10, ''), P1: OffsetAndMetadata(-1, '')}
+
+    def end_offsets(self, partitions):
+        return {P0: 15, P1: 7}
+
+    def beginning_offsets(self, partitions):
+        return {P0: 0, P1: 2}
+
+
+def test_count_new_jobs():
+    agent = get_agent({})
+    agent.consumer_lag = ConsumerLag(ttl=0)
+    agent.consumer_lag.admin = agent.consumer_lag.consumer = offsets = Offsets()
+    assert agent.count_new_jobs('group', 'new') == 5 + 5
+    assert offsets.requests == [('group', [P0, P1])]
@@ -0,0 +1,106 @@
+import time
+from types import SimpleNamespace
+
+from kafka import TopicPartition
+
+from kafka_slurm_agent.kafka_modules import config, ClusterAgent, PilotRunner, PILOT_REJECTED, get_pilot_topic
+from kafka_slurm_agent.metrics import Registry
+
+P0 = TopicPartition('new', 0)
+
+
+class Sender:
+    '''Status sender whose producer confirms everything on flush, like the status relay'''
+
+    def __init__(self):
+        self.produced = []
+        self.sent = []
+        self.producer = SimpleNamespace(flush=lambda: None)
+
+    def produce(self, topic, key, value):
+        self.produced.append((topic, value['input_job_id'], value.get(PILOT_REJECTED)))
+        return None
+
+    def send(self, jobid, status, job_id=None, node=None):
+        self.sent.append((jobid, status))
+
+
+class Consumer:
+    def __init__(self, polls):
+        self.polls = list(polls)
+        self.commits = []
+        self.seeks = {}
+
+    def poll(self, timeout_ms=0, max_records=None):
+        return self.polls.pop(0) if self.polls else {}
+
+    def assignment(self):
+        return {P0}
+
+    def paused(self):
+        return set()
+
+    def resume(self, *tps):
+        pass
+
+    def seek(self, tp, offset):
+        self.seeks[tp] = offset
+
+    def commit(self, offsets=None):
+        self.commits.append({tp: meta.offset for tp, meta in offsets.items()} if offsets else None)
+
+    def close(self):
+        pass
+
+
+def job(offset, script):
+    return SimpleNamespace(topic=P0.topic, partition=P0.partition, offset=offset,
+                           value={'input_job_id': str(offset), 'script': script, 'slurm_pars': {}})
+
+
+def test_pilot_mixed_scripts():
+    computed = []
+    computing = SimpleNamespace(ss=Sender(), slurm_job_id='7', logger=SimpleNamespace(info=lambda msg: None),
+                                load_job=lambda msg: computed.append(msg['input_job_id']), compute=lambda: None)
+    runner = PilotRunner.__new__(PilotRunner)
+    runner.computing = computing
+    runner.script = 'run.py'
+    runner.started = time.monotonic()
+    runner.processed = 0
+    runner.consumer = Consumer([{P0: [job(0, 'other.py')]}, {P0: [job(1, 'run.py')]}, {P0: [job(2, 'other.py')]},
+                                {P0: [job(3, 'jobs/other.py')]}, {P0: [job(4, 'other.py')]}, {P0: [job(5, 'run.py')]}])
+    runner.run()
+    # jobs of other scripts count as idle polls, the pilot stops after PILOT_IDLE_POLLS of them in a row
+    assert computed == ['1'] and runner.processed == 1
+    assert runner.consumer.polls == [{P0: [job(5, 'run.py')]}]
+    # and sends them back to the NEW topic marked so that they are not passed to the pilots again
+    assert computing.ss.produced == [(config['TOPIC_NEW'], str(i), True) for i in [0, 2, 3, 4]]
+
+
+def test_dispatch_jobs(monkeypatch):
+    monkeypatch.setitem(config, 'SLURM_PILOT_JOBS', 4)
+    agent = ClusterAgent.__new__(ClusterAgent)
+    agent.register_metrics(Registry())
+    agent.logger = SimpleNamespace(info=lambda msg: None)
+    agent.script_name = 'run.py'
+    agent.stat_send = Sender()
+    agent.uncommitted = set()
+    agent.consumer = Consumer([{P0: [job(0, 'run.py'), job(1, 'other.py'), job(2, None), job(3, 'other.py')]}])
+    agent.queue_snapshot = SimpleNamespace(jobs=lambda: [])
+    agent.count_free_slots = lambda: 1
+    agent.count_new_jobs = lambda group, topic: 2
+    agent.prepare_job_configs = lambda msgs: None
+    submitted = []
+    agent.submit_new_job = lambda msg: submitted.append(msg['input_job_id'])
+    pilots = []
+    agent.submit_pilot_job = lambda: pilots.append(1)
+    agent.check_pilots_submit()
+    # jobs of the pilot script go to the pilot topic, one other job is submitted as there is one free slot
+    assert agent.stat_send.produced == [(get_pilot_topic(), '0', None), (get_pilot_topic(), '2', None)]
+    assert submitted == ['1']
+    assert agent.consumer.commits == [{P0: 1}, {P0: 3}] and agent.consumer.seeks == {P0: 3}
+    assert len(pilots) == 2
+    # a job a pilot sent back is submitted as a separate slurm job
+    rejected = job(4, 'run.py')
+    rejected.value[PILOT_REJECTED] = True
+    assert not agent.is_pilot_job(rejected.value) and agent.is_pilot_job(job(5, 'run.py').value)
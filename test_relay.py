@@ -0,0 +1,54 @@
+import json
+import socket
+import threading
+
+from kafka_slurm_agent.kafka_modules import RelayProducer
+
+
+class DirectProducer:
+    def __init__(self):
+        self.sent = []
+
+    def send(self, topic, key=None, value=None, headers=None):
+        self.sent.append((topic, key, value, headers))
+
+    def flush(self, timeout=None):
+        pass
+
+
+def run_relay(server, received):
+    # confirms the first flush, then goes away after one more message
+    conn, _ = server.accept()
+    reader = conn.makefile('rb')
+    for line in reader:
+        frame = json.loads(line)
+        if frame.get('flush'):
+            conn.sendall(b'ok\n')
+            break
+        received.append(frame['key'])
+    received.append(json.loads(reader.readline())['key'])
+    reader.close()
+    conn.close()
+
+
+def test_fallback_resends_unconfirmed(tmp_path):
+    path = str(tmp_path / 'relay.sock')
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(path)
+    server.listen(1)
+    received = []
+    relay = threading.Thread(target=run_relay, args=(server, received))
+    relay.start()
+    direct = DirectProducer()
+    producer = RelayProducer(path, lambda: direct)
+    headers = [('content-type', b'application/json')]
+    producer.send('status', key=b'a', value={'status': 'DONE'}, headers=headers)
+    producer.flush()
+    producer.send('status', key=b'b', value={'status': 'DONE'}, headers=headers)
+    relay.join()
+    producer.send('status', key=b'c', value={'status': 'ERROR'}, headers=headers)
+    producer.flush()
+    server.close()
+    assert received == ['a', 'b']
+    # a was confirmed by the flush, b and c were not
+    assert direct.sent == [('status', b'b', {'status': 'DONE'}, headers), ('status', b'c', {'status': 'ERROR'}, headers)]
@@ -0,0 +1,61 @@
+from kafka_slurm_agent.kafka_modules import config, ResourceQueue, WorkerAgent
+
+
+def test_fit_and_release():
+    queue = ResourceQueue([0, 1, 2, 3], [0], 1000)
+    assert queue.can_fit((4, 1, 1000)) and not queue.can_fit((5, 0, 0)) and not queue.can_fit((1, 2, 0))
+    assert queue.free_jobs((1, 0, 0)) == 4
+    assert queue.free_jobs((2, 0, 400)) == 2
+    queue.put('gpu', (1, 1, 600))
+    queue.put('cpu', (2, 0, 400))
+    gpu_item, gpu_alloc = queue.get()
+    cpu_item, cpu_alloc = queue.get()
+    assert (gpu_item, gpu_alloc.cpus, gpu_alloc.gpus, gpu_alloc.mem) == ('gpu', [0], [0], 600)
+    assert (cpu_item, cpu_alloc.cpus, cpu_alloc.mem) == ('cpu', [1, 2], 400)
+    assert queue.free_cpus == [3] and queue.free_gpus == [] and queue.free_mem == 0
+    assert not queue.fits((1, 0, 1)) and not queue.fits((1, 1, 0))
+    queue.release(gpu_alloc)
+    queue.release(cpu_alloc)
+    assert (queue.free_cpus, queue.free_gpus, queue.free_mem) == ([0, 1, 2, 3], [0], 1000)
+
+
+def test_skip_ahead():
+    queue = ResourceQueue([0, 1, 2, 3], [], 0)
+    queue.put('first', (3, 0, 0))
+    first, first_alloc = queue.get()
+    # the big job waits for cores, the small one behind it runs on the free core
+    queue.put('big', (2, 0, 0))
+    queue.put('small', (1, 0, 0))
+    small, small_alloc = queue.get()
+    assert (small, small_alloc.cpus) == ('small', [3])
+    assert queue.qsize() == 1
+    queue.release(first_alloc)
+    big, big_alloc = queue.get()
+    assert (big, big_alloc.cpus) == ('big', [0, 1])
+    assert queue.qsize() == 0
+
+
+def test_job_requirements():
+    agent = WorkerAgent.__new__(WorkerAgent)
+    assert agent.get_job_requirements({'RESOURCES_REQUIRED': 4, 'JOB_TYPE': 'cpu'}) == (4, 0, 0)
+    assert agent.get_job_requirements({'RESOURCES_REQUIRED': 2, 'JOB_TYPE': 'gpu', 'MEM': '2gb'}) == (1, 2, 2048)
+    assert agent.get_job_requirements({'RESOURCES_REQUIRED': 0, 'JOB_TYPE': 'cpu', 'MEM': 500}) == (1, 0, 500)
+    res_req = int(config['SLURM_RESOURCES_REQUIRED'])
+    default = (1, res_req, 0) if config['SLURM_JOB_TYPE'] == 'gpu' else (max(res_req, 1), 0, 0)
+    assert agent.get_job_requirements(None) == default
+
+
+def test_free_slots():
+    agent = WorkerAgent.__new__(WorkerAgent)
+    agent.queue = ResourceQueue(list(range(64)), [], 0)
+    agent.workers = 4
+    assert agent.get_free_slots((1, 0, 0)) == 4
+    allocs = [agent.queue.get()[1] for _ in [agent.queue.put(i) for i in range(3)]]
+    agent.queue.put('queued')
+    # 61 free cores but only one idle runner, already taken by the queued job
+    assert agent.get_free_slots((1, 0, 0)) == 0
+    agent.queue.release(allocs[0])
+    assert agent.queue.running == 2
+    assert agent.get_free_slots((1, 0, 0)) == 1
+    agent.workers = 64
+    assert agent.get_free_slots((16, 0, 0)) == 2
@@ -0,0 +1,41 @@
+import asyncio
+
+from kafka_slurm_agent.kafka_modules import CycleScheduler
+
+
+def test_backoff():
+    scheduler = CycleScheduler(lambda: True, 10, min_interval=1, max_interval=60, backoff=2)
+    assert [scheduler.next_interval(True) for _ in range(4)] == [20, 40, 60, 60]
+    # any busy cycle goes back to the base interval
+    assert scheduler.next_interval(False) == 10
+    assert scheduler.next_interval(True) == 20
+    scheduler = CycleScheduler(lambda: True, 10, min_interval=30, max_interval=5)
+    assert (scheduler.min_interval, scheduler.max_interval) == (10, 10)
+
+
+def test_trigger():
+    cycles = []
+
+    def check():
+        cycles.append(len(cycles))
+        if len(cycles) == 2:
+            raise ValueError('failed cycle')
+        return True
+
+    async def run():
+        loop = asyncio.get_running_loop()
+        scheduler = CycleScheduler(check, 0.2, min_interval=0.01, max_interval=10, backoff=100)
+        task = loop.create_task(scheduler.run(loop))
+        await asyncio.sleep(0.4)
+        # idle after the first cycle - the next one is only run early by a trigger
+        assert cycles == [0] and scheduler.current_interval == 10
+        scheduler.trigger()
+        scheduler.trigger()
+        await asyncio.sleep(0.1)
+        # the triggers are merged, a failing cycle counts as busy
+        assert cycles == [0, 1] and scheduler.current_interval == 0.2
+        await asyncio.sleep(0.4)
+        assert cycles == [0, 1, 2]
+        task.cancel()
+
+    asyncio.run(run())
@@ -0,0 +1,30 @@
+import json
+import math
+
+from kafka_slurm_agent.serializers import serializers, loads, register_faust_codec
+
+MSG = {'input_job_id': 'job_1', 'script': 'run.py', 'slurm_pars': {'RESOURCES_REQUIRED': 1, 'JOB_TYPE': 'cpu'}}
+
+
+def test_loads_any_serializer():
+    for serializer in serializers.values():
+        assert loads(serializer.dumps(MSG)) == MSG
+        assert loads(serializer.dumps(MSG), serializer.content_type) == MSG
+        assert loads(serializer.dumps(None)) is None
+
+
+def test_faust_codec():
+    from faust.serializers import codecs
+    codec = codecs.get_codec(register_faust_codec())
+    for serializer in serializers.values():
+        assert codec.loads(serializer.dumps(MSG)) == MSG
+    assert codec.loads(codec.dumps(MSG)) == MSG
+
+
+def test_loads_nan():
+    # json.dumps writes NaN and Infinity, the JSON decoder must read them whether orjson is installed or not
+    data = json.dumps({'result': float('nan'), 'max': float('inf')}).encode('utf-8')
+    value = loads(data)
+    assert math.isnan(value['result']) and value['max'] == math.inf
+    from faust.serializers import codecs
+    assert math.isnan(codecs.get_codec(register_faust_codec()).loads(data)['result'])
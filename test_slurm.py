@@ -0,0 +1,40 @@
+from kafka_slurm_agent.slurm_modules import SlurmQueueSnapshot, SlurmNodeSnapshot, expand_hostlist, parse_mem
+
+SQUEUE_OUT = '596717|RUNNING|6:53:54|prubach|troll-8|36315_KSA\n' \
+             '596718|PENDING|0:00|prubach|(Priority)|36316_KSA\n' \
+             '596719|PENDING|0:00|prubach|(Resources)|other_job\n' \
+             '596720_3|PENDING|0:00|prubach|(Priority)|ARRAY_KSA\n'
+
+
+def test_queue_snapshot():
+    snapshot = SlurmQueueSnapshot('prubach', '_KSA', ttl=60)
+    snapshot.query = lambda: SQUEUE_OUT
+    assert len(snapshot.jobs()) == 3
+    assert snapshot.get_job(596718).name == '36316_KSA'
+    assert SlurmQueueSnapshot.is_waiting(snapshot.get_job_by_name('36316_KSA'))
+    assert not SlurmQueueSnapshot.is_waiting(snapshot.get_job('596717'))
+    assert snapshot.get_job('596719') is None
+    assert snapshot.get_job('596720_3').name == 'ARRAY_KSA'
+
+
+SINFO_OUT = 'n01|all*|mix|30/34/0/64|256000|128000|100000|gpu:a100:4(S:0-1)|gpu:a100:1(IDX:0)|\n' \
+            'n01|long|mix|30/34/0/64|256000|128000|100000|gpu:a100:4(S:0-1)|gpu:a100:1(IDX:0)|\n' \
+            'n02|all*|idle|0/64/0/64|256000|0|250000|(null)|gpu:0|\n' \
+            'n03|all*|drain|0/0/64/64|256000|0|250000|(null)|gpu:0|\n'
+
+
+def test_node_snapshot():
+    snapshot = SlurmNodeSnapshot(ttl=60)
+    snapshot.query = lambda: SINFO_OUT
+    assert snapshot.idle_cpus(['all']) == 98
+    assert snapshot.idle_cpus(['all'], exclude={'n02'}) == 34
+    assert snapshot.idle_cpus(['long']) == 34
+    assert snapshot.idle_gpus(['all']) == 3
+    assert snapshot.get().nodes['n01'].partitions == {'all', 'long'}
+    assert expand_hostlist('n[01-03],gpu1') == {'n01', 'n02', 'n03', 'gpu1'}
+
+
+def test_parse_mem():
+    assert parse_mem('15gb') == 15360
+    assert parse_mem('500M') == 500
+    assert parse_mem(2048) == 2048
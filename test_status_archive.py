@@ -0,0 +1,30 @@
+from kafka_slurm_agent.status_archive import StatusArchive
+
+
+def test_lookup(tmp_path):
+    archive = StatusArchive(str(tmp_path / 'archive.db'))
+    archive.put([('a', {'status': 'DONE', 'cluster': 'c1', 'node': 'n1', 'timestamp': 1000}),
+                 ('b', {'status': 'ERROR', 'cluster': 'c1', 'timestamp': 2000, 'error': 'failed'}),
+                 ('c', {'status': 'DONE', 'cluster': 'c2', 'node': 'n2', 'timestamp': 3000})])
+    assert archive.get(['b', 'x']) == {'b': {'status': 'ERROR', 'cluster': 'c1', 'timestamp': 2000, 'error': 'failed'}}
+    archive.delete(['b'])
+    assert archive.get(['b']) == {}
+    assert sorted(archive.counts()) == [('DONE', 'c1', 'n1', 1), ('DONE', 'c2', 'n2', 1)]
+
+
+def test_select(tmp_path):
+    archive = StatusArchive(str(tmp_path / 'archive.db'))
+    archive.put([('id{:03}'.format(i), {'status': 'DONE' if i % 2 else 'ERROR', 'cluster': 'c1', 'timestamp': i})
+                 for i in range(100)])
+    page = archive.select(statuses=['DONE'], since=10, until=50, limit=5)
+    assert [s_id for s_id, value in page] == ['id011', 'id013', 'id015', 'id017', 'id019']
+    page = archive.select(statuses=['DONE'], since=10, until=50, cursor=page[-1][0], limit=100)
+    assert len(page) == 15
+    assert archive.select(clusters=['c2']) == []
+
+
+def test_ids(tmp_path):
+    archive = StatusArchive(str(tmp_path / 'archive.db'))
+    archive.put([('a', {'status': 'DONE'}), ('b', {'status': 'ERROR'})])
+    archive.delete(['a'])
+    assert archive.ids() == {'b'}
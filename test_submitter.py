@@ -0,0 +1,58 @@
+import time
+
+from kafka.errors import KafkaTimeoutError
+from kafka.future import Future
+
+from kafka_slurm_agent.kafka_modules import JobSubmitter
+
+
+class FailingProducer:
+    '''Accepts every record and fails the delivery of the ids in failing'''
+
+    def __init__(self, failing):
+        self.failing = failing
+        self.futures = []
+
+    def send(self, topic, key=None, value=None, headers=None):
+        future = Future()
+        self.futures.append((key.decode('utf-8'), future))
+        return future
+
+    def flush(self):
+        for s_id, future in self.futures:
+            if s_id in self.failing:
+                future.failure(KafkaTimeoutError('Batch for {} expired'.format(s_id)))
+            else:
+                future.success(None)
+        self.futures = []
+
+
+def get_submitter(tmp_path, failing):
+    submitter = JobSubmitter(producer=FailingProducer(failing), ledger=str(tmp_path / 'ledger.db'))
+    # no TOPIC_STATUS to read in the test
+    submitter.ledger_synced_at = time.monotonic() + 3600
+    return submitter
+
+
+def test_failed_send_not_in_ledger(tmp_path):
+    submitter = get_submitter(tmp_path, {'b', 'd'})
+    summary = submitter.send_stream(['a', 'b', 'c'], check=False)
+    assert (summary['delivered'], summary['failed']) == (2, 1)
+    assert submitter.ledger.get(['a', 'b', 'c']) == {'a': 'SUBMITTED', 'c': 'SUBMITTED'}
+    submitter.send_many(['d', 'e'], check=False)
+    assert set(submitter.ledger.get(['d', 'e'])) == {'e'}
+    assert submitter.send('d', check=False)[1]
+    assert submitter.ledger.get(['d']) == {}
+    # the failed ids are submitted again
+    submitter.producer.failing = set()
+    assert submitter.send('b', check=False)[1]
+    assert submitter.ledger.get(['b']) == {'b': 'SUBMITTED'}
+
+
+def test_in_flight(tmp_path):
+    submitter = get_submitter(tmp_path, {'b'})
+    for s_id in ['a', 'b', 'c']:
+        submitter.send(s_id, check=False, flush=False)
+    assert submitter.in_flight() == 3
+    submitter.producer.flush()
+    assert submitter.in_flight() == 0
@@ -0,0 +1,54 @@
+import json
+import os
+import time
+
+from kafka_slurm_agent.tracing import Tracer, SamplingProfiler
+
+
+def test_spans(tmpdir):
+    tracer = Tracer()
+    with tracer.span('off') as span:
+        span['records'] = 1
+    path = os.path.join(str(tmpdir), 'trace.jsonl')
+    tracer.open(path)
+    with tracer.span('outer', slots=2):
+        with tracer.span('inner') as span:
+            span['records'] = 3
+    tracer.close()
+    inner, outer = [json.loads(line) for line in open(path)]
+    assert (inner['name'], inner['args']) == ('inner', {'records': 3})
+    assert (outer['name'], outer['args'], outer['ph']) == ('outer', {'slots': 2}, 'X')
+    assert outer['ts'] <= inner['ts'] and inner['dur'] <= outer['dur']
+
+    path = os.path.join(str(tmpdir), 'trace.json')
+    for i in range(2):
+        # reopened after a restart the file stays one array
+        tracer.open(path, 'chrome')
+        with tracer.span('cycle', i=i):
+            pass
+        tracer.close()
+    events = json.loads(open(path).read().rstrip().rstrip(',') + ']')
+    assert [event['args']['i'] for event in events] == [0, 1]
+    tracer.open(path, 'chrome', min_duration=60)
+    with tracer.span('fast'):
+        pass
+    tracer.close()
+    assert len(json.loads(open(path).read().rstrip().rstrip(',') + ']')) == 2
+
+
+def busy_wait(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+
+def test_profiler(tmpdir):
+    path = os.path.join(str(tmpdir), 'profile.txt')
+    profiler = SamplingProfiler(interval=0.005)
+    assert profiler.start(0.2, path)
+    assert not profiler.start(0.2, path)
+    busy_wait(0.2)
+    profiler.thread.join()
+    stacks = [line.rsplit(' ', 1) for line in open(path).read().splitlines()]
+    assert sum(int(count) for stack, count in stacks) > 0
+    assert any('busy_wait' in stack for stack, count in stacks)